@@ -0,0 +1,467 @@
+import asyncio
+import contextlib
+import email.utils
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+import taxonomy
+
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+REQUEST_TIMEOUT = 60.0
+CONNECT_TIMEOUT = 10.0
+
+_backend = None
+
+
+@dataclass
+class Completion:
+    """
+    Backend-independent result of a chat completion request.
+
+    texts: the message contents, one per requested sample
+    prompt_tokens: number of prompt tokens as reported by the backend, 0 if unknown
+    completion_tokens: number of completion tokens as reported by the backend, 0 if unknown
+    latency: duration of the successful request in seconds, set by the scheduler
+    retries: number of failed attempts before the successful request, set by the scheduler
+    raw: the unmodified response of the backend
+    """
+    texts: list[str]
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0
+    retries: int = 0
+    raw: object = field(default=None, repr=False)
+
+
+class BackendError(Exception):
+    """
+    Raised by a backend if a request fails. Subclasses distinguish the error classes that are retried by the
+    scheduler.
+    """
+
+    def __init__(self, message: str, status_code: int = None, retry_after: float = None):
+        """
+        :param message: The error message
+        :param status_code: The HTTP status code of the response, if any
+        :param retry_after: Seconds to wait before retrying as requested by the server, if any
+        """
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RateLimitError(BackendError):
+    """
+    The request was throttled (HTTP 429)
+    """
+
+
+class ServerError(BackendError):
+    """
+    The server failed to process the request (HTTP 5xx)
+    """
+
+
+class BackendTimeoutError(BackendError):
+    """
+    The request timed out
+    """
+
+
+class BackendConnectionError(BackendError):
+    """
+    The connection to the server failed
+    """
+
+
+def parse_retry_after(headers) -> float | None:
+    """
+    Reads the delay requested by the server from the retry-after-ms or Retry-After header
+
+    :param headers: The response headers
+    :return: The delay in seconds, or None if no valid header is present
+    """
+    if headers is None:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_status_error(status_code: int, message: str, headers) -> BackendError:
+    """
+    Creates the backend error for an HTTP error status
+
+    :param status_code: The HTTP status code
+    :param message: The error message
+    :param headers: The response headers
+    :return: The matching backend error
+    """
+    if status_code == 429:
+        error_class = RateLimitError
+    elif status_code >= 500:
+        error_class = ServerError
+    else:
+        error_class = BackendError
+    return error_class(message, status_code, parse_retry_after(headers))
+
+
+class CompletionBackend:
+    """
+    Base class of all completion backends. A backend is long-lived and shared by all requests of a run, so
+    implementations should keep their connections open between calls.
+    """
+
+    def complete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                 **params) -> Completion:
+        """
+        Creates a chat completion
+
+        :param model: The model name
+        :param messages: The chat messages
+        :param temperature: The sampling temperature
+        :param n: Number of samples to generate for the messages
+        :param params: Additional request parameters that are passed to the backend
+        :return: The completion
+        """
+        raise NotImplementedError
+
+    async def acomplete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                        **params) -> Completion:
+        """
+        Async variant of complete(). See complete() for the parameters
+        """
+        raise NotImplementedError
+
+    def complete_with(self, run: Callable[[Callable[[], Completion]], Completion], model: str, messages: list[dict],
+                      temperature: float = 0.5, n: int = 1, **params) -> Completion:
+        """
+        Creates a chat completion through a function sending the request, e.g. the run_sync() of the scheduler, which
+        calls the given request function once per attempt. Wrapping backends override this, so that only the request
+        of the wrapped backend is retried. See complete() for the other parameters
+
+        :param run: Function sending the request, called with the request function
+        :return: The completion
+        """
+        return run(lambda: self.complete(model, messages, temperature, n, **params))
+
+    async def acomplete_with(self, run: Callable[[Callable[[], Awaitable[Completion]]], Awaitable[Completion]],
+                             model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                             **params) -> Completion:
+        """
+        Async variant of complete_with(), e.g. for the run() of the scheduler. See complete() for the other parameters
+        """
+        return await run(lambda: self.acomplete(model, messages, temperature, n, **params))
+
+    def begin_run(self):
+        """
+        Called at the start of each classification run
+        """
+
+    def close(self):
+        """
+        Releases all connections held by the backend
+        """
+
+
+def _timeout(request_timeout: float, connect_timeout: float) -> httpx.Timeout:
+    return httpx.Timeout(request_timeout, connect=connect_timeout)
+
+
+def _limits(max_connections: int, max_keepalive_connections: int) -> httpx.Limits:
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+
+
+@contextlib.contextmanager
+def translate_openai_errors():
+    """
+    Translates exceptions of the OpenAI SDK into backend errors
+    """
+    try:
+        yield
+    except openai.APIStatusError as e:
+        raise get_status_error(e.status_code, str(e), e.response.headers) from e
+    except openai.APITimeoutError as e:
+        raise BackendTimeoutError(str(e)) from e
+    except openai.APIConnectionError as e:
+        raise BackendConnectionError(str(e)) from e
+
+
+class OpenAIBackend(CompletionBackend):
+    """
+    Backend using the official OpenAI SDK. The sync client and one async client per event loop are created once and
+    reused, so connections, TLS sessions and keep-alive are shared by all requests. Retries are left to the
+    scheduler, so the SDK doesn't retry by default.
+    """
+
+    def __init__(self, base_url: str = None, api_key: str = None, max_connections: int = MAX_CONNECTIONS,
+                 max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS, request_timeout: float = REQUEST_TIMEOUT,
+                 connect_timeout: float = CONNECT_TIMEOUT, max_retries: int = 0):
+        """
+        :param base_url: Base URL of the API, default: the OpenAI API or OPENAI_BASE_URL
+        :param api_key: The API key, default: OPENAI_API_KEY
+        :param max_connections: Maximum number of open connections in the pool
+        :param max_keepalive_connections: Maximum number of idle connections kept alive in the pool
+        :param request_timeout: Timeout in seconds for a single request
+        :param connect_timeout: Timeout in seconds for establishing a connection
+        :param max_retries: Number of retries performed by the SDK itself
+        """
+        self.client_args = {"base_url": base_url, "api_key": api_key, "max_retries": max_retries,
+                            "timeout": _timeout(request_timeout, connect_timeout)}
+        self.limits = _limits(max_connections, max_keepalive_connections)
+        self.client = None
+        self.async_client = None
+        self.async_client_loop = None
+
+    def get_client(self) -> OpenAI:
+        if self.client is None:
+            self.client = OpenAI(**self.client_args, http_client=DefaultHttpxClient(limits=self.limits))
+        return self.client
+
+    def get_async_client(self) -> AsyncOpenAI:
+        # httpx async pools are bound to the event loop they were created in
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.async_client_loop is not loop:
+            self.async_client = AsyncOpenAI(**self.client_args,
+                                            http_client=DefaultAsyncHttpxClient(limits=self.limits))
+            self.async_client_loop = loop
+        return self.async_client
+
+    @staticmethod
+    def to_completion(response) -> Completion:
+        usage = response.usage
+        return Completion(texts=[choice.message.content or "" for choice in response.choices],
+                          prompt_tokens=usage.prompt_tokens if usage else 0,
+                          completion_tokens=usage.completion_tokens if usage else 0,
+                          raw=response)
+
+    def complete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                 **params) -> Completion:
+        with translate_openai_errors():
+            response = self.get_client().chat.completions.create(model=model, messages=messages,
+                                                                 temperature=temperature, n=n, **params)
+        return self.to_completion(response)
+
+    async def acomplete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                        **params) -> Completion:
+        with translate_openai_errors():
+            response = await self.get_async_client().chat.completions.create(model=model, messages=messages,
+                                                                             temperature=temperature, n=n, **params)
+        return self.to_completion(response)
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        # the async client belongs to an event loop that might already be closed, it is dropped with its pool
+        self.async_client = None
+        self.async_client_loop = None
+
+
+@contextlib.contextmanager
+def translate_httpx_errors():
+    """
+    Translates transport exceptions of httpx into backend errors
+    """
+    try:
+        yield
+    except httpx.TimeoutException as e:
+        raise BackendTimeoutError(str(e)) from e
+    except httpx.TransportError as e:
+        raise BackendConnectionError(str(e)) from e
+
+
+class HTTPBackend(CompletionBackend):
+    """
+    Backend for any server implementing the OpenAI-compatible /chat/completions endpoint, e.g. local inference
+    servers. Talks plain HTTP through pooled httpx clients without the OpenAI SDK.
+    """
+
+    def __init__(self, base_url: str, api_key: str = None, max_connections: int = MAX_CONNECTIONS,
+                 max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS, request_timeout: float = REQUEST_TIMEOUT,
+                 connect_timeout: float = CONNECT_TIMEOUT):
+        """
+        :param base_url: Base URL of the server, e.g. http://localhost:8000/v1
+        :param api_key: Optional API key sent as bearer token
+        :param max_connections: Maximum number of open connections in the pool
+        :param max_keepalive_connections: Maximum number of idle connections kept alive in the pool
+        :param request_timeout: Timeout in seconds for a single request
+        :param connect_timeout: Timeout in seconds for establishing a connection
+        """
+        self.url = base_url.rstrip('/') + "/chat/completions"
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.timeout = _timeout(request_timeout, connect_timeout)
+        self.limits = _limits(max_connections, max_keepalive_connections)
+        self.client = None
+        self.async_client = None
+        self.async_client_loop = None
+
+    def get_client(self) -> httpx.Client:
+        if self.client is None:
+            self.client = httpx.Client(headers=self.headers, timeout=self.timeout, limits=self.limits)
+        return self.client
+
+    def get_async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.async_client_loop is not loop:
+            self.async_client = httpx.AsyncClient(headers=self.headers, timeout=self.timeout, limits=self.limits)
+            self.async_client_loop = loop
+        return self.async_client
+
+    @staticmethod
+    def to_completion(response: httpx.Response) -> Completion:
+        if response.status_code >= 400:
+            raise get_status_error(response.status_code, f"HTTP {response.status_code}: {response.text[:200]}",
+                                   response.headers)
+        body = response.json()
+        usage = body.get("usage") or {}
+        return Completion(texts=[choice["message"].get("content") or "" for choice in body["choices"]],
+                          prompt_tokens=usage.get("prompt_tokens", 0),
+                          completion_tokens=usage.get("completion_tokens", 0),
+                          raw=body)
+
+    def complete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                 **params) -> Completion:
+        payload = {"model": model, "messages": messages, "temperature": temperature, "n": n, **params}
+        with translate_httpx_errors():
+            response = self.get_client().post(self.url, json=payload)
+        return self.to_completion(response)
+
+    async def acomplete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                        **params) -> Completion:
+        payload = {"model": model, "messages": messages, "temperature": temperature, "n": n, **params}
+        with translate_httpx_errors():
+            response = await self.get_async_client().post(self.url, json=payload)
+        return self.to_completion(response)
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        self.async_client = None
+        self.async_client_loop = None
+
+
+def random_path_responder(messages: list[dict], temperature: float) -> str:
+    """
+    Default responder of the FakeBackend, answers with a random valid category path
+
+    :param messages: The chat messages of the request
+    :param temperature: The sampling temperature of the request
+    :return: The response message
+    """
+    return f"The product fits best into {random.choice(taxonomy.get_taxonomy().get_paths())}"
+
+
+def sample_json_schema(schema: dict, random_generator: random.Random = random) -> object:
+    """
+    Creates a random value matching a JSON schema. Supports the subset used for structured outputs: objects, anyOf
+    alternatives and enums
+
+    :param schema: The JSON schema
+    :param random_generator: The source of randomness
+    :return: The value
+    """
+    if "anyOf" in schema:
+        return sample_json_schema(random_generator.choice(schema["anyOf"]), random_generator)
+    if "enum" in schema:
+        return random_generator.choice(schema["enum"])
+    if schema.get("type") == "object":
+        return {name: sample_json_schema(property_schema, random_generator)
+                for name, property_schema in schema.get("properties", {}).items()}
+    return {"string": "", "integer": 0, "number": 0.0, "boolean": False, "array": []}.get(schema.get("type"))
+
+
+def get_structured_response(params: dict, random_generator: random.Random = random) -> str | None:
+    """
+    Answers a request asking for structured output with a random valid JSON value, like a server enforcing the schema
+
+    :param params: The additional request parameters
+    :param random_generator: The source of randomness
+    :return: The JSON response, None if the request doesn't ask for a JSON schema
+    """
+    response_format = params.get("response_format") or {}
+    if response_format.get("type") != "json_schema":
+        return None
+    return json.dumps(sample_json_schema(response_format["json_schema"]["schema"], random_generator))
+
+
+class FakeBackend(CompletionBackend):
+    """
+    In-process backend that answers without any network access. Used to measure throughput offline and to test the
+    classification pipeline.
+    """
+
+    def __init__(self, responder: Callable[[list[dict], float], str] = random_path_responder, latency: float = 0.0):
+        """
+        :param responder: Function creating the response message for the given messages and temperature
+        :param latency: Simulated latency of each request in seconds
+        """
+        self.responder = responder
+        self.latency = latency
+        self.calls = 0
+
+    def create_completion(self, messages: list[dict], temperature: float, n: int, params: dict) -> Completion:
+        self.calls += 1
+        # requests with a JSON schema are answered like by a server enforcing the schema
+        texts = [get_structured_response(params) or self.responder(messages, temperature) for _ in range(n)]
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        completion_tokens = sum(len(text) for text in texts) // 4
+        return Completion(texts=texts, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def complete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                 **params) -> Completion:
+        if self.latency:
+            time.sleep(self.latency)
+        return self.create_completion(messages, temperature, n, params)
+
+    async def acomplete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                        **params) -> Completion:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.create_completion(messages, temperature, n, params)
+
+
+def get_backend() -> CompletionBackend:
+    """
+    Returns the backend used for all completions. Creates a pooled OpenAIBackend on first use if no backend was set
+
+    :return: The current backend
+    """
+    global _backend
+    if _backend is None:
+        _backend = OpenAIBackend()
+    return _backend
+
+
+def set_backend(completion_backend: CompletionBackend):
+    """
+    Sets the backend used for all completions. The previous backend is not closed, as it might be wrapped by the new
+    one
+
+    :param completion_backend: The new backend
+    """
+    global _backend
+    _backend = completion_backend
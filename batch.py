@@ -0,0 +1,233 @@
+import json
+import os
+from typing import Iterable, Iterator
+
+import pandas as pd
+
+import classifier
+import data
+from util import ExperimentType
+
+# Limits of a single input file of the OpenAI Batch API
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def get_custom_id(row_index, round_name: str | None, attempt: int = 1) -> str:
+    """
+    Creates the stable ID of a batch request. The ID only depends on the row, the round and the attempt, so output
+    files can be matched to the test data in any order
+
+    :param row_index: The index of the row in the test data
+    :param round_name: The name of the round as returned by classifier.get_rounds(), None for the baseline
+    :param attempt: Number of the attempt, later attempts repeat responses with an incorrect path format
+    :return: The custom ID
+    """
+    return f"{row_index}|{round_name if round_name is not None else ''}|{attempt}"
+
+
+def parse_custom_id(custom_id: str) -> tuple[str, str | None, int]:
+    """
+    Splits a custom ID created by get_custom_id()
+
+    :param custom_id: The custom ID
+    :return: The row index as string, the round name and the attempt
+    """
+    row_index, round_name, attempt = custom_id.rsplit("|", 2)
+    return row_index, round_name or None, int(attempt)
+
+
+def create_batch_request(custom_id: str, messages: list[dict], temperature: float, **params) -> dict:
+    """
+    Creates a line of a batch input file
+
+    :param custom_id: The custom ID of the request
+    :param messages: The chat messages
+    :param temperature: The model's temperature
+    :param params: Additional request parameters, e.g. as returned by classifier.get_completion_params()
+    :return: The batch request
+    """
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT,
+            "body": {"model": classifier.GPT_MODEL, "messages": messages, "temperature": temperature, **params}}
+
+
+def write_batch_files(batch_requests: Iterable[dict], path_prefix: str, max_requests: int = MAX_BATCH_REQUESTS,
+                      max_bytes: int = MAX_BATCH_BYTES) -> list[str]:
+    """
+    Writes batch requests to JSON Lines files, starting a new file whenever the next request would exceed the
+    request or size limit of a file
+
+    :param batch_requests: The batch requests
+    :param path_prefix: Prefix of the file paths, the files are numbered <path_prefix>_000.jsonl and so on
+    :param max_requests: Maximum number of requests per file
+    :param max_bytes: Maximum size of a file in bytes
+    :return: Paths of the written files
+    """
+    directory = os.path.dirname(path_prefix)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    paths = []
+    batch_file = None
+    requests_in_file = bytes_in_file = 0
+    try:
+        for batch_request in batch_requests:
+            line = (json.dumps(batch_request, default=str) + "\n").encode("utf-8")
+            if batch_file is None or requests_in_file >= max_requests or bytes_in_file + len(line) > max_bytes:
+                if batch_file is not None:
+                    batch_file.close()
+                paths.append(f"{path_prefix}_{len(paths):03d}.jsonl")
+                batch_file = open(paths[-1], "wb")
+                requests_in_file = bytes_in_file = 0
+            batch_file.write(line)
+            requests_in_file += 1
+            bytes_in_file += len(line)
+    finally:
+        if batch_file is not None:
+            batch_file.close()
+    return paths
+
+
+def iter_row_requests(experiment_type: ExperimentType, test_data: pd.DataFrame | Iterable[pd.DataFrame],
+                      with_definition: bool = False) -> Iterator[dict]:
+    """
+    Creates the first-attempt batch request of every round classify_single_row() performs for the test data
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param test_data: The DataFrame containing the test data, or an iterator over chunks of the test data
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :return: Iterator over the batch requests
+    """
+    chunks = [test_data] if isinstance(test_data, pd.DataFrame) else test_data
+    for chunk in chunks:
+        for i, product_name, product_brand in zip(chunk.index, chunk['Title'], chunk['Brand']):
+            for round_name, temperature, second_level_labels, third_level_labels in \
+                    classifier.get_rounds(experiment_type, i):
+                messages = classifier.get_messages(product_name, product_brand, second_level_labels,
+                                                   third_level_labels, with_definition)
+                yield create_batch_request(get_custom_id(i, round_name), messages, temperature,
+                                           **classifier.get_completion_params(second_level_labels, third_level_labels))
+
+
+def export_batch(experiment_type: ExperimentType, test_data: pd.DataFrame | Iterable[pd.DataFrame],
+                 path_prefix: str, with_definition: bool = False, max_requests: int = MAX_BATCH_REQUESTS,
+                 max_bytes: int = MAX_BATCH_BYTES) -> list[str]:
+    """
+    First phase of a batch run. Writes the requests of all rounds of all rows to batch input files, which are
+    uploaded to the Batch API separately
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param test_data: The DataFrame containing the test data, or an iterator over chunks of the test data
+    :param path_prefix: Prefix of the batch input files
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :param max_requests: Maximum number of requests per file
+    :param max_bytes: Maximum size of a file in bytes
+    :return: Paths of the batch input files
+    """
+    if classifier.TWO_STAGE:
+        raise ValueError("The second stage depends on the answer of the first stage, so the two-stage mode can't be "
+                         "exported as a single batch")
+    return write_batch_files(iter_row_requests(experiment_type, test_data, with_definition), path_prefix,
+                             max_requests, max_bytes)
+
+
+def load_batch_output(output_paths: list[str]) -> dict[str, str | None]:
+    """
+    Loads the responses of batch output and error files
+
+    :param output_paths: Paths of the output files
+    :return: The response string of the first sample keyed by custom ID, None for failed requests
+    """
+    responses = {}
+    for output_path in output_paths:
+        with open(output_path, encoding="utf-8") as output_file:
+            for line in output_file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                body = response.get("body") or {}
+                if entry.get("error") or response.get("status_code", 200) != 200 or not body.get("choices"):
+                    responses[entry["custom_id"]] = None
+                else:
+                    responses[entry["custom_id"]] = (body["choices"][0]["message"]["content"] or "").strip()
+    return responses
+
+
+def load_batch_requests(request_paths: list[str], custom_ids: set[str]) -> dict[str, dict]:
+    """
+    Loads selected requests of batch input files
+
+    :param request_paths: Paths of the input files
+    :param custom_ids: The custom IDs of the requests to be loaded
+    :return: The batch requests keyed by custom ID
+    """
+    batch_requests = {}
+    for request_path in request_paths:
+        with open(request_path, encoding="utf-8") as request_file:
+            for line in request_file:
+                if line.strip():
+                    batch_request = json.loads(line)
+                    if batch_request["custom_id"] in custom_ids:
+                        batch_requests[batch_request["custom_id"]] = batch_request
+    return batch_requests
+
+
+def ingest_batch(experiment_type: ExperimentType, test_data: pd.DataFrame | Iterable[pd.DataFrame],
+                 output_paths: list[str], request_paths: list[str] = None,
+                 followup_prefix: str = None) -> tuple[pd.DataFrame, list[str]]:
+    """
+    Second phase of a batch run. Extracts the paths of the rounds from the batch output files and combines them by
+    majority vote, like classify_single_row(). Rounds whose latest request failed or returned an incorrect path format
+    are repeated in a follow-up batch, until MAX_FORMAT_ATTEMPTS attempts failed. Rows with repeated or missing rounds
+    are left without results until the output of the follow-up batch is ingested as well, together with the earlier
+    output files.
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param test_data: The DataFrame containing the test data, or an iterator over chunks of the test data
+    :param output_paths: Paths of all output and error files received so far, including those of follow-up batches
+    :param request_paths: Paths of all input files written so far, needed to create the follow-up batch
+    :param followup_prefix: Prefix of the follow-up batch input files. No follow-up batch is written if None
+    :return: The test data with the result columns, and the paths of the follow-up batch input files
+    """
+    responses = load_batch_output(output_paths)
+    latest_responses = {}
+    for custom_id, response_string in responses.items():
+        row_index, round_name, attempt = parse_custom_id(custom_id)
+        if attempt > latest_responses.get((row_index, round_name), (0, None))[0]:
+            latest_responses[(row_index, round_name)] = (attempt, response_string)
+
+    chunks = [test_data] if isinstance(test_data, pd.DataFrame) else test_data
+    result_columns = classifier.get_result_columns(experiment_type)
+    result_chunks = []
+    retried_ids = {}
+    for chunk in chunks:
+        results = data.ResultAccumulator(result_columns)
+        for i in chunk.index:
+            rounds = classifier.get_rounds(experiment_type, i)
+            results_by_round = {}
+            for round_name, _, _, _ in rounds:
+                attempt, response_string = latest_responses.get((str(i), round_name), (0, None))
+                if attempt == 0:
+                    # the round's request hasn't been processed yet
+                    continue
+                predicted_path = classifier.extract_round_path(response_string) if response_string else -1
+                if predicted_path != -1:
+                    results_by_round[round_name] = (predicted_path, response_string)
+                elif attempt >= classifier.MAX_FORMAT_ATTEMPTS:
+                    results_by_round[round_name] = classifier.FAILED_ROUND_RESULT
+                else:
+                    retried_ids[get_custom_id(i, round_name, attempt)] = get_custom_id(i, round_name, attempt + 1)
+            if len(results_by_round) == len(rounds):
+                results.add(i, classifier.get_row_record(experiment_type, rounds, results_by_round))
+        result_chunks.append(results.join(chunk))
+
+    followup_paths = []
+    if retried_ids and followup_prefix is not None:
+        if request_paths is None:
+            raise ValueError("A follow-up batch requires the paths of the batch input files")
+        batch_requests = load_batch_requests(request_paths, set(retried_ids))
+        followup_paths = write_batch_files(({**batch_requests[custom_id], "custom_id": retried_id}
+                                            for custom_id, retried_id in retried_ids.items()), followup_prefix)
+    return pd.concat(result_chunks), followup_paths
@@ -0,0 +1,363 @@
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pandas as pd
+
+import backend
+import classifier
+import data
+import scheduler
+import taxonomy
+from util import ExperimentType
+
+# Default numbers of products per benchmark run
+BENCHMARK_SIZES = [100, 1000]
+
+# Number of products of a packed prompt, as written by packing.PACKED_PROMPT_TEMPLATE
+PACKED_COUNT_PATTERN = re.compile(r"This message specifies (\d+) products")
+
+MALFORMED_RESPONSE = "I can't decide on a category for this product."
+# Filler of one token preceding the path of unstructured responses
+REASONING_TEXT = "Hmm "
+
+
+@dataclass
+class FaultProfile:
+    """
+    Behaviour of the fake LLM server
+
+    latency_median: median response latency in seconds
+    latency_sigma: spread of the log-normal latency distribution, 0 for a constant latency
+    rate_limit_rate: share of the requests answered with 429
+    server_error_rate: share of the requests answered with 500
+    malformed_rate: share of the responses without a valid category path, which are repeated by the classifier
+    retry_after: delay in seconds requested by the Retry-After header of 429 responses
+    seconds_per_token: generation time per completion token, added to the latency of successful responses
+    reasoning_tokens: number of tokens of reasoning preceding the path in unstructured responses
+    seed: seed of the faults and latencies
+    """
+    latency_median: float = 0.05
+    latency_sigma: float = 0.5
+    rate_limit_rate: float = 0.0
+    server_error_rate: float = 0.0
+    malformed_rate: float = 0.0
+    retry_after: float = 0.05
+    seconds_per_token: float = 0.0
+    reasoning_tokens: int = 0
+    seed: int = 0
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """
+    Handles POST /chat/completions like an OpenAI-compatible server and GET /stats with the request counts
+    """
+    server: "FakeLLMServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: dict, headers: dict[str, str] = None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self.send_json(200, self.server.get_stats())
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "Not found"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        status, latency, malformed = self.server.draw_outcome(request.get("n", 1))
+        time.sleep(latency)
+        if status == 429:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                           {"Retry-After": str(self.server.profile.retry_after)})
+            return
+        if status == 500:
+            self.send_json(500, {"error": {"message": "Internal server error", "type": "server_error"}})
+            return
+        prompt = "".join(message.get("content") or "" for message in request["messages"])
+        texts = [self.server.create_response(prompt, is_malformed, request) for is_malformed in malformed]
+        # samples are generated in parallel, so the longest sample determines the generation time
+        time.sleep(max(len(text) for text in texts) // 4 * self.server.profile.seconds_per_token)
+        self.send_json(200, {
+            "id": "chatcmpl-benchmark", "object": "chat.completion", "model": request.get("model"),
+            "choices": [{"index": k, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                        for k, text in enumerate(texts)],
+            # about four characters per token
+            "usage": {"prompt_tokens": len(prompt) // 4,
+                      "completion_tokens": sum(len(text) for text in texts) // 4,
+                      "total_tokens": len(prompt) // 4 + sum(len(text) for text in texts) // 4}})
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """
+    Local stand-in for an OpenAI-compatible server. Answers with random valid category paths after a log-normal
+    latency and injects rate limits, server errors and malformed responses at the rates of its fault profile.
+    """
+    daemon_threads = True
+
+    def __init__(self, profile: FaultProfile, paths: list[str], port: int = 0):
+        """
+        :param profile: The latencies and fault rates
+        :param paths: The valid category paths
+        :param port: Port to listen on, 0 for a free port
+        """
+        super().__init__(("127.0.0.1", port), FakeLLMHandler)
+        self.profile = profile
+        self.paths = paths
+        self.random = random.Random(profile.seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "rate_limited": 0, "server_errors": 0, "samples": 0, "malformed": 0}
+
+    def draw_outcome(self, n: int) -> tuple[int, float, list[bool]]:
+        """
+        Draws the outcome of a request
+
+        :param n: Number of samples requested
+        :return: HTTP status, latency in seconds and whether each sample is malformed
+        """
+        profile = self.profile
+        with self.lock:
+            latency = profile.latency_median * self.random.lognormvariate(0, profile.latency_sigma) \
+                if profile.latency_sigma else profile.latency_median
+            self.stats["requests"] += 1
+            draw = self.random.random()
+            if draw < profile.rate_limit_rate:
+                self.stats["rate_limited"] += 1
+                return 429, latency, []
+            if draw < profile.rate_limit_rate + profile.server_error_rate:
+                self.stats["server_errors"] += 1
+                return 500, latency, []
+            malformed = [self.random.random() < profile.malformed_rate for _ in range(n)]
+            self.stats["samples"] += n
+            self.stats["malformed"] += sum(malformed)
+            return 200, latency, malformed
+
+    def create_response(self, prompt: str, malformed: bool, request: dict) -> str:
+        """
+        Creates the text of a sample. Packed prompts are answered with one marked section per product, requests
+        with a JSON schema with a random value of the schema
+
+        :param prompt: The concatenated prompt messages
+        :param malformed: Answers without a valid category path if True
+        :param request: The request body
+        :return: The response text
+        """
+        if malformed:
+            return MALFORMED_RESPONSE
+        match = PACKED_COUNT_PATTERN.search(prompt)
+        with self.lock:
+            structured_response = backend.get_structured_response(request, self.random)
+            if structured_response is not None:
+                return structured_response
+            # about four characters per token
+            reasoning = REASONING_TEXT * self.profile.reasoning_tokens
+            if match:
+                return "\n".join(f"Product {number}: {reasoning}The product fits best into "
+                                 f"{self.random.choice(self.paths)}"
+                                 for number in range(1, int(match.group(1)) + 1))
+            return f"{reasoning}The product fits best into {self.random.choice(self.paths)}"
+
+    def get_stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.stats)
+
+
+def serve(profile: FaultProfile, paths: list[str], port_queue: multiprocessing.Queue):
+    """
+    Runs a fake LLM server until the process is terminated
+
+    :param profile: The latencies and fault rates
+    :param paths: The valid category paths
+    :param port_queue: Queue receiving the port of the server once it listens
+    """
+    server = FakeLLMServer(profile, paths)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+@contextlib.contextmanager
+def start_server(profile: FaultProfile, paths: list[str] = None):
+    """
+    Starts a fake LLM server in a separate process, so that it doesn't compete with the classifier for the GIL or
+    count towards its memory
+
+    :param profile: The latencies and fault rates
+    :param paths: The valid category paths, default: the paths of the current taxonomy
+    :return: Context manager yielding the base URL of the server
+    """
+    paths = paths or taxonomy.get_taxonomy().get_paths()
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    process = context.Process(target=serve, args=(profile, paths, port_queue), daemon=True)
+    process.start()
+    try:
+        yield f"http://127.0.0.1:{port_queue.get(timeout=30)}/v1"
+    finally:
+        process.terminate()
+        process.join()
+
+
+def get_server_stats(base_url: str) -> dict[str, int]:
+    """
+    Reads the request counts of a fake LLM server
+
+    :param base_url: Base URL of the server
+    :return: The counts since the server was started
+    """
+    return httpx.get(base_url.rstrip("/") + "/stats").json()
+
+
+def get_benchmark_dataset(size: int) -> pd.DataFrame:
+    """
+    Creates a dataset of the given size by repeating the test dataset
+
+    :param size: Number of products
+    :return: The dataset with a fresh index
+    """
+    test_data = data.load_test_dataset()
+    benchmark_data = pd.concat([test_data] * (size // len(test_data) + 1)).head(size)
+    benchmark_data.index = pd.RangeIndex(size, name=data.INDEX_COLUMN)
+    return benchmark_data
+
+
+def run_case(experiment_type: ExperimentType, size: int, base_url: str, output_dir: str,
+             trace_memory: bool = True) -> dict[str, object]:
+    """
+    Classifies a benchmark dataset against a running fake LLM server with the current classifier settings
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param size: Number of products
+    :param base_url: Base URL of the fake LLM server
+    :param output_dir: Directory of the results and checkpoint files
+    :param trace_memory: Measures the peak memory with tracemalloc if True, which slows down the run
+    :return: The measurements of the run. A run that failed or left products without a result is marked as failed,
+    and its rates only count the finished products
+    """
+    benchmark_data = get_benchmark_dataset(size)
+    backend.set_backend(backend.HTTPBackend(base_url))
+    # short backoff, the fake server asks for short pauses anyway
+    scheduler.set_scheduler(scheduler.RateLimitScheduler(base_delay=0.01, max_delay=1.0, retry_budget=1.0))
+    name = f"{experiment_type.value}_{size}"
+    stats_before = get_server_stats(base_url)
+    if trace_memory:
+        tracemalloc.start()
+    results_path = os.path.join(output_dir, f"results_{name}.csv")
+    error = None
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            classifier.classify(experiment_type, benchmark_data,
+                                checkpoint_path=os.path.join(output_dir, f"checkpoint_{name}.jsonl"),
+                                results_csv_name=results_path)
+        except Exception as e:
+            error = repr(e)
+    seconds = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    stats = {key: value - stats_before[key] for key, value in get_server_stats(base_url).items()}
+    summary = classifier.run_metrics.get_summary(experiment_type.value, classifier.GPT_MODEL)
+    finished = 0
+    if os.path.exists(results_path):
+        finished = int(pd.read_csv(results_path, usecols=['Predicted Path'])['Predicted Path'].notna().sum())
+    return {'Experiment Type': experiment_type.value,
+            'Products': size,
+            'Finished Products': finished,
+            'Failed': error is not None or finished < size,
+            'Error': error,
+            'Seconds': seconds,
+            'Products Per Second': finished / seconds,
+            'Calls Per Product': summary.calls / finished if finished else None,
+            'Server Requests Per Product': stats["requests"] / finished if finished else None,
+            'Rate Limited': stats["rate_limited"],
+            'Server Errors': stats["server_errors"],
+            'Malformed Samples': stats["malformed"],
+            'Format Retries': summary.format_retries,
+            'Latency P50': summary.call_latency.percentile(50),
+            'Latency P99': summary.call_latency.percentile(99),
+            'Peak Memory MiB': peak_memory}
+
+
+def get_environment() -> dict[str, str | None]:
+    """
+    Describes where the benchmark ran, so results of different commits can be told apart
+
+    :return: Commit, Python version, platform and time of the benchmark
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'Commit': commit, 'Python': platform.python_version(), 'Platform': platform.platform(),
+            'Started': time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def run_benchmark(experiment_types: list[ExperimentType] = None, sizes: list[int] = None,
+                  profile: FaultProfile = None, trace_memory: bool = True) -> dict[str, object]:
+    """
+    Benchmarks the classification of every experiment type at every dataset size against one fake LLM server. The
+    classifier settings, e.g. the number of rounds, concurrency or pack size, are taken from the classifier module
+
+    :param experiment_types: The experiment types, default: all experiment types
+    :param sizes: Numbers of products, default: BENCHMARK_SIZES
+    :param profile: The latencies and fault rates of the server, default: no faults
+    :param trace_memory: Measures the peak memory with tracemalloc if True, which slows down the runs
+    :return: The report with environment, settings and one entry per run
+    """
+    experiment_types = experiment_types or list(ExperimentType)
+    sizes = sizes or BENCHMARK_SIZES
+    profile = profile or FaultProfile()
+    report = {'Environment': get_environment(),
+              'Fault Profile': asdict(profile),
+              'Settings': {'N Self Consistency': classifier.N_SELF_CONSISTENCY,
+                           'N Choice Shuffling': classifier.N_CHOICE_SHUFFLING,
+                           'Max Concurrency': classifier.MAX_CONCURRENCY,
+                           'Fast Mode': classifier.FAST_MODE,
+                           'Max Samples Per Request': classifier.MAX_SAMPLES_PER_REQUEST},
+              'Runs': []}
+    with start_server(profile) as base_url, tempfile.TemporaryDirectory() as output_dir:
+        for experiment_type in experiment_types:
+            for size in sizes:
+                report['Runs'].append(run_case(experiment_type, size, base_url, output_dir, trace_memory))
+    return report
+
+
+def save_report(report: dict[str, object], path: str):
+    """
+    Saves a benchmark report as JSON
+
+    :param report: The report as returned by run_benchmark()
+    :param path: Path of the JSON file, missing directories are created
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
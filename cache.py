@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable
+
+import backend
+from backend import Completion, CompletionBackend
+
+CACHE_PATH = "Cache/responses.sqlite"
+# Seconds a connection waits for the lock held by another process, e.g. another shard writing to the same cache
+BUSY_TIMEOUT = 60.0
+
+
+class CacheMissError(Exception):
+    """
+    Raised in replay-only mode if a request is not in the cache
+    """
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed store of completions in a SQLite file. Entries are evicted by age and, if the cache
+    exceeds its size limits, in least-recently-used order. Several processes may share the file.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_entries: int = None, max_bytes: int = None,
+                 max_age: float = None):
+        """
+        :param path: Path of the SQLite file, missing directories are created
+        :param max_entries: Maximum number of cached completions, None for no limit
+        :param max_bytes: Maximum total size of the cached completions in bytes, None for no limit
+        :param max_age: Maximum age of a cached completion in seconds, None for no limit
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        # write-ahead logging lets the shards of a run read while another shard writes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                                "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.connection.commit()
+        self.entries, self.bytes = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        self.evict()
+
+    @staticmethod
+    def create_key(model: str, messages: list[dict], temperature: float, n: int, params: dict,
+                   occurrence: int = 0) -> str:
+        """
+        Creates the cache key of a request
+
+        :param model: The model name
+        :param messages: The chat messages
+        :param temperature: The sampling temperature
+        :param n: Number of samples
+        :param params: Additional request parameters
+        :param occurrence: How often the identical request was already sent in this run. Repeated requests, e.g. for
+        responses with an incorrect path format, are cached as separate samples
+        :return: SHA-256 hex digest of the request
+        """
+        request = {"model": model, "messages": messages, "temperature": temperature, "n": n, "params": params,
+                   "occurrence": occurrence}
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Completion | None:
+        """
+        Looks up a cached completion and updates its access time
+
+        :param key: The cache key
+        :return: The cached completion, or None if the key is missing or expired
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+        value = json.loads(row[0])
+        return Completion(texts=value["texts"], prompt_tokens=value["prompt_tokens"],
+                          completion_tokens=value["completion_tokens"])
+
+    def put(self, key: str, completion: Completion):
+        """
+        Stores a completion and evicts entries if the cache exceeds its limits
+
+        :param key: The cache key
+        :param completion: The completion to be cached
+        """
+        value = json.dumps({"texts": completion.texts, "prompt_tokens": completion.prompt_tokens,
+                            "completion_tokens": completion.completion_tokens})
+        size = len(value.encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if previous is not None:
+                self.entries -= 1
+                self.bytes -= previous[0]
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                    (key, value, size, now, now))
+            self.connection.commit()
+            self.entries += 1
+            self.bytes += size
+        if ((self.max_entries is not None and self.entries > self.max_entries) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self.evict()
+
+    def evict(self):
+        """
+        Removes expired entries and then the least recently used entries until the size limits are met
+        """
+        with self.lock:
+            if self.max_age is not None:
+                cursor = self.connection.execute("DELETE FROM responses WHERE created_at < ?",
+                                                 (time.time() - self.max_age,))
+                self.evictions += cursor.rowcount
+            self.entries, self.bytes = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            rows = self.connection.execute("SELECT key, size FROM responses ORDER BY accessed_at")
+            evicted_keys = []
+            for key, size in rows:
+                if ((self.max_entries is None or self.entries <= self.max_entries) and
+                        (self.max_bytes is None or self.bytes <= self.max_bytes)):
+                    break
+                evicted_keys.append((key,))
+                self.entries -= 1
+                self.bytes -= size
+            self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+            self.evictions += len(evicted_keys)
+            self.connection.commit()
+
+    def stats(self) -> dict[str: int]:
+        """
+        Returns the statistics of the cache
+
+        :return: Keys: Hits, Misses, Evictions, Entries, Bytes
+        """
+        return {'Hits': self.hits, 'Misses': self.misses, 'Evictions': self.evictions, 'Entries': self.entries,
+                'Bytes': self.bytes}
+
+    def close(self):
+        """
+        Closes the SQLite connection
+        """
+        self.connection.close()
+
+
+class CachingBackend(CompletionBackend):
+    """
+    Backend wrapper answering requests from a ResponseCache and storing new completions of the wrapped backend.
+    In replay-only mode the wrapped backend is never called and a cache miss raises a CacheMissError. The cache is
+    consulted once per request, retries of the scheduler only repeat the request of the wrapped backend.
+    """
+
+    def __init__(self, completion_backend: CompletionBackend, response_cache: ResponseCache,
+                 replay_only: bool = False):
+        """
+        :param completion_backend: The backend used for cache misses
+        :param response_cache: The cache
+        :param replay_only: Raises a CacheMissError on a cache miss instead of calling the wrapped backend if True
+        """
+        self.backend = completion_backend
+        self.cache = response_cache
+        self.replay_only = replay_only
+        self.occurrences = {}
+        self.lock = threading.Lock()
+
+    def begin_run(self):
+        self.occurrences = {}
+        self.backend.begin_run()
+
+    def next_key(self, model: str, messages: list[dict], temperature: float, n: int, params: dict) \
+            -> tuple[str, str, int]:
+        """
+        Reserves the next occurrence of a request
+
+        :return: The cache key, the key of the request without occurrence and the reserved occurrence
+        """
+        request_key = ResponseCache.create_key(model, messages, temperature, n, params)
+        with self.lock:
+            occurrence = self.occurrences.get(request_key, 0)
+            self.occurrences[request_key] = occurrence + 1
+        if occurrence == 0:
+            return request_key, request_key, occurrence
+        return ResponseCache.create_key(model, messages, temperature, n, params, occurrence), request_key, occurrence
+
+    def release_occurrence(self, request_key: str, occurrence: int):
+        """
+        Gives back the occurrence of a failed request, so that a repetition of the request is cached under the same
+        key as in a run without the failure. Only the latest occurrence of a request can be given back
+        """
+        with self.lock:
+            if self.occurrences.get(request_key) == occurrence + 1:
+                self.occurrences[request_key] = occurrence
+
+    def lookup(self, key: str) -> Completion | None:
+        completion = self.cache.get(key)
+        if completion is None and self.replay_only:
+            raise CacheMissError(f"Request {key} is not cached")
+        return completion
+
+    def complete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                 **params) -> Completion:
+        return self.complete_with(lambda request: request(), model, messages, temperature, n, **params)
+
+    async def acomplete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                        **params) -> Completion:
+        return await self.acomplete_with(lambda request: request(), model, messages, temperature, n, **params)
+
+    def complete_with(self, run: Callable[[Callable[[], Completion]], Completion], model: str, messages: list[dict],
+                      temperature: float = 0.5, n: int = 1, **params) -> Completion:
+        key, request_key, occurrence = self.next_key(model, messages, temperature, n, params)
+        try:
+            completion = self.lookup(key)
+            if completion is None:
+                completion = self.backend.complete_with(run, model, messages, temperature, n, **params)
+                self.cache.put(key, completion)
+        except BaseException:
+            self.release_occurrence(request_key, occurrence)
+            raise
+        return completion
+
+    async def acomplete_with(self, run: Callable[[Callable[[], Awaitable[Completion]]], Awaitable[Completion]],
+                             model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                             **params) -> Completion:
+        key, request_key, occurrence = self.next_key(model, messages, temperature, n, params)
+        try:
+            completion = self.lookup(key)
+            if completion is None:
+                completion = await self.backend.acomplete_with(run, model, messages, temperature, n, **params)
+                self.cache.put(key, completion)
+        except BaseException:
+            self.release_occurrence(request_key, occurrence)
+            raise
+        return completion
+
+    def close(self):
+        self.backend.close()
+        self.cache.close()
+
+
+def enable_cache(path: str = CACHE_PATH, max_entries: int = None, max_bytes: int = None, max_age: float = None,
+                 replay_only: bool = False) -> CachingBackend:
+    """
+    Wraps the current completion backend into a CachingBackend
+
+    :param path: Path of the SQLite file
+    :param max_entries: Maximum number of cached completions, None for no limit
+    :param max_bytes: Maximum total size of the cached completions in bytes, None for no limit
+    :param max_age: Maximum age of a cached completion in seconds, None for no limit
+    :param replay_only: Fails on cache misses instead of calling the network if True
+    :return: The new current backend
+    """
+    caching_backend = CachingBackend(backend.get_backend(), ResponseCache(path, max_entries, max_bytes, max_age),
+                                     replay_only)
+    backend.set_backend(caching_backend)
+    return caching_backend
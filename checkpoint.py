@@ -0,0 +1,145 @@
+import json
+import os
+
+import util
+from util import ExperimentType
+
+
+def get_checkpoint_path(experiment_type: ExperimentType, with_description: bool) -> str:
+    """
+    Creates the default path of a checkpoint file in the Checkpoints directory
+
+    :param experiment_type: The experiment type
+    :param with_description: States whether the experiment is conducted with or without label definitions
+    :return: Path of the checkpoint file
+    """
+    checkpoint_name = "Checkpoints/checkpoint_" + experiment_type.value + "_"
+    if with_description:
+        checkpoint_name = checkpoint_name + "with_descriptions_"
+    return checkpoint_name + util.get_current_datetime() + ".jsonl"
+
+
+def to_json_value(value):
+    # numpy scalars, e.g. index labels, are converted to their Python equivalent
+    return value.item() if hasattr(value, 'item') else value
+
+
+def get_previous_checkpoint_path(path: str) -> str:
+    """
+    :param path: Path of a checkpoint file
+    :return: Path the file is moved to when a new run starts without resuming it
+    """
+    return os.path.splitext(path)[0] + "_previous.jsonl"
+
+
+class CheckpointWriter:
+    """
+    Appends finished rows to a JSON Lines file. The first line of a new file holds the run specification, every
+    following line the results of one row. Lines are flushed and synced to disk as they are written, so a killed run
+    loses at most the rows in flight.
+    """
+
+    def __init__(self, path: str, specification: dict[str, object], sync_interval: int = 1, resume: bool = False):
+        """
+        :param path: Path of the checkpoint file
+        :param specification: The run specification, written as header of a new file
+        :param sync_interval: Number of rows after which the file is synced to disk
+        :param resume: Appends to an existing file if True. If False, an existing file is moved to
+        <path>_previous.jsonl and a new file is started, so rows of another run are never mixed into this run
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        if not resume and os.path.exists(path):
+            os.replace(path, get_previous_checkpoint_path(path))
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        ends_with_newline = True
+        if not is_new:
+            with open(path, "rb") as file:
+                file.seek(-1, os.SEEK_END)
+                ends_with_newline = file.read(1) == b"\n"
+        self.file = open(path, "a", encoding="utf-8")
+        if not ends_with_newline:
+            # terminates a line truncated by a killed run, load_checkpoint() skips it
+            self.file.write("\n")
+        self.sync_interval = sync_interval
+        self.unsynced_rows = 0
+        if is_new:
+            self.write_line({"specification": specification})
+            self.sync()
+
+    def write_line(self, line: dict):
+        self.file.write(json.dumps(line, default=to_json_value) + "\n")
+
+    def write(self, row_index, record: dict[str, object]):
+        """
+        Appends the results of a finished row
+
+        :param row_index: The index of the row in the test data
+        :param record: The results of the row keyed by result column
+        """
+        self.write_line({"index": to_json_value(row_index), "record": record})
+        self.unsynced_rows += 1
+        if self.unsynced_rows >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """
+        Flushes the file and syncs it to disk
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced_rows = 0
+
+    def close(self):
+        """
+        Syncs and closes the file
+        """
+        self.sync()
+        self.file.close()
+
+
+def load_specification(path: str) -> dict[str, object] | None:
+    """
+    Loads the run specification of a checkpoint file
+
+    :param path: Path of the checkpoint file
+    :return: The run specification, None if the file doesn't exist or has no specification
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "specification" in entry:
+                return entry["specification"]
+    return None
+
+
+def load_checkpoint(path: str, specification: dict[str, object] = None) -> dict[object, dict[str, object]]:
+    """
+    Loads the finished rows of a checkpoint file. A truncated last line, e.g. of a killed run, is ignored.
+
+    :param path: Path of the checkpoint file
+    :param specification: If set, the run specification stored in the file has to match it
+    :return: The row results keyed by row index, empty if the file doesn't exist
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "specification" in entry:
+                if specification is not None and entry["specification"] != specification:
+                    raise ValueError(f"Checkpoint {path} was created for {entry['specification']}, "
+                                     f"not for {specification}")
+            else:
+                records[entry["index"]] = entry["record"]
+    return records
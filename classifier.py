@@ -1,24 +1,173 @@
+import asyncio
+import contextvars
+import itertools
+import signal
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
 import pandas
-import pandas as pd
-from openai import OpenAI
+import backend
+import cache
+import checkpoint
 import data
+import dedup
+import sampling
+import scheduler
+import shuffling
+import structured
+import taxonomy
 import util
 from util import ExperimentType
 import logwriter
+import matcher
+import metrics
+import packing
+import prefilter
+import profiling
 
 N_SELF_CONSISTENCY = 5
 N_CHOICE_SHUFFLING = 5
 GPT_MODEL = "gpt-3.5-turbo"
+MAX_CONCURRENCY = 8
+# Rounds sharing a prompt are requested together with up to MAX_SAMPLES_PER_REQUEST samples. Self-consistency
+# rounds only share a prompt if TEMPERATURE_BUCKETS groups their temperatures, so grouping is off by default: a
+# bucket samples its rounds at their mean temperature, which changes the results compared to exact temperatures
+MAX_SAMPLES_PER_REQUEST = 8
+TEMPERATURE_BUCKETS = None
+ADAPTIVE_VOTING = False
+VOTE_CONFIDENCE = None
+VOTE_MARGIN = None
+MIN_VOTES = 1
+# Maximum number of responses per round, responses with an incorrect path format are repeated
+MAX_FORMAT_ATTEMPTS = 5
+# Number of products packed into one prompt per experiment type, experiment types not listed classify one product
+# per prompt
+PACK_SIZES = {}
+# Local index classifying products before the LLM, only products below the confidence threshold are sent to the LLM
+PREFILTER_INDEX = None
+PREFILTER_THRESHOLD = 0.5
+TWO_STAGE = False
+# Seed of the choice shuffling orderings, None for a random seed, and whether every row gets its own orderings
+SHUFFLE_SEED = None
+PER_ROW_SHUFFLING = False
+# Asks for an enum-constrained structured answer without reasoning, capped at FAST_MAX_TOKENS completion tokens
+FAST_MODE = False
+FAST_MAX_TOKENS = structured.FAST_MAX_TOKENS
+# Classifies one representative of equivalent rows and copies its results to the other rows
+DEDUPLICATION = False
+STRIP_VARIANT_TOKENS = False
 
-second_level_shuffled_choices = []
-third_level_shuffled_choices = []
+METRICS_PROMETHEUS = False
+# Root directory of the partitioned result store, None to save the results as csv file. The run identifier defaults
+# to the name of the results csv file, the shards of a run share the identifier of the merged results
+RESULT_STORE = None
+RESULT_STORE_RUN = None
+
+request_semaphore = None
+run_metrics = None
+run_deduplicator = None
+
+
+@dataclass
+class RowState:
+    """
+    Bookkeeping of the row that is currently classified. Every task working on the row shares the same state.
+
+    row_index: the index of the row, the first row of the pack for packed prompts
+    experiment_type: the experiment type the row is classified with
+    row_metrics: token usage, latency and number of completion requests of the row, including repeated requests
+    """
+    row_index: int
+    experiment_type: ExperimentType
+    row_metrics: metrics.RowMetrics = field(default_factory=metrics.RowMetrics)
+
+
+current_row = contextvars.ContextVar("current_row")
+
+permutation_registry = None
+
+
+def get_messages(title: str, brand: str, second_level_labels: list[str], third_level_labels: list[str],
+                 with_definition: bool = False) -> list[dict]:
+    """
+    Creates the chat messages for classifying a specified product
+
+    :param title: The product title
+    :param brand: The product brand
+    :param second_level_labels: The list of second-level labels, either in original or permuted order
+    :param third_level_labels: The list of third-level labels, either in original or permuted order
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :return: The system and the user message
+    """
+    with profiling.span("prompt"):
+        return [
+            {"role": "system", "content": data.FAST_SYSTEM_PROMPT if FAST_MODE else data.SYSTEM_PROMPT},
+            {"role": "user", "content": data.format_user_prompt(title, brand, second_level_labels, third_level_labels,
+                                                                with_definition, FAST_MODE)}
+        ]
+
+
+def get_completion_params(second_level_labels: list[str], third_level_labels: list[str]) -> dict:
+    """
+    Creates the additional request parameters of a classification request
+
+    :param second_level_labels: The list of second-level labels, either in original or permuted order
+    :param third_level_labels: The list of third-level labels, either in original or permuted order
+    :return: The enum-constrained response format and the max_tokens cap in the fast mode, no parameters otherwise
+    """
+    if not FAST_MODE:
+        return {}
+    return {"response_format": structured.get_response_format(tuple(second_level_labels), tuple(third_level_labels),
+                                                              taxonomy.get_taxonomy()),
+            "max_tokens": FAST_MAX_TOKENS}
+
+
+def get_packed_messages(products: list[tuple[str, str]], second_level_labels: list[str],
+                        third_level_labels: list[str], with_definition: bool = False) -> list[dict]:
+    """
+    Creates the chat messages for classifying several products with a single prompt
+
+    :param products: Title and brand of each product
+    :param second_level_labels: The list of second-level labels, either in original or permuted order
+    :param third_level_labels: The list of third-level labels, either in original or permuted order
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :return: The system and the user message
+    """
+    with profiling.span("prompt"):
+        return [
+            {"role": "system", "content": data.SYSTEM_PROMPT},
+            {"role": "user", "content": packing.format_packed_user_prompt(products, second_level_labels,
+                                                                          third_level_labels, with_definition)}
+        ]
+
+
+def get_stage_messages(title: str, brand: str, second_level_labels: list[str], second_level_label: str = None,
+                       third_level_labels: list[str] = None, with_definition: bool = False) -> list[dict]:
+    """
+    Creates the chat messages of a stage of the two-stage mode
+
+    :param title: The product title
+    :param brand: The product brand
+    :param second_level_labels: The list of second-level labels, either in original or permuted order
+    :param second_level_label: The second-level label chosen in the first stage, None for the first stage
+    :param third_level_labels: The third-level labels below the chosen second-level label for the second stage
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :return: The system and the user message
+    """
+    with profiling.span("prompt"):
+        return [
+            {"role": "system", "content": data.SYSTEM_PROMPT},
+            {"role": "user", "content": data.format_stage_prompt(title, brand, second_level_labels,
+                                                                 second_level_label, third_level_labels,
+                                                                 with_definition)}
+        ]
 
 
 def chat_completion(title: str, brand: str, second_level_labels: list[str], third_level_labels: list[str],
-                    with_definition: bool = False, temperature: float = 0.5):
+                    with_definition: bool = False, temperature: float = 0.5) -> backend.Completion:
     """
-    Creates a Chat Completion with OpenAI's GPT-3.5-TURBO model, which classifies a specified product into its
-    hierarchical category path
+    Creates a Chat Completion with the configured GPT model through the current completion backend, which classifies
+    a specified product into its hierarchical category path. The request passes through the rate-limit scheduler,
+    which also retries failed requests
 
     :param title: The product title
     :param brand: The product brand
@@ -26,216 +175,829 @@ def chat_completion(title: str, brand: str, second_level_labels: list[str], thir
     :param third_level_labels: The list of third-level labels, either in original or permuted order
     :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
     :param temperature: The model's temperature, used for temperature-sampling with Self-Consistency
-    :return: The created response object
+    :return: The created completion
     """
-    client = OpenAI()
-    response = client.chat.completions.create(
-        model=GPT_MODEL,
-        messages=[
-            {"role": "system", "content": data.SYSTEM_PROMPT},
-            {"role": "user", "content": data.format_user_prompt(title, brand, second_level_labels, third_level_labels,
-                                                                with_definition)}
-        ],
-        temperature=temperature
-    )
-    return response
+    messages = get_messages(title, brand, second_level_labels, third_level_labels, with_definition)
+    params = get_completion_params(second_level_labels, third_level_labels)
+    tokens = scheduler.estimate_tokens(messages, max_tokens=params.get("max_tokens"))
+    return backend.get_backend().complete_with(lambda request: scheduler.get_scheduler().run_sync(request, tokens),
+                                               GPT_MODEL, messages, temperature, **params)
+
+
+async def async_chat_completion(title: str, brand: str, second_level_labels: list[str], third_level_labels: list[str],
+                                with_definition: bool = False, temperature: float = 0.5, n: int = 1,
+                                format_retry: bool = False) -> backend.Completion:
+    """
+    Async variant of chat_completion(). Waits for a free slot of the global request semaphore before sending the
+    request, so that at most MAX_CONCURRENCY requests are in flight. Token usage, latency and retries of the
+    completion are recorded in the run metrics
+
+    :param title: The product title
+    :param brand: The product brand
+    :param second_level_labels: The list of second-level labels, either in original or permuted order
+    :param third_level_labels: The list of third-level labels, either in original or permuted order
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :param temperature: The model's temperature, used for temperature-sampling with Self-Consistency
+    :param n: Number of samples generated for the prompt
+    :param format_retry: States whether the request repeats a response with an incorrect path format
+    :return: The created completion
+    """
+    messages = get_messages(title, brand, second_level_labels, third_level_labels, with_definition)
+    return await async_send_messages(messages, temperature, n, format_retry,
+                                     **get_completion_params(second_level_labels, third_level_labels))
 
 
-def classify_single_row(experiment_type: ExperimentType, row_index: int, result_dataset: pandas.DataFrame,
-                        with_definition: bool = False):
+async def async_send_messages(messages: list[dict], temperature: float = 0.5, n: int = 1,
+                              format_retry: bool = False, **params) -> backend.Completion:
     """
-    Performs single-row classification. The exact execution depends on the experiment type.
+    Sends chat messages through the scheduler, with at most MAX_CONCURRENCY requests in flight, and records the
+    completion in the run metrics
+
+    :param messages: The chat messages
+    :param temperature: The model's temperature
+    :param n: Number of samples generated for the prompt
+    :param format_retry: States whether the request repeats a response with an incorrect path format
+    :param params: Additional request parameters, e.g. as returned by get_completion_params()
+    :return: The created completion
+    """
+    with profiling.span("queue"):
+        await request_semaphore.acquire()
+    try:
+        with profiling.span("network"):
+            # the scheduler only retries the request of the innermost backend, so that a response cache is
+            # consulted once per request
+            tokens = scheduler.estimate_tokens(messages, n, params.get("max_tokens"))
+            completion = await backend.get_backend().acomplete_with(
+                lambda request: scheduler.get_scheduler().run(request, tokens), GPT_MODEL, messages, temperature, n,
+                **params)
+    finally:
+        request_semaphore.release()
+    row_state = current_row.get(None)
+    if run_metrics is not None and row_state is not None:
+        run_metrics.record_call(row_state.experiment_type.value, GPT_MODEL, row_state.row_metrics, completion,
+                                format_retry)
+    return completion
+
+
+def get_round_temperature(round_index: int) -> float:
+    """
+    Calculates the temperature of a self-consistency round. The temperatures are spread evenly over [0, 1]
+
+    :param round_index: The index of the self-consistency round
+    :return: The temperature used for this round
+    """
+    if N_SELF_CONSISTENCY > 1:
+        return round_index * 1 / (N_SELF_CONSISTENCY - 1)
+    return 0.5
+
+
+def get_rounds(experiment_type: ExperimentType, row_key=None) \
+        -> list[tuple[str | None, float, list[str], list[str]]]:
+    """
+    Lists the classification rounds that are performed for a single product. The exact rounds depend on the
+    experiment type.
 
     :param experiment_type: The experiment type as specified in util.ExperimentType
-    :param row_index: The index of the current row
-    :param result_dataset: The resulting dataset. The results will be stored here
+    :param row_key: The key of the row, e.g. its index, used to derive per-row label orderings
+    :return: List of (round name, temperature, second-level labels, third-level labels). The round name is used for
+    the result columns and is None for the baseline, which only has a single round
+    """
+    category_taxonomy = taxonomy.get_taxonomy()
+    if experiment_type == ExperimentType.BASELINE:
+        return [(None, 0.5, category_taxonomy.second_level_labels, category_taxonomy.third_level_labels)]
+    elif experiment_type == ExperimentType.SELF_CONSISTENCY:
+        return [(f"{i}", get_round_temperature(i), category_taxonomy.second_level_labels,
+                 category_taxonomy.third_level_labels)
+                for i in range(N_SELF_CONSISTENCY)]
+    elif experiment_type == ExperimentType.CHOICE_SHUFFLING:
+        orderings = get_permutation_registry().get_orderings(row_key)
+        return [(f"{i}", 0.5, orderings[i].second_level_labels, orderings[i].third_level_labels)
+                for i in range(N_CHOICE_SHUFFLING)]
+    elif experiment_type == ExperimentType.COMBINED:
+        orderings = get_permutation_registry().get_orderings(row_key)
+        return [(f"{i},{j}", get_round_temperature(i), orderings[j].second_level_labels,
+                 orderings[j].third_level_labels)
+                for i in range(N_SELF_CONSISTENCY) for j in range(N_CHOICE_SHUFFLING)]
+    else:
+        raise ValueError(f"Unknown experiment type {experiment_type}")
+
+
+def get_permutation_registry() -> shuffling.PermutationRegistry:
+    """
+    Returns the registry of the choice shuffling orderings. It is created on first use and again whenever the
+    number of orderings or the taxonomy changed
+
+    :return: The registry for the current settings
+    """
+    global permutation_registry
+    category_taxonomy = taxonomy.get_taxonomy()
+    if (permutation_registry is None or permutation_registry.n_orderings != N_CHOICE_SHUFFLING or
+            permutation_registry.second_level_labels != tuple(category_taxonomy.second_level_labels) or
+            permutation_registry.third_level_labels != tuple(category_taxonomy.third_level_labels)):
+        permutation_registry = shuffling.PermutationRegistry(category_taxonomy.second_level_labels,
+                                                             category_taxonomy.third_level_labels,
+                                                             N_CHOICE_SHUFFLING, SHUFFLE_SEED, PER_ROW_SHUFFLING)
+    return permutation_registry
+
+
+def restore_shuffle_seed(checkpoint_path: str):
+    """
+    Derives the choice shuffling orderings from the seed recorded in a checkpoint, so that a resumed run without a
+    fixed seed continues with the orderings of the interrupted run
+
+    :param checkpoint_path: Path of the checkpoint file
+    """
+    global permutation_registry
+    seed = (checkpoint.load_specification(checkpoint_path) or {}).get('Shuffle Seed')
+    if seed is not None:
+        category_taxonomy = taxonomy.get_taxonomy()
+        permutation_registry = shuffling.PermutationRegistry(category_taxonomy.second_level_labels,
+                                                             category_taxonomy.third_level_labels,
+                                                             N_CHOICE_SHUFFLING, seed, PER_ROW_SHUFFLING)
+
+
+FAILED_ROUND_RESULT = ("None>None>None", "RESPONSE PATH FORMAT INCORRECT")
+
+
+async def classify_round(product_name: str, product_brand: str, temperature: float,
+                         second_level_labels: list[str], third_level_labels: list[str],
+                         with_definition: bool = False, response_string: str = None,
+                         round_name: str = None) -> tuple[str, str]:
+    """
+    Performs a single classification round. If the response doesn't contain a valid path, the request is repeated
+    up to MAX_FORMAT_ATTEMPTS times.
+
+    :param product_name: The product title
+    :param product_brand: The product brand
+    :param temperature: The model's temperature
+    :param second_level_labels: The list of second-level labels, either in original or permuted order
+    :param third_level_labels: The list of third-level labels, either in original or permuted order
     :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
-    :return:
+    :param response_string: An already received response for this round, e.g. a sample of a multi-sample request.
+    No new request is sent unless its path format is incorrect
+    :param round_name: The name of the round, added to the log records
+    :return: The predicted path and the response string
     """
-    row = result_dataset.iloc[row_index]
-    product_name = row['Title']
-    product_brand = row['Brand']
-    result_paths = []
+    response = response_string
+    if response_string is None:
+        response = await async_chat_completion(product_name, product_brand, second_level_labels,
+                                               third_level_labels, with_definition, temperature)
+        response_string = response.texts[0].strip()
+    predicted_path = extract_round_path(response_string)
+
+    loop_counter = 0
+    while predicted_path == -1:
+        loop_counter += 1
+        if logwriter.should_log_response():
+            logwriter.write_to_log("Response path format incorrect", "WARNING", round=round_name,
+                                   attempt=loop_counter, response=response_string)
+        else:
+            logwriter.write_to_log("Response path format incorrect", "WARNING", round=round_name,
+                                   attempt=loop_counter)
+        if loop_counter >= MAX_FORMAT_ATTEMPTS:
+            predicted_path, response_string = FAILED_ROUND_RESULT
+            break
+        response = await async_chat_completion(product_name, product_brand, second_level_labels,
+                                               third_level_labels, with_definition, temperature, format_retry=True)
+        response_string = response.texts[0].strip()
+        predicted_path = extract_round_path(response_string)
+
+    return predicted_path, response_string
+
+
+async def classify_packed_round(products: list[tuple[str, str]], temperature: float,
+                                second_level_labels: list[str], third_level_labels: list[str],
+                                with_definition: bool = False, round_name: str = None) -> list[tuple[str, str]]:
+    """
+    Performs a classification round for several products with a packed prompt. Products whose section of the
+    response doesn't contain a valid path are classified with unpacked prompts, the other products keep their
+    section. If the sections can't be assigned to the products unambiguously, the whole pack is classified with
+    unpacked prompts instead, so that no product gets the answer of another product.
+
+    :param products: Title and brand of each product
+    :param temperature: The model's temperature
+    :param second_level_labels: The list of second-level labels, either in original or permuted order
+    :param third_level_labels: The list of third-level labels, either in original or permuted order
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :param round_name: The name of the round, added to the log records
+    :return: The predicted path and the response section for each product
+    """
+    messages = get_packed_messages(products, second_level_labels, third_level_labels, with_definition)
+    response = await async_send_messages(messages, temperature)
+    sections = packing.split_packed_response(response.texts[0], len(products))
+    if sections is None:
+        logwriter.write_to_log("Packed response can't be split, classifying the products separately", "WARNING",
+                               round=round_name, products=len(products))
+        results = [(-1, None)] * len(products)
+    else:
+        results = [(extract_response_path(section) if section else -1, section) for section in sections]
+    failed = [k for k, (predicted_path, _) in enumerate(results) if predicted_path == -1]
+    if failed and sections is not None:
+        logwriter.write_to_log("Packed response has no valid path for some products, classifying them separately",
+                               "WARNING", round=round_name, products=len(failed))
+    retried_results = await asyncio.gather(
+        *(classify_round(products[k][0], products[k][1], temperature, second_level_labels, third_level_labels,
+                         with_definition, round_name=round_name)
+          for k in failed))
+    for k, result in zip(failed, retried_results):
+        results[k] = result
+    return results
+
+
+async def complete_until_valid(messages: list[dict], temperature: float, extract: Callable[[str], str | int],
+                               round_name: str = None) -> tuple[str, str] | None:
+    """
+    Sends a request and repeats it until the response is valid, up to MAX_FORMAT_ATTEMPTS times
+
+    :param messages: The chat messages
+    :param temperature: The model's temperature
+    :param extract: Function extracting the answer from a response string, returning -1 for invalid responses
+    :param round_name: The name of the round, added to the log records
+    :return: The extracted answer and the response string, or None if no response was valid
+    """
+    for attempt in range(1, MAX_FORMAT_ATTEMPTS + 1):
+        response = await async_send_messages(messages, temperature, format_retry=attempt > 1)
+        response_string = response.texts[0].strip()
+        answer = extract(response_string)
+        if answer != -1:
+            return answer, response_string
+        if logwriter.should_log_response():
+            logwriter.write_to_log("Response path format incorrect", "WARNING", round=round_name, attempt=attempt,
+                                   response=response_string)
+        else:
+            logwriter.write_to_log("Response path format incorrect", "WARNING", round=round_name, attempt=attempt)
+    return None
+
+
+async def classify_two_stage_round(product_name: str, product_brand: str, temperature: float,
+                                   second_level_labels: list[str], third_level_labels: list[str],
+                                   with_definition: bool = False, round_name: str = None) -> tuple[str, str]:
+    """
+    Performs a classification round in two stages. The first request chooses the second-level category, the second
+    request chooses among its children, in the order of the round's third-level labels.
+
+    :param product_name: The product title
+    :param product_brand: The product brand
+    :param temperature: The model's temperature
+    :param second_level_labels: The list of second-level labels, either in original or permuted order
+    :param third_level_labels: The list of third-level labels, either in original or permuted order
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :param round_name: The name of the round, added to the log records
+    :return: The predicted path and both response strings
+    """
+    first_stage = await complete_until_valid(
+        get_stage_messages(product_name, product_brand, second_level_labels, with_definition=with_definition),
+        temperature, extract_second_level_label, round_name)
+    if first_stage is None:
+        return FAILED_ROUND_RESULT
+    second_level_label, first_response_string = first_stage
+
+    children = set(taxonomy.get_taxonomy().get_children(second_level_label))
+    second_stage = await complete_until_valid(
+        get_stage_messages(product_name, product_brand, second_level_labels, second_level_label,
+                           [label for label in third_level_labels if label in children], with_definition),
+        temperature, lambda response_string: extract_response_path(response_string, second_level_label), round_name)
+    if second_stage is None:
+        return FAILED_ROUND_RESULT
+    predicted_path, second_response_string = second_stage
+    return predicted_path, first_response_string + "\n\n" + second_response_string
+
+
+async def classify_request(product_name: str, product_brand: str, request: sampling.SampleRequest,
+                           with_definition: bool = False) -> list[tuple[str, str]]:
+    """
+    Performs all classification rounds served by a planned request. The rounds share a single multi-sample request,
+    only samples with an incorrect path format are repeated individually.
+
+    :param product_name: The product title
+    :param product_brand: The product brand
+    :param request: The planned request as returned by sampling.plan_requests()
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :return: The predicted path and the response string for each round of the request
+    """
+    if len(request.round_names) == 1:
+        return [await classify_round(product_name, product_brand, request.temperature, request.second_level_labels,
+                                     request.third_level_labels, with_definition, round_name=request.round_names[0])]
+
+    response = await async_chat_completion(product_name, product_brand, request.second_level_labels,
+                                           request.third_level_labels, with_definition, request.temperature,
+                                           len(request.round_names))
+    # servers that ignore n return fewer samples, the missing rounds are requested individually
+    response_strings = [text.strip() for text in response.texts]
+    response_strings += [""] * (len(request.round_names) - len(response_strings))
+    return list(await asyncio.gather(
+        *(classify_round(product_name, product_brand, request.temperature, request.second_level_labels,
+                         request.third_level_labels, with_definition, response_string, round_name)
+          for round_name, response_string in zip(request.round_names, response_strings))))
+
+
+async def classify_rounds(product_name: str, product_brand: str,
+                          rounds: list[tuple[str | None, float, list[str], list[str]]],
+                          with_definition: bool = False) -> dict[str | None, tuple[str, str]]:
+    """
+    Performs the given classification rounds for a product. Rounds sharing the same prompt are grouped into
+    multi-sample requests, and all requests are sent concurrently. In the two-stage mode, every round is performed
+    separately.
+
+    :param product_name: The product title
+    :param product_brand: The product brand
+    :param rounds: The rounds as returned by get_rounds()
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :return: The predicted path and the response string for each round name
+    """
+    if TWO_STAGE:
+        results = await asyncio.gather(
+            *(classify_two_stage_round(product_name, product_brand, temperature, second_level_labels,
+                                       third_level_labels, with_definition, round_name)
+              for round_name, temperature, second_level_labels, third_level_labels in rounds))
+        return {round_name: result for (round_name, _, _, _), result in zip(rounds, results)}
+    requests = sampling.plan_requests(rounds, MAX_SAMPLES_PER_REQUEST, TEMPERATURE_BUCKETS)
+    request_results = await asyncio.gather(
+        *(classify_request(product_name, product_brand, request, with_definition) for request in requests))
+    return {round_name: result
+            for request, results in zip(requests, request_results)
+            for round_name, result in zip(request.round_names, results)}
+
+
+def get_result_columns(experiment_type: ExperimentType) -> list[str]:
+    """
+    Lists the result columns of an experiment type in the order they are added to the test data
 
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :return: The names of the result columns
+    """
     if experiment_type == ExperimentType.BASELINE:
-        response = chat_completion(product_name, product_brand, data.SECOND_LEVEL_LABELS, data.THIRD_LEVEL_LABELS,
-                                   with_definition)
-        response_string = response.choices[0].message.content.strip()
-        majority_path = extract_response_path(response_string)
-
-        loop_counter = 0
-        while majority_path == -1:
-            loop_counter += 1
-            logwriter.write_to_log(f"Response path format incorrect for response: {response}")
-            if loop_counter >= 5:
-                response_string = "RESPONSE PATH FORMAT INCORRECT"
-                majority_path = "None>None>None"
-                break
-            response = chat_completion(product_name, product_brand, data.SECOND_LEVEL_LABELS, data.THIRD_LEVEL_LABELS,
-                                       with_definition)
-            response_string = response.choices[0].message.content.strip()
-            majority_path = extract_response_path(response_string)
-
-        result_dataset.loc[row_index, 'Predicted Path'] = majority_path
-        result_dataset.loc[row_index, 'Response'] = response_string
+        columns = ['Predicted Path', 'Response']
+    else:
+        columns = []
+        for round_name, _, _, _ in get_rounds(experiment_type):
+            columns += [f"Path Round {round_name}", f"Response Round {round_name}"]
+        columns.append('Predicted Path')
+    if ADAPTIVE_VOTING:
+        columns.append('Calls Used')
+    if PREFILTER_INDEX is not None:
+        columns += ['Prefilter Path', 'Prefilter Confidence']
+    if DEDUPLICATION:
+        columns.append('Duplicate Of')
+    return columns
 
-    elif experiment_type == ExperimentType.SELF_CONSISTENCY:
-        for i in range(N_SELF_CONSISTENCY):
-            if N_SELF_CONSISTENCY > 1:
-                temperature = i * 1 / (N_SELF_CONSISTENCY - 1)
-            else:
-                temperature = 0.5
-
-            response = chat_completion(product_name, product_brand, data.SECOND_LEVEL_LABELS, data.THIRD_LEVEL_LABELS,
-                                       with_definition, temperature)
-            response_string = response.choices[0].message.content.strip()
-            predicted_path = extract_response_path(response_string)
-
-            loop_counter = 0
-            while predicted_path == -1:
-                loop_counter += 1
-                logwriter.write_to_log(f"Response path format incorrect for response: {response}")
-                if loop_counter >= 5:
-                    response_string = "RESPONSE PATH FORMAT INCORRECT"
-                    predicted_path = "None>None>None"
-                    break
-                response = chat_completion(product_name, product_brand, data.SECOND_LEVEL_LABELS,
-                                           data.THIRD_LEVEL_LABELS, with_definition, temperature)
-                response_string = response.choices[0].message.content.strip()
-                predicted_path = extract_response_path(response_string)
-
-            logwriter.write_to_log(f"-> Round {i} completed: {predicted_path}")
-            result_paths.append(predicted_path)
-            result_dataset.loc[row_index, f"Path Round {i}"] = predicted_path
-            result_dataset.loc[row_index, f"Response Round {i}"] = response_string
 
-        majority_path = util.most_common_string(result_paths)
-        result_dataset.loc[row_index, 'Predicted Path'] = majority_path
+def get_run_specification(experiment_type: ExperimentType, with_definition: bool) -> dict[str, object]:
+    """
+    Describes the settings that determine the results of a run. A checkpoint can only be resumed by a run with the
+    same specification
 
-    elif experiment_type == ExperimentType.CHOICE_SHUFFLING:
-        init_choice_shuffling()
-        for i in range(N_CHOICE_SHUFFLING):
-            response = chat_completion(product_name, product_brand, second_level_shuffled_choices[i],
-                                       third_level_shuffled_choices[i], with_definition)
-            response_string = response.choices[0].message.content.strip()
-            predicted_path = extract_response_path(response_string)
-
-            loop_counter = 0
-            while predicted_path == -1:
-                loop_counter += 1
-                logwriter.write_to_log(f"Response path format incorrect for response: {response}")
-                if loop_counter >= 5:
-                    response_string = "RESPONSE PATH FORMAT INCORRECT"
-                    predicted_path = "None>None>None"
-                    break
-                response = chat_completion(product_name, product_brand, second_level_shuffled_choices[i],
-                                           third_level_shuffled_choices[i], with_definition)
-                response_string = response.choices[0].message.content.strip()
-                predicted_path = extract_response_path(response_string)
-
-            logwriter.write_to_log(f"-> Round {i} completed: {predicted_path}")
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param with_definition: States whether label definitions are added to the prompt
+    :return: The run specification
+    """
+    specification = {'Experiment Type': experiment_type.value, 'Descriptions': with_definition,
+                     'GPT Model': GPT_MODEL, 'Result Columns': get_result_columns(experiment_type)}
+    if TWO_STAGE:
+        specification['Two Stage'] = True
+    if FAST_MODE:
+        specification['Fast Mode'] = True
+    if DEDUPLICATION:
+        specification['Strip Variant Tokens'] = STRIP_VARIANT_TOKENS
+    if experiment_type in (ExperimentType.CHOICE_SHUFFLING, ExperimentType.COMBINED):
+        # a random seed is recorded as well, so that a resumed run continues with the same orderings
+        specification['Shuffle Seed'] = get_permutation_registry().seed
+        specification['Per-Row Shuffling'] = PER_ROW_SHUFFLING
+    return specification
+
+
+def get_row_record(experiment_type: ExperimentType, rounds: list[tuple[str | None, float, list[str], list[str]]],
+                   results_by_round: dict[str | None, tuple[str, str]]) -> dict[str, object]:
+    """
+    Combines the results of a row's rounds into the row's results. The predicted path is the majority vote of the
+    performed rounds
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param rounds: The rounds as returned by get_rounds()
+    :param results_by_round: The predicted path and the response string for each performed round
+    :return: The results of the row, keyed by result column. Rounds that weren't performed are missing
+    """
+    if experiment_type == ExperimentType.BASELINE:
+        predicted_path, response_string = results_by_round[None]
+        return {'Predicted Path': predicted_path, 'Response': response_string}
+    record = {}
+    result_paths = []
+    for round_name, _, _, _ in rounds:
+        if round_name in results_by_round:
+            predicted_path, response_string = results_by_round[round_name]
+            record[f"Path Round {round_name}"] = predicted_path
+            record[f"Response Round {round_name}"] = response_string
             result_paths.append(predicted_path)
-            result_dataset.loc[row_index, f"Path Round {i}"] = predicted_path
-            result_dataset.loc[row_index, f"Response Round {i}"] = response_string
+    record['Predicted Path'] = util.most_common_string(result_paths)
+    return record
 
-        majority_path = util.most_common_string(result_paths)
-        result_dataset.loc[row_index, 'Predicted Path'] = majority_path
 
-    elif experiment_type == ExperimentType.COMBINED:
-        init_choice_shuffling()
-        for i in range(N_SELF_CONSISTENCY):
-            if N_SELF_CONSISTENCY > 1:
-                temperature = i * 1 / (N_SELF_CONSISTENCY - 1)
+async def classify_single_row(experiment_type: ExperimentType, row_index: int, product_name: str, product_brand: str,
+                              with_definition: bool = False) -> dict[str, object]:
+    """
+    Performs single-row classification. The exact execution depends on the experiment type. With adaptive voting,
+    the rounds are performed in waves and the row stops as soon as the vote is decided, otherwise all rounds are
+    performed at once.
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param row_index: The index of the current row
+    :param product_name: The product title
+    :param product_brand: The product brand
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :return: The results of the row, keyed by result column. Rounds skipped by adaptive voting are missing
+    """
+    row_state = RowState(row_index, experiment_type)
+    current_row.set(row_state)
+    logwriter.bind(row=row_index)
+
+    logwriter.write_to_log("Row started", product=product_name)
+    rounds = get_rounds(experiment_type, row_index)
+    remaining_rounds = rounds
+    results_by_round = {}
+    result_paths = []
+    while remaining_rounds:
+        if ADAPTIVE_VOTING:
+            wave_size = util.get_next_vote_count(result_paths, len(remaining_rounds), VOTE_CONFIDENCE, VOTE_MARGIN,
+                                                 MIN_VOTES)
+        else:
+            wave_size = len(remaining_rounds)
+        wave, remaining_rounds = remaining_rounds[:wave_size], remaining_rounds[wave_size:]
+        results_by_round.update(await classify_rounds(product_name, product_brand, wave, with_definition))
+        for round_name, _, _, _ in wave:
+            logwriter.write_to_log("Round completed", round=round_name, path=results_by_round[round_name][0])
+        result_paths += [results_by_round[round_name][0] for round_name, _, _, _ in wave]
+        if ADAPTIVE_VOTING and util.is_vote_decided(result_paths, len(remaining_rounds), VOTE_CONFIDENCE,
+                                                    VOTE_MARGIN, MIN_VOTES):
+            break
+
+    record = get_row_record(experiment_type, rounds, results_by_round)
+    majority_path = record['Predicted Path']
+
+    if ADAPTIVE_VOTING:
+        record['Calls Used'] = row_state.row_metrics.calls
+    if run_metrics is not None:
+        run_metrics.record_row(experiment_type.value, GPT_MODEL, row_state.row_metrics)
+    logwriter.write_to_log("Row completed", path=majority_path, calls=row_state.row_metrics.calls)
+    return record
+
+
+async def classify_packed_rows(experiment_type: ExperimentType, rows: list[tuple[object, str, str]],
+                               with_definition: bool = False) -> list[dict[str, object]]:
+    """
+    Performs the classification of several rows with packed prompts. Every round sends one prompt for all rows, the
+    rows' results are combined like in classify_single_row()
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param rows: Index, product title and product brand of each row
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :return: The results of each row, keyed by result column
+    """
+    pack_state = RowState(rows[0][0], experiment_type)
+    current_row.set(pack_state)
+    logwriter.bind(row=[i for i, _, _ in rows])
+
+    rounds = get_rounds(experiment_type, rows[0][0])
+    products = [(product_name, product_brand) for _, product_name, product_brand in rows]
+    round_results = await asyncio.gather(
+        *(classify_packed_round(products, temperature, second_level_labels, third_level_labels, with_definition,
+                                round_name)
+          for round_name, temperature, second_level_labels, third_level_labels in rounds))
+
+    row_metrics = pack_state.row_metrics.share(len(rows))
+    records = []
+    for k, (i, _, _) in enumerate(rows):
+        results_by_round = {round_name: results[k] for (round_name, _, _, _), results in zip(rounds, round_results)}
+        record = get_row_record(experiment_type, rounds, results_by_round)
+        logwriter.write_to_log("Row completed", row=i, path=record['Predicted Path'])
+        if run_metrics is not None:
+            run_metrics.record_row(experiment_type.value, GPT_MODEL, row_metrics)
+        records.append(record)
+    return records
+
+
+async def classify_chunk(experiment_type: ExperimentType, chunk: pandas.DataFrame,
+                         results: data.ResultAccumulator, finished_records: dict[object, dict[str, object]],
+                         checkpoint_writer: checkpoint.CheckpointWriter, with_definition: bool = False):
+    """
+    Classifies the rows of a chunk. With deduplication, only one representative of equivalent rows is classified
+    and its results are copied to the other rows. If a prefilter index is set, all rows are classified by the index
+    first and only rows below PREFILTER_THRESHOLD are classified by the LLM, whose results are added to the index
+    afterwards.
+    Rows are processed by MAX_CONCURRENCY workers, every finished row is added to the results and appended to the
+    checkpoint. If a pack size is set for the experiment type, every worker classifies a pack of rows at once.
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param chunk: The DataFrame containing the rows of the chunk
+    :param results: The accumulator the row results are added to
+    :param finished_records: Rows finished in a resumed run. Rows of the chunk are taken from here instead of being
+    classified again
+    :param checkpoint_writer: The writer of the checkpoint file
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    """
+    resumed_rows = set()
+    for i in chunk.index:
+        if i in finished_records:
+            results.add(i, finished_records.pop(i))
+            resumed_rows.add(i)
+    pending_rows = [(i, product_name, product_brand)
+                    for i, product_name, product_brand in zip(chunk.index, chunk['Title'], chunk['Brand'])
+                    if i not in resumed_rows]
+
+    prefilter_records = {}
+    classified_products = []
+
+    def finish_duplicate(i, representative, record: dict[str, object]):
+        duplicate_record = {**record, 'Duplicate Of': representative}
+        results.add(i, duplicate_record)
+        checkpoint_writer.write(i, duplicate_record)
+        if run_metrics is not None:
+            run_metrics.record_resolved_row(experiment_type.value, GPT_MODEL, "duplicate")
+
+    def finish_row(i, record: dict[str, object]):
+        with profiling.span("results"):
+            record.update(prefilter_records.get(i, {}))
+            results.add(i, record)
+            checkpoint_writer.write(i, record)
+            print(f"Round {i} done")
+            if run_deduplicator is not None:
+                for duplicate in run_deduplicator.finish(i, record):
+                    finish_duplicate(duplicate, i, record)
+
+    if run_deduplicator is not None:
+        row_count = len(pending_rows)
+        with profiling.span("dedup"):
+            pending_rows, known_duplicates = run_deduplicator.split(pending_rows)
+        for i, representative, record in known_duplicates:
+            finish_duplicate(i, representative, record)
+        logwriter.write_to_log("Deduplicated rows", rows=row_count, representatives=len(pending_rows),
+                               known_duplicates=len(known_duplicates))
+
+    if PREFILTER_INDEX is not None:
+        with profiling.span("prefilter"):
+            predictions = PREFILTER_INDEX.query([prefilter.get_product_text(product_name, product_brand)
+                                                 for _, product_name, product_brand in pending_rows])
+        uncertain_rows = []
+        for (i, product_name, product_brand), (path, confidence) in zip(pending_rows, predictions):
+            prefilter_records[i] = {'Prefilter Path': path, 'Prefilter Confidence': confidence}
+            if confidence >= PREFILTER_THRESHOLD:
+                if run_metrics is not None:
+                    run_metrics.record_resolved_row(experiment_type.value, GPT_MODEL, "prefilter")
+                finish_row(i, {'Predicted Path': path, **prefilter_records[i]})
             else:
-                temperature = 0.5
-            for j in range(N_CHOICE_SHUFFLING):
-                response = chat_completion(product_name, product_brand, second_level_shuffled_choices[j],
-                                           third_level_shuffled_choices[j], with_definition, temperature)
-                response_string = response.choices[0].message.content.strip()
-                predicted_path = extract_response_path(response_string)
-
-                loop_counter = 0
-                while predicted_path == -1:
-                    loop_counter += 1
-                    logwriter.write_to_log(f"Response path format incorrect for response: {response}")
-                    if loop_counter >= 5:
-                        response_string = "RESPONSE PATH FORMAT INCORRECT"
-                        predicted_path = "None>None>None"
-                        break
-                    response = chat_completion(product_name, product_brand, second_level_shuffled_choices[j],
-                                               third_level_shuffled_choices[j], with_definition, temperature)
-                    response_string = response.choices[0].message.content.strip()
-                    predicted_path = extract_response_path(response_string)
-
-                logwriter.write_to_log(f"-> Round {i},{j} completed: {predicted_path}")
-                result_paths.append(predicted_path)
-                result_dataset.loc[row_index, f"Path Round {i},{j}"] = predicted_path
-                result_dataset.loc[row_index, f"Response Round {i},{j}"] = response_string
-
-        majority_path = util.most_common_string(result_paths)
-        result_dataset.loc[row_index, 'Predicted Path'] = majority_path
+                uncertain_rows.append((i, product_name, product_brand))
+        logwriter.write_to_log("Prefilter classified rows", rows=len(pending_rows) - len(uncertain_rows),
+                               uncertain_rows=len(uncertain_rows))
+        pending_rows = uncertain_rows
+    pending_rows = iter(pending_rows)
 
-    else:
-        raise ValueError(f"Unknown experiment type {experiment_type}")
+    async def row_worker():
+        for i, product_name, product_brand in pending_rows:
+            with profiling.span("row"):
+                record = await classify_single_row(experiment_type, i, product_name, product_brand, with_definition)
+            classified_products.append((prefilter.get_product_text(product_name, product_brand),
+                                        record['Predicted Path']))
+            finish_row(i, record)
 
-    logwriter.write_to_log(f"Final Response: {majority_path}\n")
-    return result_dataset
+    async def pack_worker():
+        while rows := list(itertools.islice(pending_rows, pack_size)):
+            with profiling.span("pack"):
+                records = await classify_packed_rows(experiment_type, rows, with_definition)
+            for (i, product_name, product_brand), record in zip(rows, records):
+                classified_products.append((prefilter.get_product_text(product_name, product_brand),
+                                            record['Predicted Path']))
+                finish_row(i, record)
 
+    pack_size = get_pack_size(experiment_type)
+    worker = row_worker if pack_size == 1 else pack_worker
 
-def classify(experiment_type: ExperimentType, test_data: pandas.DataFrame, with_definition: bool = False) \
-        -> pandas.DataFrame:
+    workers = [asyncio.create_task(worker()) for _ in range(MAX_CONCURRENCY)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+    if PREFILTER_INDEX is not None and classified_products:
+        texts, paths = zip(*classified_products)
+        PREFILTER_INDEX.add(list(texts), list(paths))
+
+
+async def classify_async(experiment_type: ExperimentType, test_data: pandas.DataFrame | Iterable[pandas.DataFrame],
+                         with_definition: bool = False, checkpoint_path: str = None, resume: bool = False,
+                         results_csv_name: str = None) -> pandas.DataFrame | None:
     """
-    Performs the classification for the whole dataset by calling classify_single_row() for each row.
-    The output is saved into a csv file
+    Performs the classification for the whole dataset. Rows and the rounds within each row are classified
+    concurrently, at most MAX_CONCURRENCY requests are in flight at the same time. The test data is either a
+    DataFrame or an iterator over chunks, e.g. from data.iter_products(). Each chunk is joined with its results and
+    appended to the results csv file, or to the result store if set, before the next chunk is read, so memory stays
+    flat for streamed catalogs.
+    Every finished row is appended to a checkpoint file, so that an interrupted run can be resumed.
 
     :param experiment_type: The experiment type as specified in util.ExperimentType
-    :param test_data: The DataFrame containing the test data
+    :param test_data: The DataFrame containing the test data, or an iterator over chunks of the test data
     :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
-    :returns: result_dataset: The DataFrame containing the classification results
+    :param checkpoint_path: Path of the checkpoint file, default: a new file in the Checkpoints directory
+    :param resume: Loads the rows finished in checkpoint_path and only classifies the remaining rows if True
+    :param results_csv_name: Path of the results csv file, default: a new file in the Results directory
+    :returns: result_dataset: The DataFrame containing the classification results. None if the test data is an
+    iterator over chunks, the results are only saved to the csv file then
     """
+    if ADAPTIVE_VOTING and get_pack_size(experiment_type) > 1:
+        raise ValueError("Adaptive voting can't be combined with packed prompts")
+    if TWO_STAGE and get_pack_size(experiment_type) > 1:
+        raise ValueError("The two-stage mode can't be combined with packed prompts")
+    if FAST_MODE and (TWO_STAGE or get_pack_size(experiment_type) > 1):
+        raise ValueError("The fast mode can't be combined with the two-stage mode or packed prompts")
     logwriter.open_log()
+    run_profiler = profiling.begin_run()
     logwriter.write_to_log("Starting Product Classification")
     if with_definition:
         description_string = "with category descriptions"
     else:
         description_string = "without category descriptions"
     logwriter.write_to_log(f"Specifications: Experiment Type: {experiment_type}, Descriptions: {description_string}, "
-                           f"GPT model: {GPT_MODEL}")
-    logwriter.write_to_log("-" * 50 + "\n")
+                           f"GPT model: {GPT_MODEL}, Max concurrency: {MAX_CONCURRENCY}")
+    if resume and checkpoint_path is None:
+        raise ValueError("Resuming a run requires a checkpoint path")
+    if experiment_type in (ExperimentType.CHOICE_SHUFFLING, ExperimentType.COMBINED):
+        if resume and SHUFFLE_SEED is None:
+            restore_shuffle_seed(checkpoint_path)
+        logwriter.write_to_log(f"Choice shuffling seed: {get_permutation_registry().seed}, "
+                               f"per-row orderings: {PER_ROW_SHUFFLING}")
 
-    result_dataset = pd.DataFrame(test_data)
+    result_columns = get_result_columns(experiment_type)
+    specification = get_run_specification(experiment_type, with_definition)
+    finished_records = {}
+    if resume:
+        finished_records = checkpoint.load_checkpoint(checkpoint_path, specification)
+        logwriter.write_to_log(f"Resuming from {checkpoint_path}: {len(finished_records)} rows already classified")
+    if checkpoint_path is None:
+        checkpoint_path = checkpoint.get_checkpoint_path(experiment_type, with_definition)
+    checkpoint_writer = checkpoint.CheckpointWriter(checkpoint_path, specification, resume=resume)
+    logwriter.write_to_log(f"Checkpoint: {checkpoint_path}")
+
+    is_dataframe = isinstance(test_data, pandas.DataFrame)
+    chunks = [test_data] if is_dataframe else test_data
+    if results_csv_name is None:
+        results_csv_name = data.get_results_csv_path(experiment_type, with_definition)
+    result_dataset = None
+    store_writer = None
+    if RESULT_STORE is not None:
+        # pyarrow is only needed for the result store
+        import resultstore
+        store_writer = resultstore.ResultStoreWriter(RESULT_STORE, experiment_type.value, GPT_MODEL,
+                                                     RESULT_STORE_RUN or resultstore.get_run_id(results_csv_name),
+                                                     resultstore.get_run_id(results_csv_name))
+        logwriter.write_to_log(f"Result store: {RESULT_STORE}, run {store_writer.run_id}")
+
+    global request_semaphore, run_metrics, run_deduplicator
+    request_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    run_metrics = metrics.MetricsRecorder()
+    run_deduplicator = dedup.Deduplicator(STRIP_VARIANT_TOKENS) if DEDUPLICATION else None
+    completion_backend = backend.get_backend()
+    completion_backend.begin_run()
+    loop = asyncio.get_running_loop()
+    failure = None
     try:
-        for i in test_data.index:
-            product_name = result_dataset.iloc[i]['Title']
-            logwriter.write_to_log(f"--- {product_name} ---")
-            result_dataset = classify_single_row(experiment_type, i, result_dataset, with_definition)
-            print(f"Round {i} done")
-        data.save_results_as_csv(result_dataset, experiment_type, with_definition)
+        # SIGTERM cancels the run like a KeyboardInterrupt, the results finished so far are saved
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except (NotImplementedError, RuntimeError):
+        # signal handlers are only available on Unix in the main thread
+        pass
+    try:
+        for chunk_number, chunk in enumerate(chunks):
+            results = data.ResultAccumulator(result_columns)
+            try:
+                await classify_chunk(experiment_type, chunk, results, finished_records, checkpoint_writer,
+                                     with_definition)
+            finally:
+                result_chunk = results.join(chunk)
+                with profiling.span("save"):
+                    if store_writer is not None:
+                        store_writer.append(result_chunk)
+                    else:
+                        data.save_results_as_csv(result_chunk, experiment_type, with_definition, results_csv_name,
+                                                 append=chunk_number > 0)
+                if is_dataframe:
+                    result_dataset = result_chunk
+    except asyncio.CancelledError:
+        logwriter.write_to_log(f"Classification cancelled, resume from {checkpoint_path}")
+        logwriter.close_log()
+        profiling.end_run()
+        raise
     except Exception as e:
-        logwriter.write_to_log(f"Exception caught: {e}")
-        data.save_results_as_csv(result_dataset, experiment_type, with_definition)
+        # the results, checkpoint and metrics finished so far are saved before the run fails
+        logwriter.write_to_log(f"Exception caught: {e}", "ERROR")
+        failure = e
+    finally:
+        checkpoint_writer.close()
+        try:
+            loop.remove_signal_handler(signal.SIGTERM)
+        except (NotImplementedError, RuntimeError):
+            pass
 
+    if isinstance(completion_backend, cache.CachingBackend):
+        logwriter.write_to_log(f"Cache statistics: {completion_backend.cache.stats()}")
+    if run_deduplicator is not None:
+        logwriter.write_to_log(f"Deduplication: {run_deduplicator.duplicates} rows copied from a representative")
+    for summary in run_metrics.to_report():
+        logwriter.write_to_log(f"Run summary: {summary}")
+    logwriter.write_to_log(f"Metrics: {run_metrics.save(results_csv_name, METRICS_PROMETHEUS)}")
+    if run_profiler is not None:
+        profiling.end_run()
+        for stage in run_profiler.stage_stats.to_report(run_profiler.wall_time):
+            logwriter.write_to_log("Profile stage", **stage)
+        logwriter.write_to_log(f"Profile: {run_profiler.save(results_csv_name)}")
     logwriter.close_log()
+    if failure is not None:
+        raise failure
     return result_dataset
 
 
-def extract_response_path(response_string: str) -> str | int:
+def classify(experiment_type: ExperimentType, test_data: pandas.DataFrame | Iterable[pandas.DataFrame],
+             with_definition: bool = False, checkpoint_path: str = None, resume: bool = False,
+             results_csv_name: str = None) -> pandas.DataFrame | None:
+    """
+    Performs the classification for the whole dataset by running classify_async() in a new event loop.
+    The output is saved into a csv file
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :param test_data: The DataFrame containing the test data, or an iterator over chunks of the test data
+    :param with_definition: Adds label definitions to the prompt if True, doesn't add label definitions if False
+    :param checkpoint_path: Path of the checkpoint file, default: a new file in the Checkpoints directory
+    :param resume: Loads the rows finished in checkpoint_path and only classifies the remaining rows if True
+    :param results_csv_name: Path of the results csv file, default: a new file in the Results directory
+    :returns: result_dataset: The DataFrame containing the classification results, None for an iterator over chunks
+    """
+    return asyncio.run(classify_async(experiment_type, test_data, with_definition, checkpoint_path, resume,
+                                      results_csv_name))
+
+
+def get_path_matcher(second_level_label: str = None) -> matcher.PathMatcher:
+    """
+    Returns the path matcher for the valid paths of the current taxonomy. It is compiled on first use
+
+    :param second_level_label: Only matches the paths below this second-level label if set
+    :return: The path matcher
+    """
+    return taxonomy.get_taxonomy().get_path_matcher(second_level_label)
+
+
+def normalize_response(response_string: str) -> str:
     """
-    Extracts the predicted category path from the response message given by GPT-3.5.
+    Removes whitespace around the separators of category paths in a response
 
     :param response_string: String value of the response message
-    :return: Extracted category path, or -1 if response_string doesn't contain any valid path
+    :return: The normalized response
     """
     parts = response_string.split('>')
     modified_parts = [part.strip() for part in parts]
-    response_string = ">".join(modified_parts)
+    return ">".join(modified_parts)
 
-    for label_2 in data.SECOND_LEVEL_LABELS:
-        for label_3 in data.THIRD_LEVEL_LABELS:
-            path = f"Computers & Electronics>{label_2}>{label_3}"
-            if path in response_string:
-                return path
-    return -1
+
+def extract_response_path(response_string: str, second_level_label: str = None) -> str | int:
+    """
+    Extracts the predicted category path from the response message given by GPT-3.5. Only paths of the taxonomy are
+    valid. If the response contains several paths, the last one is taken as the model's final answer.
+
+    :param response_string: String value of the response message
+    :param second_level_label: Only accepts paths below this second-level label if set, e.g. in the second stage
+    :return: Extracted category path, or -1 if response_string doesn't contain any valid path
+    """
+    with profiling.span("parse"):
+        path = get_path_matcher(second_level_label).find(normalize_response(response_string))
+    if path is None:
+        return -1
+    return path
+
+
+def extract_round_path(response_string: str) -> str | int:
+    """
+    Extracts the predicted category path from the response of a classification round. Structured responses of the
+    fast mode are decoded, other responses are searched for a path
+
+    :param response_string: String value of the response message
+    :return: Extracted category path, or -1 if response_string doesn't contain any valid path
+    """
+    if FAST_MODE:
+        with profiling.span("parse"):
+            return structured.extract_structured_path(response_string)
+    return extract_response_path(response_string)
+
+
+def extract_second_level_label(response_string: str) -> str | int:
+    """
+    Extracts the second-level category chosen in the first stage of the two-stage mode. If the response contains
+    several second-level paths, the last one is taken
+
+    :param response_string: String value of the response message
+    :return: The second-level label, or -1 if response_string doesn't contain any valid second-level path
+    """
+    with profiling.span("parse"):
+        path = taxonomy.get_taxonomy().get_second_level_matcher().find(normalize_response(response_string))
+    if path is None:
+        return -1
+    return path.split(taxonomy.PATH_SEPARATOR)[1]
 
 
 def set_n_self_consistency(n_self_consistency: int):
@@ -258,6 +1020,187 @@ def set_n_choice_shuffling(n_choice_shuffling: int):
     N_CHOICE_SHUFFLING = n_choice_shuffling
 
 
+def set_max_concurrency(max_concurrency: int):
+    """
+    Sets the maximum number of requests that are in flight at the same time
+
+    :param max_concurrency: maximum number of concurrent requests, 1 classifies strictly sequentially
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"Max concurrency must be at least 1, got {max_concurrency}")
+    global MAX_CONCURRENCY
+    MAX_CONCURRENCY = max_concurrency
+
+
+def set_max_samples_per_request(max_samples_per_request: int):
+    """
+    Sets the maximum number of samples (n) requested at once for rounds sharing the same prompt
+
+    :param max_samples_per_request: maximum number of samples per request, 1 sends a separate request per round
+    """
+    if max_samples_per_request < 1:
+        raise ValueError(f"Max samples per request must be at least 1, got {max_samples_per_request}")
+    global MAX_SAMPLES_PER_REQUEST
+    MAX_SAMPLES_PER_REQUEST = max_samples_per_request
+
+
+def set_temperature_buckets(temperature_buckets: int = None):
+    """
+    Sets the number of buckets the self-consistency temperature schedule is split into. Rounds whose temperatures
+    fall into the same bucket share a multi-sample request, e.g. 1 samples all self-consistency rounds at once
+
+    :param temperature_buckets: number of temperature buckets, None keeps the exact temperature of each round
+    """
+    if temperature_buckets is not None and temperature_buckets < 1:
+        raise ValueError(f"Temperature buckets must be at least 1, got {temperature_buckets}")
+    global TEMPERATURE_BUCKETS
+    TEMPERATURE_BUCKETS = temperature_buckets
+
+
+def set_adaptive_voting(adaptive_voting: bool = True, vote_confidence: float = None, vote_margin: int = None,
+                        min_votes: int = 1):
+    """
+    Enables or disables adaptive voting. With adaptive voting, a row stops as soon as the leading path can't be
+    overtaken by the remaining rounds. The optional thresholds stop a row earlier, but can change its result
+
+    :param adaptive_voting: Stops rows early if True, always performs all rounds if False
+    :param vote_confidence: Stops once the leading path has at least this share of the votes cast, None to disable
+    :param vote_margin: Stops once the leading path leads by at least this many votes, None to disable
+    :param min_votes: Minimum number of votes before vote_confidence and vote_margin are checked
+    """
+    global ADAPTIVE_VOTING, VOTE_CONFIDENCE, VOTE_MARGIN, MIN_VOTES
+    ADAPTIVE_VOTING = adaptive_voting
+    VOTE_CONFIDENCE = vote_confidence
+    VOTE_MARGIN = vote_margin
+    MIN_VOTES = min_votes
+
+
+def set_fast_mode(fast_mode: bool = True, max_tokens: int = structured.FAST_MAX_TOKENS):
+    """
+    Sets whether products are classified in the fast mode. The model answers without reasoning with a JSON object
+    whose fields are restricted to the label pools, so responses are short and are decoded instead of searched
+
+    :param fast_mode: Asks for structured answers if True, for reasoned answers if False
+    :param max_tokens: Maximum number of completion tokens per answer in the fast mode
+    """
+    global FAST_MODE, FAST_MAX_TOKENS
+    FAST_MODE = fast_mode
+    FAST_MAX_TOKENS = max_tokens
+
+
+def set_two_stage(two_stage: bool = True):
+    """
+    Sets whether products are classified in two stages, first into a second-level category and then into one of its
+    third-level categories, so that each prompt only offers the labels of one level of the taxonomy
+
+    :param two_stage: Classifies in two stages if True, with one prompt offering both levels if False
+    """
+    global TWO_STAGE
+    TWO_STAGE = two_stage
+
+
+def set_deduplication(deduplication: bool = True, strip_variant_tokens: bool = False):
+    """
+    Sets whether equivalent rows are classified once. Rows are equivalent if title and brand are equal after
+    canonicalization as specified in dedup.canonicalize()
+
+    :param deduplication: Classifies one representative per group of equivalent rows if True
+    :param strip_variant_tokens: Also treats variants like other colours or capacities as equivalent if True
+    """
+    global DEDUPLICATION, STRIP_VARIANT_TOKENS
+    DEDUPLICATION = deduplication
+    STRIP_VARIANT_TOKENS = strip_variant_tokens
+
+
+def set_taxonomy(category_taxonomy: taxonomy.Taxonomy):
+    """
+    Sets the taxonomy the products are classified into
+
+    :param category_taxonomy: The taxonomy, e.g. as returned by taxonomy.load_taxonomy()
+    """
+    taxonomy.set_taxonomy(category_taxonomy)
+
+
+def set_prefilter(prefilter_index: prefilter.NearestNeighbourIndex | None, threshold: float = 0.5):
+    """
+    Sets the local index classifying products before the LLM
+
+    :param prefilter_index: The index, None to classify all products with the LLM
+    :param threshold: Minimum confidence of the index for a product to skip the LLM
+    """
+    global PREFILTER_INDEX, PREFILTER_THRESHOLD
+    PREFILTER_INDEX = prefilter_index
+    PREFILTER_THRESHOLD = threshold
+
+
+def get_pack_size(experiment_type: ExperimentType) -> int:
+    """
+    Returns the number of products packed into one prompt
+
+    :param experiment_type: The experiment type as specified in util.ExperimentType
+    :return: The pack size, 1 if products aren't packed
+    """
+    return PACK_SIZES.get(experiment_type, 1)
+
+
+def set_pack_size(pack_size: int, experiment_type: ExperimentType = None):
+    """
+    Sets the number of products packed into one prompt. Packed prompts share the label block, so tokens and
+    requests drop by about the pack size
+
+    :param pack_size: Number of products per prompt, 1 to classify one product per prompt
+    :param experiment_type: The experiment type the pack size is set for, default: all experiment types
+    """
+    for packed_experiment_type in ([experiment_type] if experiment_type is not None else ExperimentType):
+        PACK_SIZES[packed_experiment_type] = pack_size
+
+
+def set_prometheus_metrics(prometheus_metrics: bool = True):
+    """
+    Sets whether the run metrics are also saved as Prometheus textfile next to the results
+
+    :param prometheus_metrics: Saves a .prom file in addition to the JSON report if True
+    """
+    global METRICS_PROMETHEUS
+    METRICS_PROMETHEUS = prometheus_metrics
+
+
+def set_choice_shuffling(seed: int = None, per_row: bool = False):
+    """
+    Sets how the label orderings of choice shuffling are derived. Runs with the same seed use the same orderings
+
+    :param seed: Seed of the orderings, None for a random seed
+    :param per_row: Derives separate orderings for every row if True, shares N_CHOICE_SHUFFLING orderings between
+    all rows if False
+    """
+    global SHUFFLE_SEED, PER_ROW_SHUFFLING, permutation_registry
+    SHUFFLE_SEED = seed
+    PER_ROW_SHUFFLING = per_row
+    permutation_registry = None
+
+
+def set_result_store(root: str = None, run_id: str = None):
+    """
+    Sets whether the results are appended to the partitioned result store instead of the results csv file. Metrics
+    and profiles are still saved next to the results csv path
+
+    :param root: Root directory of the store, None to save the results as csv file
+    :param run_id: Identifier of the run in the store, default: the name of the results csv file
+    """
+    global RESULT_STORE, RESULT_STORE_RUN
+    RESULT_STORE = root
+    RESULT_STORE_RUN = run_id
+
+
+def set_profiling(mode: str = None):
+    """
+    Sets how runs are profiled. The stage breakdown and the profiles are saved next to the results file
+
+    :param mode: One of profiling.PROFILING_MODES, None to disable profiling
+    """
+    profiling.set_profiling(mode)
+
+
 def set_gpt_model(gpt_model: str = "gpt-3.5-turbo"):
     """
     Sets the GPT model that should be used for the classification task
@@ -266,14 +1209,3 @@ def set_gpt_model(gpt_model: str = "gpt-3.5-turbo"):
     """
     global GPT_MODEL
     GPT_MODEL = gpt_model
-
-
-def init_choice_shuffling():
-    """
-    Initializes the arrays with permuted labels for choice shuffling
-    """
-    global second_level_shuffled_choices
-    global third_level_shuffled_choices
-    for i in range(N_CHOICE_SHUFFLING):
-        second_level_shuffled_choices.append(data.permute_labels(data.SECOND_LEVEL_LABELS))
-        third_level_shuffled_choices.append(data.permute_labels(data.THIRD_LEVEL_LABELS))
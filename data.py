@@ -1,225 +1,253 @@
+import functools
+from typing import Iterator
 import pandas as pd
 import random
 import os
+import taxonomy
 import util
 from util import ExperimentType
 
 # Dataset consisting of 50 test samples.
 # They are classified into one of 25 category paths, each category path having two samples.
-test_dataset = pd.read_csv('icecat_test_data.csv', index_col="Index")
-
-# Label lists and definition for each label as specified by Icecat
-SECOND_LEVEL_LABELS = ['Computers', 'Warranty & Support', 'Software', 'TVs & Monitors', 'Data Input Devices',
-                       'Computer Cables', 'Telecom & Navigation', 'Batteries & Power Supplies', 'Projectors',
-                       'Networking']
-
-THIRD_LEVEL_LABELS = ['Notebooks', 'Warranty & Support Extensions', 'Software Licenses/Upgrades', 'PCs/Workstations',
-                      'TVs', 'Keyboards', 'All-in-One PCs/Workstations', 'Computer Monitors', 'Networking Cables',
-                      'Antivirus Security Software', 'Mobile Phone Cases', 'Power Adapters & Inverters',
-                      'Flat Panel Spare Parts', 'Fibre Optic Cables', 'Smartphones', 'Tablets', 'Projection Screens',
-                      'Screen Protectors', 'Tablet Cases', 'Uninterruptible Power Supplies (UPSs)',
-                      'Cable Interface/Gender Adapters', 'Data Projectors', 'Network Switches', 'Mice', 'Power Cables']
-
-LABEL_DEFINITIONS = {
-    'Computers': "Electronic devices capable of receiving, processing, and storing data to perform various tasks. "
-                 "Computers encompass a wide range of devices, including desktops, laptops, tablets, and servers. "
-                 "They consist of hardware components such as processors, memory (RAM), storage, input/output "
-                 "devices, and often include software systems like operating systems and applications for user "
-                 "interaction and task execution. Computers are used for purposes such as personal productivity, "
-                 "entertainment, communication, and data processing across various domains.",
-    'Warranty & Support': "A warranty is a written guarantee, issued to the purchaser of an article by its "
-                          "manufacturer, promising to repair or replace it if necessary within a specified period of "
-                          "time. Support means help with set-up and use of a device, and if there are any problems "
-                          "with it.",
-    'Software': "Instructions for a computer's processor to perform specific operations e.g. system software such as "
-                "Windows and iOS, application software such as internet browsers and apps.",
-    'TVs & Monitors': "Television sets and computer displays used for visual entertainment or as output devices for "
-                      "computers. TVs receive and display broadcast signals, while monitors are specifically designed "
-                      "for computer output.",
-    'Data Input Devices': "Devices that feed data into a computer e.g. keyboard, joystick",
-    'Computer Cables': "Cables used to connect computers to power supplies and other devices such as printers.",
-    'Telecom & Navigation': "Portable computer devices and phones, and their accessories such as cables and stands.",
-    'Batteries & Power Supplies': "Battery units and devices used to power electronic equipment, providing portable "
-                                  "energy sources for various devices. Power supplies include units that convert "
-                                  "electrical power from one form to another to ensure proper operation of electronic "
-                                  "devices.",
-    'Projectors': "Device that is used to project rays of light, especially an apparatus with a system of lenses for "
-                  "projecting slides or film on to a screen.",
-    'Networking': "A telecommunications network which allows computers and other electronic devices to exchange data. "
-                  "Common examples are local area networks (LANs) and virtual private networks (VPNs).",
-    'Notebooks': "Portable computing devices, designed for mobility and convenience. Notebooks integrate components "
-                 "such as a display screen, keyboard, processor, memory, and storage into a single compact unit.",
-    'Warranty & Support Extensions': "Extending the warranty & support beyond that offered by the "
-                                     "manufacturer/retailer, so that the purchase is covered for a longer period of "
-                                     "time.",
-    'Software Licenses/Upgrades': "A software licence permits you to use a piece of software legally. An software "
-                                  "upgrade is a newer or better version, in order to bring the software up to date or "
-                                  "to improve its characteristics.",
-    'PCs/Workstations': "Personal Computers, PCs for short, are computers for personal usage. They always have the "
-                        "following components: a processor (CPU), memory (RAM), motherboard, video board, "
-                        "a hard disk, and an optional DVD/CD player/recorder.",
-    'TVs': "Television sets designed for receiving and displaying broadcasted visual content, including programs, "
-           "movies, and video games. TVs come in various sizes, display technologies, and feature sets (such as smart "
-           "capabilities, resolution, and refresh rate).",
-    'Keyboards': "The keyboard is the main input peripheral used by all computers. The keyboard allows for user input "
-                 "and interaction with the computer.",
-    'All-in-One PCs/Workstations': "Desktop PC with monitor.",
-    'Computer Monitors': "TFT/LCD displays are perfectly flat, a lot thinner and lighter than conventional CRT "
-                         "displays and do not flicker, all this because of the new technology they use for producing "
-                         "images. Do you want to free up space on your desk, or do you want to be able to move your "
-                         "monitor without breaking your back? Then this is the perfect display for you!",
-    'Networking Cables': "Any type of network has its own type of cables. Today's standard for home and office use is "
-                         "Ethernet. For Fast Ethernet and Gigabit Ethernet you need at least category 5 cabling. "
-                         "Ethernet cables can have their connectors attached in two different ways: ordinary or cross "
-                         "linked. You will most likely need the ordinary version, unless you want to connect two "
-                         "devices directly to each other, and even then most modern Ethernet network devices will "
-                         "automatically detect the type of cable you are using and adapt their settings to it, "
-                         "so they will work with both types.",
-    'Antivirus Security Software': "Computer programs that protect computer systems, files and software from computer "
-                                   "viruses, etc.",
-    'Mobile Phone Cases': "Telecom & Navigation>Mobile Phone Cases: Protective cases for mobile phones such as "
-                          "smartphones.",
-    'Power Adapters & Inverters': "A power adapter connects a device into the mains electricity through a plug. They "
-                                  "are used with  electrical devices that require power but do not contain internal "
-                                  "components to derive the required voltage and power from mains power. A power "
-                                  "inverter, or inverter, is an electronic device or circuitry that changes direct "
-                                  "current (DC) to alternating current (AC).",
-    'Flat Panel Spare Parts': "Replacement components and spare parts for flat-panel TVs and monitors, including "
-                              "items such as screens, circuit boards, and connectors.",
-    'Fibre Optic Cables': "A thin glass fibre through which light can be transmitted.",
-    'Smartphones': "Mobile phone that is able to perform many of the functions of a computer, typically having a "
-                   "relatively large screen and an operating system capable of running general-purpose applications.",
-    'Tablets': "Mobile computer with display, circuitry and battery in a single unit. Tablets are equipped with "
-               "sensors, including cameras, microphone, accelerometer and touchscreen, with finger or stylus gestures "
-               "replacing computer mouse and keyboard.",
-    'Projection Screens': "Installation consisting of a surface and a support structure used for displaying a "
-                          "projected image for the view of an audience.",
-    'Screen Protectors': "Plastic covers used to protect smartphone screen from scratching etc.",
-    'Tablet Cases': "Protective cases for tablets such as the iPad.",
-    'Uninterruptible Power Supplies (UPSs)': "Once you have a UPS (Uninterruptible Power Supply), there is no need to "
-                                             "fear for data loss due to power outages. If the duration of the outage "
-                                             "is short, you can work on without being disturbed, and if it takes "
-                                             "longer, you will have more than enough time to save your work and "
-                                             "safely turn off your computer.",
-    'Cable Interface/Gender Adapters': "Adapters used to convert between different cable interfaces or genders, "
-                                       "facilitating connections between devices with incompatible connectors. These "
-                                       "adapters ensure compatibility and proper signal transmission in networking, "
-                                       "audiovisual, and other setups.",
-    'Data Projectors': "Use a beamer to project the images from your notebook, computer, DVD-player, video recorder "
-                       "or other device with a compatible connector on the wall or a specially-designed projection "
-                       "screen. With a device like this, giving professional, clear presentations is easy. Or make "
-                       "your own home cinema!",
-    'Network Switches': "A switch is a device with which it is possible to connect computers into a (local area) "
-                        "network, provided your computers all have an appropriate networking device installed. "
-                        "Switches can be daisy chained to form larger networks and come in managed and unmanaged "
-                        "variaties. The unmanaged versions generally cannot filter data and will forward any data "
-                        "that is fed into them, so they are better suited for small networks. Switches are easy to "
-                        "set up (just plug in the network cables) and allow you to share printers, storage space and "
-                        "other network resources with your entire home or office network.",
-    'Mice': "The mouse is the second most important way of communicating with a computer.",
-    'Power Cables': "A power cable, also known as a power cord, is used for the transmission of electrical power."
-}
+# The dataset is loaded on first access of data.test_dataset
+TEST_DATASET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icecat_test_data.csv')
+
+# Name of the column holding the row index in catalog and result files
+INDEX_COLUMN = "Index"
+
+# Default number of products per chunk when streaming a catalog file
+CHUNK_SIZE = 1000
+
+
+@functools.cache
+def load_test_dataset() -> pd.DataFrame:
+    """
+    Loads the built-in test dataset. The dataset is only read once
+
+    :return: The test dataset
+    """
+    return pd.read_csv(TEST_DATASET_PATH, index_col=INDEX_COLUMN)
+
+
+def __getattr__(name: str):
+    # keeps data.test_dataset available without reading the csv file on import
+    if name == "test_dataset":
+        return load_test_dataset()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def iter_products(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Lazily reads a product catalog in chunks of bounded size, so that catalogs of any size can be classified with
+    flat memory. Supported formats are csv, JSON Lines (.jsonl, .ndjson) and Parquet. The catalog needs the columns
+    Title and Brand. If it has an Index column, it is used as row index, otherwise the rows are numbered
+    consecutively.
+
+    :param path: Path of the catalog file
+    :param chunk_size: Maximum number of products per chunk
+    :return: Iterator over the chunks of the catalog
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        chunks = pd.read_csv(path, chunksize=chunk_size)
+    elif extension in (".jsonl", ".ndjson"):
+        chunks = pd.read_json(path, lines=True, chunksize=chunk_size)
+    elif extension == ".parquet":
+        import pyarrow.parquet
+        chunks = (batch.to_pandas() for batch in
+                  pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size))
+    else:
+        raise ValueError(f"Unsupported catalog format {extension}")
+
+    offset = 0
+    for chunk in chunks:
+        if INDEX_COLUMN in chunk.columns:
+            chunk = chunk.set_index(INDEX_COLUMN)
+        else:
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        yield chunk
+
+
+# Description of the general setting, shared by the system prompts
+SETTING_PROMPT = ("You are tasked with classifying products within a hierarchical category structure consisting of "
+                  "three levels. All products fall under the overarching first-level category 'Computers & "
+                  "Electronics.' Your role is to utilize your expertise to categorize the products effectively into "
+                  "their second and third level categories, considering their intended use and notable features. "
+                  "The classification involves predicting the second-level and third-level categories from "
+                  "two provided category pools. ")
 
 # System Prompt explaining the general setting. This prompt will be performed before each classification
-SYSTEM_PROMPT = ("You are tasked with classifying products within a hierarchical category structure consisting of "
-                 "three levels. All products fall under the overarching first-level category 'Computers & "
-                 "Electronics.' Your role is to utilize your expertise to categorize the products effectively into "
-                 "their second and third level categories, considering their intended use and notable features. "
-                 "The classification involves predicting the second-level and third-level categories from "
-                 "two provided category pools. "
+SYSTEM_PROMPT = (SETTING_PROMPT +
                  "Please explain your reasoning behind your decision and provide your answer for the hierarchical "
                  "path in the format \"Computers & Electronics>[Second-level Category]>[Third-level Category]\" by "
                  "filling the [Second-level Category] with a category from the second-level pool and the [Third-level "
                  "Category] with a category from the third-level pool.")
 
-# User Prompt Templates to be filled with product and label input
-USER_PROMPT_TEMPLATE_1 = ("The product to be classified is \"{title}\" of the brand {brand}.\n"
-                          "Please classify the specified product into the described product hierarchy. "
+# System Prompt of the fast mode, which asks for the answer only, as a structured JSON object instead of a reasoned
+# path
+FAST_SYSTEM_PROMPT = SETTING_PROMPT + "Answer only with the requested JSON object, without any explanation."
+
+# User Prompt Templates to be filled with label and product input. The label templates only depend on the label
+# order and form a static prefix of the user prompt, the product template is appended last, so that consecutive
+# requests share a byte-identical prompt prefix
+USER_PROMPT_TEMPLATE_1 = ("Please classify the product specified at the end of this message into the described "
+                          "product hierarchy. "
                           "Fill the [Second-level Category] with a category of this second-level pool: "
-                          "{label_2_1}, {label_2_2}, {label_2_3}, {label_2_4}, {label_2_5}, "
-                          "{label_2_6}, {label_2_7}, {label_2_8}, {label_2_9}, {label_2_10}.\n")
+                          "{second_level_pool}.\n")
 
 USER_PROMPT_TEMPLATE_2 = ("Use the following definitions for the second-level categories:\n"
-                          "- {label_2_1}: {definition_2_1}\n"
-                          "- {label_2_2}: {definition_2_2}\n"
-                          "- {label_2_3}: {definition_2_3}\n"
-                          "- {label_2_4}: {definition_2_4}\n"
-                          "- {label_2_5}: {definition_2_5}\n"
-                          "- {label_2_6}: {definition_2_6}\n"
-                          "- {label_2_7}: {definition_2_7}\n"
-                          "- {label_2_8}: {definition_2_8}\n"
-                          "- {label_2_9}: {definition_2_9}\n"
-                          "- {label_2_10}: {definition_2_10}\n")
+                          "{second_level_definitions}")
 
 USER_PROMPT_TEMPLATE_3 = ("Fill the [Third-level Category] with a category from this third-level pool: "
-                          "{label_3_1}, {label_3_2}, {label_3_3}, {label_3_4}, {label_3_5}, {label_3_6}, "
-                          "{label_3_7}, {label_3_8}, {label_3_9}, {label_3_10}, {label_3_11}, {label_3_12}, "
-                          "{label_3_13}, {label_3_14}, {label_3_15}, {label_3_16}, {label_3_17}, {label_3_18}, "
-                          "{label_3_19}, {label_3_20}, {label_3_21}, {label_3_22}, {label_3_23}, {label_3_24}, "
-                          "{label_3_25}. It is highly important that you only use categories from the third-level pool "
-                          "to fill the [Third-level Category] placeholder.\n")
+                          "{third_level_pool}. It is highly important that you only use categories from the "
+                          "third-level pool to fill the [Third-level Category] placeholder.\n")
 
 USER_PROMPT_TEMPLATE_4 = ("Use the following definitions for the third-level categories:\n"
-                          "- {label_3_1}: {definition_3_1}\n"
-                          "- {label_3_2}: {definition_3_2}\n"
-                          "- {label_3_3}: {definition_3_3}\n"
-                          "- {label_3_4}: {definition_3_4}\n"
-                          "- {label_3_5}: {definition_3_5}\n"
-                          "- {label_3_6}: {definition_3_6}\n"
-                          "- {label_3_7}: {definition_3_7}\n"
-                          "- {label_3_8}: {definition_3_8}\n"
-                          "- {label_3_9}: {definition_3_9}\n"
-                          "- {label_3_10}: {definition_3_10}\n"
-                          "- {label_3_11}: {definition_3_11}\n"
-                          "- {label_3_12}: {definition_3_12}\n"
-                          "- {label_3_13}: {definition_3_13}\n"
-                          "- {label_3_14}: {definition_3_14}\n"
-                          "- {label_3_15}: {definition_3_15}\n"
-                          "- {label_3_16}: {definition_3_16}\n"
-                          "- {label_3_17}: {definition_3_17}\n"
-                          "- {label_3_18}: {definition_3_18}\n"
-                          "- {label_3_19}: {definition_3_19}\n"
-                          "- {label_3_20}: {definition_3_20}\n"
-                          "- {label_3_21}: {definition_3_21}\n"
-                          "- {label_3_22}: {definition_3_22}\n"
-                          "- {label_3_23}: {definition_3_23}\n"
-                          "- {label_3_24}: {definition_3_24}\n"
-                          "- {label_3_25}: {definition_3_25}\n")
+                          "{third_level_definitions}")
 
 USER_PROMPT_TEMPLATE_5 = ("It is crucial that the answer path exactly matches the three-level hierarchy format "
                           "\"Computers & Electronics>[Second-level Category]>[Third-level Category]\"."
                           "Only answers with the correct number of levels and the correct path format can be accepted."
                           "The format needs to follow the example \"Computers & Electronics>Data Input "
-                          "Devices>Keyboards\"")
+                          "Devices>Keyboards\"\n")
+
+# Replaces USER_PROMPT_TEMPLATE_5 in the fast mode
+USER_PROMPT_FAST_FORMAT_TEMPLATE = ("Answer with a JSON object whose category holds the second_level_category and "
+                                    "the third_level_category of the product.\n")
+
+USER_PROMPT_PRODUCT_TEMPLATE = "The product to be classified is \"{title}\" of the brand {brand}."
+
+DEFINITION_TEMPLATE = "- {label}: {definition}\n"
+
+# User Prompt Templates of the two-stage mode. The first stage only chooses the second-level category, the second
+# stage chooses among the children of the chosen category, so prompts stay small for large taxonomies
+USER_PROMPT_STAGE_1_TEMPLATE = ("Please classify the product specified at the end of this message into its "
+                                "second-level category. Choose a category of this second-level pool: "
+                                "{second_level_pool}.\n")
+
+USER_PROMPT_STAGE_1_FORMAT_TEMPLATE = ("It is crucial that the answer ends with the path in the format "
+                                       "\"{root}>[Second-level Category]\". The format needs to follow the example "
+                                       "\"{root}>{example}\"\n")
+
+USER_PROMPT_STAGE_2_TEMPLATE = ("Please classify the product specified at the end of this message into the described "
+                                "product hierarchy. The product belongs to the second-level category "
+                                "{second_level_label}, so fill the [Second-level Category] with {second_level_label}. "
+                                "Fill the [Third-level Category] with a category from this third-level pool: "
+                                "{third_level_pool}. It is highly important that you only use categories from the "
+                                "third-level pool to fill the [Third-level Category] placeholder.\n")
+
+# Number of label orders whose compiled prompts are kept in memory
+PROMPT_CACHE_SIZE = 1024
+
+
+def format_definitions(labels: tuple[str, ...], label_taxonomy: taxonomy.Taxonomy) -> str:
+    """
+    Lists the definitions of labels
+
+    :param labels: The labels
+    :param label_taxonomy: The taxonomy defining the labels
+    :return: One definition per line
+    """
+    return "".join(DEFINITION_TEMPLATE.format(label=label, definition=label_taxonomy.definitions[label])
+                   for label in labels)
+
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def compile_label_prompt(second_level_labels: tuple[str, ...], third_level_labels: tuple[str, ...],
+                         with_definition: bool = False, label_taxonomy: taxonomy.Taxonomy = None,
+                         fast: bool = False) -> str:
+    """
+    Renders the static part of the user prompt, i.e. the label pools and optionally their definitions, for one
+    label order. The result is cached, so each label order is only rendered once.
+
+    :param second_level_labels: Tuple of second-level categories, either in original or in permuted order
+    :param third_level_labels: Tuple of third-level categories, either in original or in permuted order
+    :param with_definition: Adds label definitions if True, doesn't add label definitions if False
+    :param label_taxonomy: The taxonomy defining the labels, default: the current taxonomy
+    :param fast: Asks for a structured answer instead of a path if True
+    :return: The label part of the user prompt
+    """
+    label_taxonomy = label_taxonomy or taxonomy.get_taxonomy()
+    label_prompt = USER_PROMPT_TEMPLATE_1.format(second_level_pool=", ".join(second_level_labels))
+    if with_definition:
+        label_prompt += USER_PROMPT_TEMPLATE_2.format(
+            second_level_definitions=format_definitions(second_level_labels, label_taxonomy))
+    label_prompt += USER_PROMPT_TEMPLATE_3.format(third_level_pool=", ".join(third_level_labels))
+    if with_definition:
+        label_prompt += USER_PROMPT_TEMPLATE_4.format(
+            third_level_definitions=format_definitions(third_level_labels, label_taxonomy))
+    return label_prompt + (USER_PROMPT_FAST_FORMAT_TEMPLATE if fast else USER_PROMPT_TEMPLATE_5)
+
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def compile_stage_prompt(second_level_labels: tuple[str, ...], second_level_label: str = None,
+                         third_level_labels: tuple[str, ...] = None, with_definition: bool = False,
+                         label_taxonomy: taxonomy.Taxonomy = None) -> str:
+    """
+    Renders the static part of a two-stage user prompt. The first stage offers the second-level pool, the second
+    stage the third-level pool below the chosen second-level category. The result is cached like
+    compile_label_prompt().
+
+    :param second_level_labels: Tuple of second-level categories for the first stage, empty for the second stage
+    :param second_level_label: The second-level category chosen in the first stage, None for the first stage
+    :param third_level_labels: Tuple of the category's third-level categories for the second stage
+    :param with_definition: Adds label definitions if True, doesn't add label definitions if False
+    :param label_taxonomy: The taxonomy defining the labels, default: the current taxonomy
+    :return: The label part of the user prompt
+    """
+    label_taxonomy = label_taxonomy or taxonomy.get_taxonomy()
+    if second_level_label is None:
+        label_prompt = USER_PROMPT_STAGE_1_TEMPLATE.format(second_level_pool=", ".join(second_level_labels))
+        if with_definition:
+            label_prompt += USER_PROMPT_TEMPLATE_2.format(
+                second_level_definitions=format_definitions(second_level_labels, label_taxonomy))
+        return label_prompt + USER_PROMPT_STAGE_1_FORMAT_TEMPLATE.format(root=label_taxonomy.root.name,
+                                                                         example=second_level_labels[0])
+    label_prompt = USER_PROMPT_STAGE_2_TEMPLATE.format(second_level_label=second_level_label,
+                                                       third_level_pool=", ".join(third_level_labels))
+    if with_definition:
+        label_prompt += USER_PROMPT_TEMPLATE_4.format(
+            third_level_definitions=format_definitions(third_level_labels, label_taxonomy))
+    return label_prompt + USER_PROMPT_TEMPLATE_5
 
 
 def format_user_prompt(title: str, brand: str, second_level_labels: list[str], third_level_labels: list[str],
-                       with_definition: bool = False) -> str:
+                       with_definition: bool = False, fast: bool = False) -> str:
     """
-    Assembles the user prompt templates and fills it with the given specifications.
+    Assembles the user prompt from the compiled label prompt and the product specification.
 
     :param title: Title of the product
     :param brand: Brand of the product
     :param second_level_labels: List of second-level categories, either in original or in permuted order
     :param third_level_labels: List of third-level categories, either in original or in permuted order
     :param with_definition: Adds label definitions if True, doesn't add label definitions if False
+    :param fast: Asks for a structured answer instead of a path if True
     :return: Formatted string for the user prompt
     """
-    labels = {f"label_2_{i}": second_level_labels[i - 1] for i in range(1, 11)}
-    labels.update({f"label_3_{i}": third_level_labels[i - 1] for i in range(1, 26)})
+    return (compile_label_prompt(tuple(second_level_labels), tuple(third_level_labels), with_definition,
+                                 taxonomy.get_taxonomy(), fast) +
+            USER_PROMPT_PRODUCT_TEMPLATE.format(title=title, brand=brand))
 
-    definitions = {f"definition_2_{i}": LABEL_DEFINITIONS[labels[f"label_2_{i}"]] for i in range(1, 11)}
-    definitions.update({f"definition_3_{i}": LABEL_DEFINITIONS[labels[f"label_3_{i}"]] for i in range(1, 26)})
 
-    if with_definition:
-        user_prompt_template = (USER_PROMPT_TEMPLATE_1 + USER_PROMPT_TEMPLATE_2 + USER_PROMPT_TEMPLATE_3 +
-                                USER_PROMPT_TEMPLATE_4 + USER_PROMPT_TEMPLATE_5)
-        formatted_string = user_prompt_template.format(title=title, brand=brand, **labels, **definitions)
-    else:
-        user_prompt_template = USER_PROMPT_TEMPLATE_1 + USER_PROMPT_TEMPLATE_3 + USER_PROMPT_TEMPLATE_5
+def format_stage_prompt(title: str, brand: str, second_level_labels: list[str], second_level_label: str = None,
+                        third_level_labels: list[str] = None, with_definition: bool = False) -> str:
+    """
+    Assembles a two-stage user prompt from the compiled stage prompt and the product specification.
 
-        formatted_string = user_prompt_template.format(title=title, brand=brand, **labels)
-    return formatted_string
+    :param title: Title of the product
+    :param brand: Brand of the product
+    :param second_level_labels: List of second-level categories, either in original or in permuted order
+    :param second_level_label: The second-level category chosen in the first stage, None for the first stage
+    :param third_level_labels: List of the category's third-level categories for the second stage
+    :param with_definition: Adds label definitions if True, doesn't add label definitions if False
+    :return: Formatted string for the user prompt
+    """
+    # the second stage doesn't depend on the order of the second-level pool, so all orders share a compiled prompt
+    stage_labels = tuple(second_level_labels) if second_level_label is None else ()
+    return (compile_stage_prompt(stage_labels, second_level_label, tuple(third_level_labels or ()), with_definition,
+                                 taxonomy.get_taxonomy()) +
+            USER_PROMPT_PRODUCT_TEMPLATE.format(title=title, brand=brand))
 
 
 def permute_labels(labels: list[str]) -> list[str]:
@@ -234,19 +262,83 @@ def permute_labels(labels: list[str]) -> list[str]:
     return permuted_labels
 
 
-def save_results_as_csv(df: pd.DataFrame, experiment_type: ExperimentType, with_description: bool):
+class ResultAccumulator:
+    """
+    Collects the results of classified rows as compact records with a fixed column order. The records are turned
+    into a DataFrame in one step instead of writing single cells into the result dataset.
     """
-    Saves the given DataFrame as csv into the Results directory
 
-    :param df: The DataFrame to be saved as csv, should be the result of a classification experiment
+    def __init__(self, columns: list[str]):
+        """
+        :param columns: The result columns, in output order
+        """
+        self.columns = columns
+        self.indices = []
+        self.records = []
+
+    def add(self, row_index, record: dict[str, object]):
+        """
+        Adds the results of a row
+
+        :param row_index: The index of the row in the test data
+        :param record: The results of the row keyed by column. Missing columns are left empty
+        """
+        self.indices.append(row_index)
+        self.records.append(tuple(record.get(column) for column in self.columns))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Builds a DataFrame of the collected results
+
+        :return: DataFrame with one row per added record, indexed by row index
+        """
+        return pd.DataFrame(self.records, index=pd.Index(self.indices), columns=self.columns)
+
+    def join(self, test_data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Appends the result columns to the test data. Rows without results are left empty
+
+        :param test_data: The DataFrame containing the test data
+        :return: The test data with the result columns, in the original row order
+        """
+        return pd.concat([test_data, self.to_dataframe().reindex(test_data.index)], axis=1)
+
+
+def get_results_csv_path(experiment_type: ExperimentType, with_description: bool) -> str:
+    """
+    Creates the path of a new results csv file in the Results directory
+
     :param experiment_type: The experiment type
     :param with_description: States whether the experiment has been conducted with or without label definitions
+    :return: Path of the csv file
     """
-    if not os.path.exists("./Results"):
-        os.makedirs("./Results")
     results_csv_name = "Results/results_" + experiment_type.value + "_"
     if with_description:
         results_csv_name = results_csv_name + "with_descriptions_"
-    results_csv_name = results_csv_name + util.get_current_datetime() + ".csv"
+    return results_csv_name + util.get_current_datetime() + ".csv"
+
 
-    df.to_csv(results_csv_name, index_label="Index")
+def save_results_as_csv(df: pd.DataFrame, experiment_type: ExperimentType, with_description: bool,
+                        results_csv_name: str = None, append: bool = False):
+    """
+    Saves the given DataFrame as csv into the Results directory
+
+    :param df: The DataFrame to be saved as csv, should be the result of a classification experiment
+    :param experiment_type: The experiment type
+    :param with_description: States whether the experiment has been conducted with or without label definitions
+    :param results_csv_name: Path of the csv file, default: a new file named after the experiment and current time
+    :param append: Appends the rows to an existing file if True, e.g. for results that are saved chunk by chunk
+    """
+    if results_csv_name is None:
+        results_csv_name = get_results_csv_path(experiment_type, with_description)
+    directory = os.path.dirname(results_csv_name)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    if append and os.path.exists(results_csv_name):
+        df.to_csv(results_csv_name, mode="a", header=False, index_label=INDEX_COLUMN)
+    else:
+        df.to_csv(results_csv_name, index_label=INDEX_COLUMN)
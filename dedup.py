@@ -0,0 +1,111 @@
+import re
+import unicodedata
+from collections import OrderedDict
+
+# Tokens that distinguish variants of the same product without changing its category, e.g. colours, capacities and
+# pack sizes. Only stripped if variant stripping is enabled
+VARIANT_PATTERN = re.compile(
+    r"\b(?:black|white|silver|grey|gray|red|blue|green|yellow|orange|purple|pink|gold|brown|beige|transparent"
+    r"|\d+(?:[.,]\d+)?\s*(?:kb|mb|gb|tb|mah|w|mm|cm|inch|\")"
+    r"|\d+\s*(?:pcs|pc|pack|pieces)|(?:pack|set) of \d+)(?=\W|$)",
+    re.IGNORECASE)
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]|_")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# Maximum number of classified groups remembered for rows of later chunks
+MAX_REMEMBERED_GROUPS = 100000
+
+
+def canonicalize(text: str, strip_variants: bool = False) -> str:
+    """
+    Canonicalizes a title or brand, so that spellings of the same product compare equal
+
+    :param text: The title or brand
+    :param strip_variants: Removes variant tokens as specified in VARIANT_PATTERN if True
+    :return: The text in lower case, without punctuation and with single spaces
+    """
+    if not isinstance(text, str):
+        return ""
+    text = unicodedata.normalize("NFKC", text).lower()
+    if strip_variants:
+        text = VARIANT_PATTERN.sub(" ", text)
+    text = PUNCTUATION_PATTERN.sub(" ", text)
+    return WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+def get_product_key(title: str, brand: str, strip_variants: bool = False) -> tuple[str, str]:
+    """
+    Creates the key rows are grouped by. Rows with the same key are classified once
+
+    :param title: The product title
+    :param brand: The product brand
+    :param strip_variants: Removes variant tokens from the title if True
+    :return: The canonical brand and title
+    """
+    return canonicalize(brand), canonicalize(title, strip_variants)
+
+
+class Deduplicator:
+    """
+    Groups equivalent rows of a run, so that only one representative per group is classified and its results are
+    copied to the other members. Groups span chunks: the records of classified groups are remembered, so duplicates
+    in later chunks are finished without being classified.
+    """
+
+    def __init__(self, strip_variants: bool = False, max_remembered_groups: int = MAX_REMEMBERED_GROUPS):
+        """
+        :param strip_variants: Groups variants like other colours or capacities of a product if True
+        :param max_remembered_groups: Maximum number of classified groups remembered for later chunks, the least
+        recently used groups are forgotten first
+        """
+        self.strip_variants = strip_variants
+        self.max_remembered_groups = max_remembered_groups
+        self.keys = {}
+        self.members = {}
+        self.remembered = OrderedDict()
+        self.duplicates = 0
+
+    def split(self, rows: list[tuple[object, str, str]]) \
+            -> tuple[list[tuple[object, str, str]], list[tuple[object, object, dict[str, object]]]]:
+        """
+        Splits rows into representatives and duplicates. Duplicates of a group classified in an earlier chunk are
+        returned with its record, the other duplicates are assigned to the representative of their group and
+        returned by finish()
+
+        :param rows: Index, product title and product brand of each row
+        :return: The representatives to be classified, and index, representative index and record of each duplicate
+        of a classified group
+        """
+        representatives = []
+        known_duplicates = []
+        chunk_representatives = {}
+        for i, product_name, product_brand in rows:
+            key = get_product_key(product_name, product_brand, self.strip_variants)
+            if key in self.remembered:
+                self.remembered.move_to_end(key)
+                representative, record = self.remembered[key]
+                known_duplicates.append((i, representative, record))
+            elif key in chunk_representatives:
+                self.members[chunk_representatives[key]].append(i)
+            else:
+                chunk_representatives[key] = i
+                self.keys[i] = key
+                self.members[i] = []
+                representatives.append((i, product_name, product_brand))
+        self.duplicates += len(rows) - len(representatives)
+        return representatives, known_duplicates
+
+    def finish(self, row_index, record: dict[str, object]) -> list:
+        """
+        Remembers the record of a classified representative
+
+        :param row_index: The index of the representative
+        :param record: The results of the representative
+        :return: The indices of the duplicates waiting for the record
+        """
+        key = self.keys.pop(row_index, None)
+        if key is None:
+            return []
+        self.remembered[key] = (row_index, dict(record))
+        if len(self.remembered) > self.max_remembered_groups:
+            self.remembered.popitem(last=False)
+        return self.members.pop(row_index)
@@ -1,7 +1,61 @@
+import glob
+import os
+from dataclasses import dataclass
+
+import numpy as np
 import pandas
-from sklearn.metrics import f1_score
-from statsmodels.stats.contingency_tables import mcnemar
-from sklearn.metrics import cohen_kappa_score
+import scipy.sparse
+from scipy.stats import binom, chi2
+
+import data
+
+# Levels of a category path, evaluated separately. The paths level compares full paths
+LEVELS = ['Paths', 'Second-Level', 'Third-Level']
+
+# Number of bootstrap resamples drawn at once, bounds the memory of the bootstrap
+BOOTSTRAP_BATCH_SIZE = 100
+
+
+def encode_paths(paths: list[pandas.Series | np.ndarray]) \
+        -> tuple[dict[str, list[np.ndarray]], dict[str, np.ndarray]]:
+    """
+    Encodes category paths into integer codes per level. The paths are split only once per distinct path, and all
+    given arrays share the same codes, so they can be compared with array operations.
+
+    :param paths: Arrays of category paths, e.g. the correct paths and the predicted paths of several runs
+    :return: The codes of each array per level, and the labels of the codes per level
+    """
+    lengths = [len(path_array) for path_array in paths]
+    codes, uniques = pandas.factorize(np.concatenate([np.asarray(path_array, dtype=object) for path_array in paths]))
+    parts = [path.split('>') for path in uniques]
+    if any(len(path_parts) < 3 for path_parts in parts):
+        raise Exception(f"Incorrect path format: {[path for path in uniques if len(path.split('>')) < 3]}")
+    level_uniques = {'Paths': np.asarray(uniques, dtype=object),
+                     'Second-Level': np.array([path_parts[1] for path_parts in parts], dtype=object),
+                     'Third-Level': np.array([path_parts[2] for path_parts in parts], dtype=object)}
+    encoded = {}
+    labels = {}
+    for level in LEVELS:
+        unique_codes, labels[level] = pandas.factorize(level_uniques[level])
+        encoded[level] = np.split(unique_codes[codes], np.cumsum(lengths)[:-1])
+    return encoded, labels
+
+
+def f1_scores_from_codes(y_true: np.ndarray, y_pred: np.ndarray, n_classes: int) -> tuple[float, float]:
+    """
+    Calculates micro and macro f1 scores of integer-coded labels. The macro f1 score averages over all labels that
+    occur in y_true or y_pred, like sklearn.
+
+    :param y_true: the correct label codes
+    :param y_pred: the predicted label codes
+    :param n_classes: number of label codes
+    :return: micro f1 score and macro f1 score
+    """
+    true_positives = np.bincount(y_true[y_true == y_pred], minlength=n_classes)
+    support = np.bincount(y_true, minlength=n_classes) + np.bincount(y_pred, minlength=n_classes)
+    present = support > 0
+    return (float(true_positives.sum() / len(y_true)),
+            float(np.mean(2 * true_positives[present] / support[present])))
 
 
 def micro_f1_score(y_true: pandas.Series, y_pred: pandas.Series) -> float:
@@ -12,7 +66,9 @@ def micro_f1_score(y_true: pandas.Series, y_pred: pandas.Series) -> float:
     :param y_pred: the predicted labels
     :return: micro f1 score
     """
-    return f1_score(y_true, y_pred, average='micro')
+    codes, uniques = pandas.factorize(np.concatenate([np.asarray(y_true, dtype=object),
+                                                      np.asarray(y_pred, dtype=object)]))
+    return f1_scores_from_codes(codes[:len(y_true)], codes[len(y_true):], len(uniques))[0]
 
 
 def macro_f1_score(y_true: pandas.Series, y_pred: pandas.Series) -> float:
@@ -23,7 +79,9 @@ def macro_f1_score(y_true: pandas.Series, y_pred: pandas.Series) -> float:
     :param y_pred: the predicted labels
     :return: macro f1 score
     """
-    return f1_score(y_true, y_pred, average='macro')
+    codes, uniques = pandas.factorize(np.concatenate([np.asarray(y_true, dtype=object),
+                                                      np.asarray(y_pred, dtype=object)]))
+    return f1_scores_from_codes(codes[:len(y_true)], codes[len(y_true):], len(uniques))[1]
 
 
 def eval_f1_scores(paths_true: pandas.Series, paths_pred: pandas.Series) -> dict[str: float]:
@@ -35,60 +93,123 @@ def eval_f1_scores(paths_true: pandas.Series, paths_pred: pandas.Series) -> dict
     :return: Results for all six f1 scores. Keys: Paths Micro F1, Paths Macro F1, Second-Level Micro F1,
     Second-Level Macro F1, Third-Level Micro F1, Third-Level Macro F1
     """
-    try:
-        paths_micro_f1 = micro_f1_score(paths_true, paths_pred)
-        paths_macro_f1 = macro_f1_score(paths_true, paths_pred)
+    encoded, labels = encode_paths([paths_true, paths_pred])
+    result_dict = {}
+    for level in LEVELS:
+        level_true, level_pred = encoded[level]
+        micro_f1, macro_f1 = f1_scores_from_codes(level_true, level_pred, len(labels[level]))
+        result_dict[f"{level} Micro F1"] = micro_f1
+        result_dict[f"{level} Macro F1"] = macro_f1
+    return result_dict
 
-        second_level_true = paths_true.apply(lambda x: x.split('>')[1])
-        second_level_pred = paths_pred.apply(lambda x: x.split('>')[1])
-        second_level_micro_f1 = micro_f1_score(second_level_true, second_level_pred)
-        second_level_macro_f1 = macro_f1_score(second_level_true, second_level_pred)
 
-        third_level_true = paths_true.apply(lambda x: x.split('>')[2])
-        third_level_pred = paths_pred.apply(lambda x: x.split('>')[2])
-        third_level_micro_f1 = micro_f1_score(third_level_true, third_level_pred)
-        third_level_macro_f1 = macro_f1_score(third_level_true, third_level_pred)
+def bootstrap_f1_scores(y_true: np.ndarray, y_pred: np.ndarray, n_classes: int, n_resamples: int = 1000,
+                        confidence: float = 0.95, seed: int = 0) -> dict[str, tuple[float, float]]:
+    """
+    Calculates bootstrap percentile confidence intervals of the micro and macro f1 scores of integer-coded labels.
+    Resampling the rows is equivalent to drawing multinomial counts of the distinct (correct, predicted) pairs, so
+    the cost of a resample depends on the number of distinct pairs instead of the number of rows.
 
-        result_dict = {'Paths Micro F1': paths_micro_f1,
-                       'Paths Macro F1': paths_macro_f1,
-                       'Second-Level Micro F1': second_level_micro_f1,
-                       'Second-Level Macro F1': second_level_macro_f1,
-                       'Third-Level Micro F1': third_level_micro_f1,
-                       'Third-Level Macro F1': third_level_macro_f1}
-        return result_dict
-    except IndexError as e:
-        raise Exception(f"Incorrect path format: {e}")
+    :param y_true: the correct label codes
+    :param y_pred: the predicted label codes
+    :param n_classes: number of label codes
+    :param n_resamples: number of bootstrap resamples
+    :param confidence: confidence level of the intervals
+    :param seed: seed of the resampling
+    :return: lower and upper bound for Micro F1 and Macro F1
+    """
+    random_generator = np.random.default_rng(seed)
+    n = len(y_true)
+    pairs, pair_counts = np.unique(y_true.astype(np.int64) * n_classes + y_pred, return_counts=True)
+    pair_true, pair_pred = np.divmod(pairs, n_classes)
+    correct_pairs = pair_true == pair_pred
+    pair_rows = np.arange(len(pairs))
+    # maps pair counts to per-class counts, each pair adds to the support of its correct and its predicted label
+    true_positive_matrix = scipy.sparse.csr_matrix((correct_pairs.astype(np.int64), (pair_rows, pair_true)),
+                                                   shape=(len(pairs), n_classes))
+    support_matrix = (scipy.sparse.csr_matrix((np.ones(len(pairs), dtype=np.int64), (pair_rows, pair_true)),
+                                              shape=(len(pairs), n_classes)) +
+                      scipy.sparse.csr_matrix((np.ones(len(pairs), dtype=np.int64), (pair_rows, pair_pred)),
+                                              shape=(len(pairs), n_classes)))
+    micro_scores = []
+    macro_scores = []
+    for batch_start in range(0, n_resamples, BOOTSTRAP_BATCH_SIZE):
+        batch_size = min(BOOTSTRAP_BATCH_SIZE, n_resamples - batch_start)
+        weights = random_generator.multinomial(n, pair_counts / n, size=batch_size)
+        true_positives = np.asarray((true_positive_matrix.T @ weights.T).T)
+        support = np.asarray((support_matrix.T @ weights.T).T)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            class_f1 = np.where(support > 0, 2 * true_positives / support, np.nan)
+        micro_scores.append(weights[:, correct_pairs].sum(axis=1) / n)
+        macro_scores.append(np.nanmean(class_f1, axis=1))
+    alpha = (1 - confidence) / 2
+    return {name: tuple(float(bound) for bound in np.quantile(np.concatenate(scores), [alpha, 1 - alpha]))
+            for name, scores in (('Micro F1', micro_scores), ('Macro F1', macro_scores))}
+
+
+def mcnemar_p_values(correct: np.ndarray, exact: bool = None) -> np.ndarray:
+    """
+    Performs McNemar's test for all pairs of runs at once. The discordant counts of all pairs are calculated with a
+    single matrix product.
+
+    :param correct: boolean matrix with one row per run, True where the run's prediction is correct
+    :param exact: determines whether an exact binomial distribution (if True) or an approximated chi-squared
+    distribution with continuity correction (if False) is used as the test statistic. If not set, the exact test is
+    used for pairs with less than 25 discordant predictions
+    :return: matrix of p-values, with 1 on the diagonal
+    """
+    correct = correct.astype(np.int64)
+    only_first = correct @ (1 - correct).T
+    only_second = only_first.T
+    discordant = only_first + only_second
+    if exact is None:
+        exact_pairs = discordant < 25
+    else:
+        exact_pairs = np.full(discordant.shape, exact)
+    exact_p = np.minimum(1.0, 2 * binom.cdf(np.minimum(only_first, only_second), discordant, 0.5))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        statistic = (np.abs(only_first - only_second) - 1) ** 2 / discordant
+    approximated_p = np.where(discordant > 0, chi2.sf(statistic, 1), 1.0)
+    return np.where(exact_pairs, exact_p, approximated_p)
+
+
+def cohen_kappas(predictions: np.ndarray, n_classes: int) -> np.ndarray:
+    """
+    Calculates Cohen's Kappa for all pairs of runs
+
+    :param predictions: integer-coded predictions with one row per run
+    :param n_classes: number of label codes
+    :return: matrix of Cohen's Kappa values
+    """
+    n_runs, n = predictions.shape
+    offsets = np.arange(n_runs)[:, None] * n_classes
+    label_shares = np.bincount((predictions + offsets).ravel(),
+                               minlength=n_runs * n_classes).reshape(n_runs, n_classes) / n
+    expected_agreement = label_shares @ label_shares.T
+    observed_agreement = np.array([(predictions == predictions[i]).mean(axis=1) for i in range(n_runs)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(expected_agreement < 1, (observed_agreement - expected_agreement) / (1 - expected_agreement),
+                        1.0)
 
 
 def mcnemar_test(gold_standard: list[str], predictions1: list[str], predictions2: list[str], exact: bool = None) \
         -> float:
     """
-    Performs a McNemar's test on two given list of predictions. Used to test whether there's a difference in performance between the different approaches
+    Performs a McNemar's test on two given list of predictions. Used to test whether there's a difference in
+    performance between the different approaches
 
     :param gold_standard: the gold standard, i.e., list of correct categories (or category paths)
     :param predictions1: the first list of category (or category path) predictions
     :param predictions2: the second list of category (or category path) predictions
-    :param exact: determines whether an exact binomial distribution (if True) or an approximated chi-squared distribution (if False) is used as the test statistic. If not set, the value for exact is calculated based on a threshold
+    :param exact: determines whether an exact binomial distribution (if True) or an approximated chi-squared
+    distribution (if False) is used as the test statistic. If not set, the value for exact is calculated based on a
+    threshold
     :return: the p-value calculated by the McNemar test
     """
-    table = [[0, 0], [0, 0]]
-    for true, pred1, pred2 in zip(gold_standard, predictions1, predictions2):
-        true1 = (true == pred1)
-        true2 = (true == pred2)
-        if true1 and true2:
-            table[0][0] += 1
-        elif true1 and not true2:
-            table[0][1] += 1
-        elif not true1 and true2:
-            table[1][0] += 1
-        else:
-            table[1][1] += 1
-    if exact is None:
-        exact = True
-        if table[0][1] + table[1][0] >= 25:
-            exact = False
-    result = mcnemar(table, exact=exact)
-    return result.pvalue
+    gold_standard = np.asarray(gold_standard, dtype=object)
+    correct = np.array([gold_standard == np.asarray(predictions1, dtype=object),
+                        gold_standard == np.asarray(predictions2, dtype=object)])
+    return float(mcnemar_p_values(correct, exact)[0, 1])
 
 
 def cohen_kappa(predictions1: list[str], predictions2: list[str]) -> float:
@@ -99,4 +220,136 @@ def cohen_kappa(predictions1: list[str], predictions2: list[str]) -> float:
     :param predictions2: the second list of category (or category path) predictions
     :return: float value of Cohen's Kappa
     """
-    return cohen_kappa_score(predictions1, predictions2)
+    codes, uniques = pandas.factorize(np.concatenate([np.asarray(predictions1, dtype=object),
+                                                      np.asarray(predictions2, dtype=object)]))
+    return float(cohen_kappas(codes.reshape(2, -1), len(uniques))[0, 1])
+
+
+@dataclass
+class RunSet:
+    """
+    Predictions of several runs on the same products, encoded into integer codes per level
+
+    names: the names of the runs
+    index: the row index of the products
+    gold: the codes of the correct labels per level
+    predictions: the codes of the predicted labels per level, with one row per run
+    labels: the labels of the codes per level
+    """
+    names: list[str]
+    index: pandas.Index
+    gold: dict[str, np.ndarray]
+    predictions: dict[str, np.ndarray]
+    labels: dict[str, np.ndarray]
+
+
+def load_runs(paths: list[str] | str, prediction_column: str = 'Predicted Path') -> RunSet:
+    """
+    Loads result files of several runs and encodes their paths. Only products that every run predicted are kept
+
+    :param paths: Paths of the results csv files or glob patterns such as Results/results_*.csv
+    :param prediction_column: The column holding the predicted paths
+    :return: The encoded runs, named after their files
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    paths = [path for pattern in paths
+             for path in (sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])]
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    gold = None
+    predictions = []
+    for path in paths:
+        result_data = pandas.read_csv(path, index_col=data.INDEX_COLUMN,
+                                      usecols=[data.INDEX_COLUMN, 'Category Path', prediction_column])
+        gold = result_data['Category Path'] if gold is None else gold
+        predictions.append(result_data[prediction_column])
+    return encode_runs(gold, predictions, names)
+
+
+def load_store_runs(root: str, experiment: str = None, model: str = None, runs: list[str] = None,
+                    prediction_column: str = 'Predicted Path') -> RunSet:
+    """
+    Loads the runs of a result store and encodes their paths. Only the path columns are read, the response texts
+    are skipped. Only products that every run predicted are kept
+
+    :param root: Root directory of the result store
+    :param experiment: Only runs of this experiment type value
+    :param model: Only runs of this GPT model
+    :param runs: Only these runs, default: all runs matching the other filters
+    :param prediction_column: The column holding the predicted paths
+    :return: The encoded runs, named after their run identifiers
+    """
+    import resultstore
+    result_data = resultstore.load_results(root, ['Category Path', prediction_column], experiment, model, runs=runs)
+    names = []
+    gold = None
+    predictions = []
+    for name, run_data in result_data.groupby(resultstore.RUN_COLUMN, sort=True):
+        run_data = run_data.set_index(data.INDEX_COLUMN)
+        names.append(name)
+        gold = run_data['Category Path'] if gold is None else gold
+        predictions.append(run_data[prediction_column])
+    if not names:
+        raise ValueError(f"No runs in {root} match the filters")
+    return encode_runs(gold, predictions, names)
+
+
+def encode_runs(gold: pandas.Series, predictions: list[pandas.Series], names: list[str]) -> RunSet:
+    """
+    Encodes the paths of several runs on the rows they share
+
+    :param gold: The correct paths, indexed by row
+    :param predictions: The predicted paths of each run, indexed by row
+    :param names: The names of the runs
+    :return: The encoded runs
+    """
+    combined = pandas.concat([gold] + predictions, axis=1, keys=['Category Path'] + names, join='inner').dropna()
+    encoded, labels = encode_paths([combined[column] for column in combined.columns])
+    return RunSet(names, combined.index, {level: encoded[level][0] for level in LEVELS},
+                  {level: np.vstack(encoded[level][1:]) for level in LEVELS}, labels)
+
+
+def evaluate_runs(runs: RunSet, n_resamples: int = 1000, confidence: float = 0.95, seed: int = 0) \
+        -> pandas.DataFrame:
+    """
+    Calculates the f1 scores of every run with bootstrap confidence intervals
+
+    :param runs: The encoded runs as returned by load_runs()
+    :param n_resamples: Number of bootstrap resamples, 0 to skip the confidence intervals
+    :param confidence: Confidence level of the intervals
+    :param seed: Seed of the resampling, the same resamples are used for every run
+    :return: One row per run with the scores of eval_f1_scores() and their lower and upper bounds
+    """
+    rows = []
+    for run_index in range(len(runs.names)):
+        row = {}
+        for level in LEVELS:
+            n_classes = len(runs.labels[level])
+            level_pred = runs.predictions[level][run_index]
+            micro_f1, macro_f1 = f1_scores_from_codes(runs.gold[level], level_pred, n_classes)
+            row[f"{level} Micro F1"] = micro_f1
+            row[f"{level} Macro F1"] = macro_f1
+            if n_resamples:
+                intervals = bootstrap_f1_scores(runs.gold[level], level_pred, n_classes, n_resamples, confidence,
+                                                seed)
+                for score, (lower, upper) in intervals.items():
+                    row[f"{level} {score} Lower"] = lower
+                    row[f"{level} {score} Upper"] = upper
+        rows.append(row)
+    return pandas.DataFrame(rows, index=pandas.Index(runs.names, name='Run'))
+
+
+def compare_runs(runs: RunSet, level: str = 'Paths', exact: bool = None) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+    """
+    Compares all pairs of runs with McNemar's test and Cohen's Kappa
+
+    :param runs: The encoded runs as returned by load_runs()
+    :param level: The level to be compared, one of LEVELS
+    :param exact: Test statistic of McNemar's test as in mcnemar_test()
+    :return: The matrix of McNemar p-values and the matrix of Cohen's Kappa values, indexed by run names
+    """
+    level_pred = runs.predictions[level]
+    p_values = mcnemar_p_values(level_pred == runs.gold[level], exact)
+    kappas = cohen_kappas(level_pred, len(runs.labels[level]))
+    return (pandas.DataFrame(p_values, index=runs.names, columns=runs.names),
+            pandas.DataFrame(kappas, index=runs.names, columns=runs.names))
@@ -1,40 +1,189 @@
-import util
+import contextvars
+import datetime
+import json
 import os
+import queue
+import random
+import threading
+import time
+
+import profiling
+import util
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+# Seconds after which buffered lines are flushed to the log file
+FLUSH_INTERVAL = 1.0
+# Size in bytes after which the log file is rotated, None for no rotation
+MAX_LOG_BYTES = 50 * 1024 * 1024
+# Number of rotated log files that are kept
+LOG_BACKUP_COUNT = 5
+
+log_writer = None
+log_name_suffix = ""
+log_level = LEVELS["INFO"]
+response_sample_rate = 1.0
+
+log_fields = contextvars.ContextVar("log_fields", default={})
+
+
+class LogWriter:
+    """
+    Writes log records as JSON lines from a background thread. Callers only put records into a queue, so logging
+    never blocks on file I/O and can be used from threads and async tasks alike. Lines are flushed every
+    flush_interval seconds and the file is rotated once it exceeds max_bytes.
+    """
 
-logfile = None
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL, max_bytes: int = MAX_LOG_BYTES,
+                 backup_count: int = LOG_BACKUP_COUNT):
+        """
+        :param path: Path of the log file, an existing file is overwritten
+        :param flush_interval: Seconds after which buffered lines are flushed
+        :param max_bytes: Size in bytes after which the file is rotated, None for no rotation
+        :param backup_count: Number of rotated files that are kept, as path.1 (newest) to path.<backup_count>
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue = queue.SimpleQueue()
+        self.file = open(path, "w", encoding="utf-8")
+        self.thread = threading.Thread(target=self.run, name="logwriter", daemon=True)
+        self.thread.start()
+
+    def put(self, record: dict):
+        """
+        Queues a record for writing
+
+        :param record: The log record
+        """
+        self.queue.put(record)
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = False
+            if record is None:
+                break
+            if record:
+                self.file.write(json.dumps(record, default=str) + "\n")
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = time.monotonic()
+                if self.max_bytes and self.file.tell() >= self.max_bytes:
+                    self.rotate()
+        self.file.close()
+
+    def rotate(self):
+        """
+        Renames the log file to path.1, shifting older rotated files, and continues in a new file
+        """
+        self.file.close()
+        for number in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"):
+                os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "w", encoding="utf-8")
+
+    def close(self):
+        """
+        Writes all queued records and closes the file
+        """
+        self.queue.put(None)
+        self.thread.join()
 
 
 def open_log():
     """
-    Opens a log file and sets the global parameter to this new log file
+    Opens a log file and sets the global log writer to a writer of this new log file
     """
     if not os.path.exists("./Logs"):
         os.makedirs("./Logs")
     close_log()
     current_datetime = util.get_current_datetime()
-    logfile_name = "Logs/log_" + current_datetime + ".log"
-    global logfile
-    logfile = open(logfile_name, "w")
+    logfile_name = "Logs/log_" + current_datetime + log_name_suffix + ".jsonl"
+    global log_writer
+    log_writer = LogWriter(logfile_name)
+
+
+def set_log_name_suffix(suffix: str):
+    """
+    Sets a suffix appended to the names of new log files, e.g. to separate the logs of parallel worker processes
+
+    :param suffix: String - Suffix of the log file names
+    """
+    global log_name_suffix
+    log_name_suffix = suffix
+
+
+def set_log_level(level: str):
+    """
+    Sets the minimum level of written records
+
+    :param level: String - One of DEBUG, INFO, WARNING, ERROR
+    """
+    global log_level
+    log_level = LEVELS[level.upper()]
+
+
+def set_response_sample_rate(sample_rate: float):
+    """
+    Sets the share of log records that include full response texts, e.g. of responses with an incorrect path format.
+    Responses are large, so long runs can log only a sample of them
+
+    :param sample_rate: Float - Share between 0 (never) and 1 (always)
+    """
+    global response_sample_rate
+    response_sample_rate = sample_rate
+
+
+def bind(**fields):
+    """
+    Adds fields to every record written from the current context, e.g. the row index. Async tasks inherit the
+    fields of the context they were created in
+
+    :param fields: The fields, None values remove a field
+    """
+    bound_fields = {**log_fields.get(), **fields}
+    log_fields.set({key: value for key, value in bound_fields.items() if value is not None})
+
+
+def should_log_response() -> bool:
+    """
+    Decides whether the next response text is added to a log record
+
+    :return: True for a share of response_sample_rate of the calls
+    """
+    return response_sample_rate >= 1 or random.random() < response_sample_rate
 
 
-def write_to_log(message: str):
+def write_to_log(message: str, level: str = "INFO", **fields):
     """
-    Writes to the log file
+    Writes a record to the log file. The record holds the time, the level, the message, the fields bound to the
+    current context and the given fields
 
     :param message: String - Message to be written to the logfile
+    :param level: String - Level of the record, one of DEBUG, INFO, WARNING, ERROR
+    :param fields: Further fields of the record, e.g. round
     """
-    global logfile
-    if not logfile:
+    if not log_writer:
         raise Exception("No open log file")
-    else:
-        logfile.write(message + '\n')
+    if LEVELS[level] < log_level:
+        return
+    with profiling.span("logging"):
+        timestamp = datetime.datetime.now().isoformat(timespec="milliseconds")
+        log_writer.put({"time": timestamp, "level": level, "message": message, **log_fields.get(), **fields})
 
 
 def close_log():
     """
-    Closes the log file
+    Writes the queued records and closes the log file
     """
-    global logfile
-    if logfile:
-        logfile.close()
-        logfile = None
+    global log_writer
+    if log_writer:
+        log_writer.close()
+        log_writer = None
@@ -1,16 +1,405 @@
+import argparse
+import json
+import os
+
+import pandas as pd
+
+import batch
+import benchmark
+import cache
 import classifier
 import data
 import eval
+import profiling
+import sharding
+import structured
+import taxonomy
 from util import ExperimentType
 
-# Classification
-classifier.set_n_self_consistency(3)
-classifier.set_n_choice_shuffling(3)
 
-test_data = data.test_dataset
-experiment_type = ExperimentType.SELF_CONSISTENCY
-result_data = classifier.classify(experiment_type, test_data)
+def parse_args(args: list[str] = None) -> argparse.Namespace:
+    """
+    Parses the command line arguments
+
+    :param args: The arguments, default: sys.argv
+    :return: The parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Classifies products into their Icecat category path")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    experiment_parser = argparse.ArgumentParser(add_help=False)
+    experiment_parser.add_argument("--input", default=data.TEST_DATASET_PATH,
+                                   help="catalog file (csv, jsonl or parquet), default: the built-in test dataset")
+    experiment_parser.add_argument("--experiment", default=ExperimentType.SELF_CONSISTENCY.value,
+                                   choices=[experiment_type.value for experiment_type in ExperimentType],
+                                   help="experiment type")
+    experiment_parser.add_argument("--model", default="gpt-3.5-turbo", help="GPT model")
+    experiment_parser.add_argument("--n-self-consistency", type=int, default=3,
+                                   help="number of self-consistency paths")
+    experiment_parser.add_argument("--n-choice-shuffling", type=int, default=3,
+                                   help="number of choice shuffling paths")
+    experiment_parser.add_argument("--shuffle-seed", type=int,
+                                   help="seed of the choice shuffling orderings, default: a random seed")
+    experiment_parser.add_argument("--per-row-shuffling", action="store_true",
+                                   help="derive separate choice shuffling orderings for every product")
+    experiment_parser.add_argument("--fast", action="store_true",
+                                   help="ask for an answer-only structured output restricted to the labels instead of "
+                                        "a reasoned path")
+    experiment_parser.add_argument("--fast-max-tokens", type=int, default=structured.FAST_MAX_TOKENS,
+                                   help="maximum number of completion tokens per answer in the fast mode")
+    experiment_parser.add_argument("--with-definition", action="store_true",
+                                   help="add label definitions to the prompt")
+    experiment_parser.add_argument("--chunk-size", type=int, default=data.CHUNK_SIZE,
+                                   help="number of products read at once")
+    experiment_parser.add_argument("--taxonomy", help="taxonomy file, default: the Icecat taxonomy")
+
+    classify_parser = subparsers.add_parser("classify", parents=[experiment_parser], help="classify a product catalog")
+    classify_parser.add_argument("--output", help="results csv file, default: a new file in Results")
+    classify_parser.add_argument("--result-store", metavar="DIRECTORY",
+                                 help="append the results to this partitioned Parquet store instead of the csv file, "
+                                      "as run named after the csv file")
+    classify_parser.add_argument("--max-concurrency", type=int, default=8,
+                                 help="maximum number of concurrent requests per process")
+    classify_parser.add_argument("--pack-size", type=int, default=1,
+                                 help="number of products classified with one prompt")
+    classify_parser.add_argument("--max-samples-per-request", type=int, default=8,
+                                 help="maximum number of samples requested at once for rounds sharing a prompt")
+    classify_parser.add_argument("--temperature-buckets", type=int,
+                                 help="group the self-consistency temperatures into this many buckets, so rounds of "
+                                      "a bucket share one multi-sample request, default: exact temperatures, i.e. "
+                                      "one request per round")
+    classify_parser.add_argument("--adaptive-voting", action="store_true",
+                                 help="stop a product once its leading path can't be overtaken by the remaining rounds")
+    classify_parser.add_argument("--vote-confidence", type=float,
+                                 help="with adaptive voting, also stop once the leading path has this share of votes")
+    classify_parser.add_argument("--vote-margin", type=int,
+                                 help="with adaptive voting, also stop once the leading path leads by this many votes")
+    classify_parser.add_argument("--min-votes", type=int, default=1,
+                                 help="minimum number of votes before --vote-confidence and --vote-margin are checked")
+    classify_parser.add_argument("--cache", nargs="?", const=cache.CACHE_PATH, metavar="SQLITE_FILE",
+                                 help=f"answer repeated requests from a response cache, default file: "
+                                      f"{cache.CACHE_PATH}")
+    classify_parser.add_argument("--replay-only", action="store_true",
+                                 help="only answer from the response cache and fail on cache misses")
+    classify_parser.add_argument("--two-stage", action="store_true",
+                                 help="choose the second-level category first and then one of its children")
+    classify_parser.add_argument("--profile", choices=profiling.PROFILING_MODES,
+                                 help="time the stages of the run and, with cprofile or sampling, also save a "
+                                      "profile next to the results")
+    classify_parser.add_argument("--deduplicate", action="store_true",
+                                 help="classify products with the same canonical title and brand once")
+    classify_parser.add_argument("--strip-variant-tokens", action="store_true",
+                                 help="ignore colours, capacities and pack sizes when deduplicating")
+    classify_parser.add_argument("--prefilter", nargs="+", metavar="LABELED_CSV",
+                                 help="classify products by their nearest labeled neighbours in these files first and "
+                                      "only send uncertain products to the LLM")
+    classify_parser.add_argument("--prefilter-label-column", default="Category Path",
+                                 help="column holding the paths in the prefilter files, e.g. Predicted Path")
+    classify_parser.add_argument("--prefilter-threshold", type=float, default=0.5,
+                                 help="minimum prefilter confidence for a product to skip the LLM")
+    classify_parser.add_argument("--shards", type=int, default=1, help="number of shards the catalog is split into")
+    classify_parser.add_argument("--shard-index", type=int,
+                                 help="only classify this shard in the current process, e.g. one shard per machine")
+    classify_parser.add_argument("--workers", type=int,
+                                 help="number of worker processes for all shards, default: one per shard")
+    classify_parser.add_argument("--resume", action="store_true", help="continue the shards from their checkpoints")
+    classify_parser.add_argument("--backend", choices=["openai", "http", "fake"], default="openai",
+                                 help="completion backend")
+    classify_parser.add_argument("--base-url", help="base URL of an OpenAI-compatible server")
+    classify_parser.add_argument("--requests-per-minute", type=float,
+                                 help="request limit per process, i.e. the account limit divided by the workers")
+    classify_parser.add_argument("--tokens-per-minute", type=float,
+                                 help="token limit per process, i.e. the account limit divided by the workers")
+    classify_parser.add_argument("--prometheus-metrics", action="store_true",
+                                 help="also save the run metrics as Prometheus textfile next to the results")
+    classify_parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                                 help="minimum level of the log records")
+    classify_parser.add_argument("--response-sample-rate", type=float, default=1.0,
+                                 help="share of the log records that include full response texts")
+
+    batch_export_parser = subparsers.add_parser("batch-export", parents=[experiment_parser],
+                                                help="write the requests of a catalog to Batch API input files")
+    batch_export_parser.add_argument("--output-prefix", required=True,
+                                     help="prefix of the input files, numbered <prefix>_000.jsonl and so on")
+
+    batch_ingest_parser = subparsers.add_parser("batch-ingest", parents=[experiment_parser],
+                                                help="classify a catalog from Batch API output files")
+    batch_ingest_parser.add_argument("--output", help="results csv file, default: a new file in Results")
+    batch_ingest_parser.add_argument("--result-store", metavar="DIRECTORY",
+                                     help="save the results to this partitioned Parquet store instead of the csv file")
+    batch_ingest_parser.add_argument("--requests", nargs="+", required=True,
+                                     help="all input files submitted so far, including follow-up batches")
+    batch_ingest_parser.add_argument("--responses", nargs="+", required=True,
+                                     help="all output and error files received so far, including follow-up batches")
+    batch_ingest_parser.add_argument("--followup-prefix",
+                                     help="prefix of the follow-up input files repeating failed rounds")
+
+    merge_parser = subparsers.add_parser("merge", help="merge the results files of separately classified shards")
+    merge_parser.add_argument("--output", required=True, help="merged results csv file")
+    merge_parser.add_argument("shard_paths", nargs="+", help="results files of the shards")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="measure throughput against a local fake LLM server")
+    benchmark_parser.add_argument("--experiments", nargs="+", choices=[experiment_type.value
+                                                                       for experiment_type in ExperimentType],
+                                  help="experiment types, default: all")
+    benchmark_parser.add_argument("--sizes", nargs="+", type=int, default=benchmark.BENCHMARK_SIZES,
+                                  help="numbers of products")
+    benchmark_parser.add_argument("--n-self-consistency", type=int, default=3, help="number of self-consistency paths")
+    benchmark_parser.add_argument("--n-choice-shuffling", type=int, default=3, help="number of choice shuffling paths")
+    benchmark_parser.add_argument("--max-concurrency", type=int, default=8,
+                                  help="maximum number of concurrent requests")
+    benchmark_parser.add_argument("--pack-size", type=int, default=1,
+                                  help="number of products classified with one prompt")
+    benchmark_parser.add_argument("--fast", action="store_true", help="classify in the fast mode")
+    benchmark_parser.add_argument("--latency", type=float, default=0.05, help="median server latency in seconds")
+    benchmark_parser.add_argument("--latency-sigma", type=float, default=0.5,
+                                  help="spread of the log-normal latency distribution")
+    benchmark_parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of 429 responses")
+    benchmark_parser.add_argument("--server-error-rate", type=float, default=0.0, help="share of 500 responses")
+    benchmark_parser.add_argument("--malformed-rate", type=float, default=0.0,
+                                  help="share of responses without a valid path")
+    benchmark_parser.add_argument("--seconds-per-token", type=float, default=0.0,
+                                  help="generation time per completion token")
+    benchmark_parser.add_argument("--reasoning-tokens", type=int, default=0,
+                                  help="reasoning tokens preceding the path in unstructured responses")
+    benchmark_parser.add_argument("--seed", type=int, default=0, help="seed of the faults and latencies")
+    benchmark_parser.add_argument("--no-trace-memory", action="store_true",
+                                  help="skip the peak memory measurement, which slows down the runs")
+    benchmark_parser.add_argument("--output", help="JSON report, default: print the report")
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="evaluate and compare several results files")
+    evaluate_parser.add_argument("result_paths", nargs="*", help="results files or glob patterns, e.g. "
+                                                                 "'Results/results_*.csv'")
+    evaluate_parser.add_argument("--result-store", metavar="DIRECTORY",
+                                 help="evaluate the runs of this result store instead of results files")
+    evaluate_parser.add_argument("--experiment", choices=[experiment_type.value for experiment_type in ExperimentType],
+                                 help="only evaluate the store runs of this experiment type")
+    evaluate_parser.add_argument("--model", help="only evaluate the store runs of this GPT model")
+    evaluate_parser.add_argument("--runs", nargs="+", help="only evaluate these store runs")
+    evaluate_parser.add_argument("--level", choices=eval.LEVELS, default="Paths",
+                                 help="label level of the pairwise comparison")
+    evaluate_parser.add_argument("--n-resamples", type=int, default=1000,
+                                 help="bootstrap resamples of the confidence intervals, 0 disables them")
+    evaluate_parser.add_argument("--output-prefix", help="saves the scores, p-values and kappas as csv files")
+
+    store_import_parser = subparsers.add_parser("store-import", help="copy results files into a result store")
+    store_import_parser.add_argument("--result-store", metavar="DIRECTORY", required=True,
+                                     help="root directory of the result store")
+    store_import_parser.add_argument("--experiment", required=True,
+                                     choices=[experiment_type.value for experiment_type in ExperimentType],
+                                     help="experiment type of the runs")
+    store_import_parser.add_argument("--model", required=True, help="GPT model of the runs")
+    store_import_parser.add_argument("--date", help="date partition, default: the modification date of each file")
+    store_import_parser.add_argument("result_paths", nargs="+", help="results files, each imported as one run")
+
+    store_list_parser = subparsers.add_parser("store-list", help="list the runs of a result store")
+    store_list_parser.add_argument("--result-store", metavar="DIRECTORY", required=True,
+                                   help="root directory of the result store")
+    arguments = parser.parse_args(args)
+    if arguments.command == "evaluate" and not arguments.result_paths and not arguments.result_store:
+        parser.error("evaluate requires results files or --result-store")
+    if arguments.command == "classify" and arguments.backend == "http" and not arguments.base_url:
+        parser.error("--backend http requires --base-url")
+    return arguments
+
+
+def print_evaluation(results_path: str):
+    """
+    Prints the f1 scores of a results file, if it contains the correct category paths
+
+    :param results_path: Path of the results csv file
+    """
+    columns = pd.read_csv(results_path, nrows=0).columns
+    if 'Category Path' not in columns:
+        return
+    result_data = pd.read_csv(results_path, usecols=['Category Path', 'Predicted Path']).dropna()
+    print(eval.eval_f1_scores(result_data['Category Path'], result_data['Predicted Path']))
+
+
+def print_store_evaluation(root: str, run_id: str):
+    """
+    Prints the f1 scores of a run in the result store, if it contains the correct category paths
+
+    :param root: Root directory of the result store
+    :param run_id: The identifier of the run
+    """
+    import resultstore
+    if 'Category Path' not in resultstore.open_dataset(root).schema.names:
+        return
+    result_data = resultstore.load_results(root, ['Category Path', 'Predicted Path'], runs=[run_id]).dropna()
+    print(eval.eval_f1_scores(result_data['Category Path'], result_data['Predicted Path']))
+
+
+def run_evaluate_command(arguments: argparse.Namespace):
+    """
+    Runs the evaluate command on the rows shared by all results files or store runs
+
+    :param arguments: The parsed arguments
+    """
+    if arguments.result_store:
+        runs = eval.load_store_runs(arguments.result_store, arguments.experiment, arguments.model, arguments.runs)
+    else:
+        runs = eval.load_runs(arguments.result_paths)
+    scores = eval.evaluate_runs(runs, arguments.n_resamples)
+    p_values, kappas = eval.compare_runs(runs, arguments.level)
+    with pd.option_context("display.max_columns", None, "display.width", None):
+        print(f"Evaluated {len(runs.index)} rows of {len(runs.names)} runs")
+        print(scores)
+        print(f"McNemar p-values ({arguments.level})")
+        print(p_values)
+        print(f"Cohen's kappa ({arguments.level})")
+        print(kappas)
+    if arguments.output_prefix:
+        scores.to_csv(f"{arguments.output_prefix}_scores.csv")
+        p_values.to_csv(f"{arguments.output_prefix}_mcnemar.csv")
+        kappas.to_csv(f"{arguments.output_prefix}_kappa.csv")
+
+
+def run_store_command(arguments: argparse.Namespace):
+    """
+    Runs the store-import or store-list command
+
+    :param arguments: The parsed arguments
+    """
+    # pyarrow is only needed for the result store
+    import resultstore
+    if arguments.command == "store-import":
+        for results_path in arguments.result_paths:
+            run_id = resultstore.import_csv(results_path, arguments.result_store, arguments.experiment,
+                                            arguments.model, date=arguments.date)
+            print(f"Imported {results_path} as run {run_id}")
+        return
+    with pd.option_context("display.max_rows", None, "display.width", None):
+        print(resultstore.list_runs(arguments.result_store))
+
+
+def run_benchmark_command(arguments: argparse.Namespace):
+    """
+    Runs the benchmark command
+
+    :param arguments: The parsed arguments
+    """
+    classifier.set_n_self_consistency(arguments.n_self_consistency)
+    classifier.set_n_choice_shuffling(arguments.n_choice_shuffling)
+    classifier.set_max_concurrency(arguments.max_concurrency)
+    classifier.set_pack_size(arguments.pack_size)
+    classifier.set_fast_mode(arguments.fast)
+    profile = benchmark.FaultProfile(arguments.latency, arguments.latency_sigma, arguments.rate_limit_rate,
+                                     arguments.server_error_rate, arguments.malformed_rate,
+                                     seconds_per_token=arguments.seconds_per_token,
+                                     reasoning_tokens=arguments.reasoning_tokens, seed=arguments.seed)
+    experiment_types = [ExperimentType(experiment) for experiment in arguments.experiments or []]
+    report = benchmark.run_benchmark(experiment_types, arguments.sizes, profile, not arguments.no_trace_memory)
+    if arguments.output:
+        benchmark.save_report(report, arguments.output)
+        print(f"Benchmark report saved to {arguments.output}")
+    else:
+        print(json.dumps(report, indent=2))
+    for run in report['Runs']:
+        if run['Failed']:
+            print(f"Failed: {run['Experiment Type']} finished {run['Finished Products']} of {run['Products']} "
+                  f"products, error: {run['Error']}")
+
+
+def run_batch_command(arguments: argparse.Namespace):
+    """
+    Runs the batch-export or batch-ingest command
+
+    :param arguments: The parsed arguments
+    """
+    experiment_type = ExperimentType(arguments.experiment)
+    classifier.set_gpt_model(arguments.model)
+    classifier.set_n_self_consistency(arguments.n_self_consistency)
+    classifier.set_n_choice_shuffling(arguments.n_choice_shuffling)
+    classifier.set_choice_shuffling(arguments.shuffle_seed, arguments.per_row_shuffling)
+    classifier.set_fast_mode(arguments.fast, arguments.fast_max_tokens)
+    if arguments.taxonomy:
+        classifier.set_taxonomy(taxonomy.load_taxonomy(arguments.taxonomy))
+    chunks = data.iter_products(arguments.input, arguments.chunk_size)
+    if arguments.command == "batch-export":
+        for path in batch.export_batch(experiment_type, chunks, arguments.output_prefix, arguments.with_definition):
+            print(f"Batch input saved to {path}")
+        return
+
+    result_dataset, followup_paths = batch.ingest_batch(experiment_type, chunks, arguments.responses,
+                                                        arguments.requests, arguments.followup_prefix)
+    output_path = arguments.output or data.get_results_csv_path(experiment_type, arguments.with_definition)
+    pending = result_dataset['Predicted Path'].isna().sum()
+    if arguments.result_store:
+        import resultstore
+        run_id = resultstore.get_run_id(output_path)
+        resultstore.ResultStoreWriter(arguments.result_store, experiment_type.value, arguments.model,
+                                      run_id).append(result_dataset)
+        print(f"Results saved to {arguments.result_store} as run {run_id}, {pending} rows pending")
+    else:
+        data.save_results_as_csv(result_dataset, experiment_type, arguments.with_definition, output_path)
+        print(f"Results saved to {output_path}, {pending} rows pending")
+    for path in followup_paths:
+        print(f"Follow-up batch input saved to {path}")
+    if arguments.result_store:
+        print_store_evaluation(arguments.result_store, run_id)
+    else:
+        print_evaluation(output_path)
+
+
+def main(args: list[str] = None):
+    arguments = parse_args(args)
+    if arguments.command == "merge":
+        sharding.merge_results(arguments.shard_paths, arguments.output)
+        return
+    if arguments.command == "evaluate":
+        run_evaluate_command(arguments)
+        return
+    if arguments.command == "benchmark":
+        run_benchmark_command(arguments)
+        return
+    if arguments.command in ("store-import", "store-list"):
+        run_store_command(arguments)
+        return
+    if arguments.command in ("batch-export", "batch-ingest"):
+        run_batch_command(arguments)
+        return
+
+    experiment_type = ExperimentType(arguments.experiment)
+    config = sharding.RunConfig(experiment_type, arguments.model, arguments.n_self_consistency,
+                                arguments.n_choice_shuffling, arguments.with_definition, arguments.max_concurrency,
+                                arguments.chunk_size, arguments.backend, arguments.base_url,
+                                arguments.requests_per_minute, arguments.tokens_per_minute,
+                                arguments.prometheus_metrics, arguments.log_level,
+                                arguments.response_sample_rate, arguments.pack_size, arguments.prefilter,
+                                arguments.prefilter_label_column, arguments.prefilter_threshold, arguments.taxonomy,
+                                arguments.two_stage, arguments.deduplicate, arguments.strip_variant_tokens,
+                                arguments.shuffle_seed, arguments.per_row_shuffling, arguments.profile,
+                                arguments.fast, arguments.fast_max_tokens, arguments.result_store,
+                                max_samples_per_request=arguments.max_samples_per_request,
+                                temperature_buckets=arguments.temperature_buckets,
+                                adaptive_voting=arguments.adaptive_voting,
+                                vote_confidence=arguments.vote_confidence, vote_margin=arguments.vote_margin,
+                                min_votes=arguments.min_votes, cache_path=arguments.cache,
+                                replay_only=arguments.replay_only)
+    output_path = arguments.output or data.get_results_csv_path(experiment_type, arguments.with_definition)
+    # the run of the result store is named after the results csv file
+    run_id = os.path.splitext(os.path.basename(output_path))[0]
+    if arguments.shard_index is not None:
+        shard_path = sharding.run_shard(config, arguments.input, arguments.shard_index, arguments.shards, output_path,
+                                        arguments.resume)
+        if arguments.result_store:
+            print(f"Shard results saved to {arguments.result_store} as run {run_id}")
+        else:
+            print(f"Shard results saved to {shard_path}")
+        return
+
+    sharding.run_sharded(config, arguments.input, output_path, arguments.shards, arguments.workers,
+                         arguments.resume)
+    if arguments.result_store:
+        print(f"Results saved to {arguments.result_store} as run {run_id}")
+        print_store_evaluation(arguments.result_store, run_id)
+        return
+    print(f"Results saved to {output_path}")
+    # Evaluation
+    # TODO Store eval results
+    print_evaluation(output_path)
+
 
-# Evaluation
-# TODO Store eval results
-print(eval.eval_f1_scores(result_data['Category Path'], result_data['Predicted Path']))
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import re
+
+
+def build_trie(strings: list[str]) -> dict:
+    """
+    Builds a character trie of the given strings. The empty key marks the end of a string.
+
+    :param strings: the strings to be inserted
+    :return: the root node of the trie
+    """
+    root = {}
+    for string in strings:
+        node = root
+        for char in string:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return root
+
+
+def trie_to_pattern(node: dict) -> str:
+    """
+    Converts a trie into a regular expression matching exactly the strings of the trie. Shared prefixes are only
+    matched once, and optional suffixes are greedy, so the longest string wins if one string is a prefix of another.
+
+    :param node: the root node of the trie
+    :return: the regular expression
+    """
+    alternatives = [re.escape(char) + trie_to_pattern(child) for char, child in sorted(node.items()) if char != '']
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1:
+        pattern = alternatives[0]
+    else:
+        pattern = '(?:' + '|'.join(alternatives) + ')'
+    if '' in node:
+        if len(alternatives) == 1 and len(alternatives[0]) > 1:
+            pattern = '(?:' + pattern + ')'
+        pattern = pattern + '?'
+    return pattern
+
+
+class PathMatcher:
+    """
+    Finds category paths in a response with a single regular expression compiled once from all valid paths. A
+    response is scanned in one pass, independent of the number of paths.
+    """
+
+    def __init__(self, paths: list[str]):
+        """
+        :param paths: all valid category paths
+        """
+        self.pattern = re.compile(trie_to_pattern(build_trie(paths)))
+
+    def find_all(self, response_string: str) -> list[str]:
+        """
+        Finds all category paths in a response
+
+        :param response_string: the response, with normalized whitespace around '>'
+        :return: the paths in order of occurrence
+        """
+        return self.pattern.findall(response_string)
+
+    def find(self, response_string: str) -> str | None:
+        """
+        Finds the final category path of a response, i.e. its last occurrence, as the model concludes its reasoning
+        with the answer
+
+        :param response_string: the response, with normalized whitespace around '>'
+        :return: the last path, or None if the response doesn't contain any path
+        """
+        last_match = None
+        for last_match in self.pattern.finditer(response_string):
+            pass
+        return last_match.group(0) if last_match else None
@@ -0,0 +1,235 @@
+import json
+import os
+import random
+from dataclasses import dataclass, field
+
+from backend import Completion
+
+# Maximum number of values kept per distribution, larger runs are sampled
+RESERVOIR_SIZE = 100000
+
+
+class Reservoir:
+    """
+    Uniform sample of bounded size over a stream of values, used to estimate percentiles with constant memory
+    """
+
+    def __init__(self, size: int = RESERVOIR_SIZE, seed: int = 0):
+        """
+        :param size: Maximum number of kept values
+        :param seed: Seed of the sampling
+        """
+        self.size = size
+        self.count = 0
+        self.values = []
+        self.random = random.Random(seed)
+
+    def add(self, value: float):
+        """
+        Adds a value to the stream
+
+        :param value: The value
+        """
+        self.count += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            position = self.random.randrange(self.count)
+            if position < self.size:
+                self.values[position] = value
+
+    def percentile(self, percent: float) -> float:
+        """
+        Estimates a percentile of the stream (nearest rank)
+
+        :param percent: The percentile between 0 and 100
+        :return: The estimated percentile, 0 for an empty stream
+        """
+        if not self.values:
+            return 0.0
+        values = sorted(self.values)
+        rank = max(0, min(len(values) - 1, round(percent / 100 * len(values) + 0.5) - 1))
+        return values[rank]
+
+
+@dataclass
+class RunSummary:
+    """
+    Aggregated metrics of the classified rows of one experiment type and model. Rows resolved without a completion
+    request, by the prefilter or as duplicates of another row, are counted in rows with zero calls and also reported
+    separately, so the per-product figures stay comparable across configurations.
+    """
+    rows: int = 0
+    prefilter_rows: int = 0
+    duplicate_rows: int = 0
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    format_retries: int = 0
+    call_latency: Reservoir = field(default_factory=Reservoir)
+    row_tokens: Reservoir = field(default_factory=Reservoir)
+    row_calls: Reservoir = field(default_factory=Reservoir)
+
+    def to_dict(self) -> dict[str, float]:
+        """
+        Converts the summary into the values of the run report
+
+        :return: Totals, per-product means and p50/p95 of call latency and tokens per product
+        """
+        rows = max(self.rows, 1)
+        return {'Rows': self.rows,
+                'Prefilter Rows': self.prefilter_rows,
+                'Duplicate Rows': self.duplicate_rows,
+                'Calls': self.calls,
+                'Prompt Tokens': self.prompt_tokens,
+                'Completion Tokens': self.completion_tokens,
+                'Retries': self.retries,
+                'Format Retries': self.format_retries,
+                'Calls Per Product': self.calls / rows,
+                'Tokens Per Product': (self.prompt_tokens + self.completion_tokens) / rows,
+                'Tokens Per Product P50': self.row_tokens.percentile(50),
+                'Tokens Per Product P95': self.row_tokens.percentile(95),
+                'Latency P50': self.call_latency.percentile(50),
+                'Latency P95': self.call_latency.percentile(95),
+                'Latency Mean': (sum(self.call_latency.values) / len(self.call_latency.values)
+                                 if self.call_latency.values else 0.0)}
+
+
+@dataclass
+class RowMetrics:
+    """
+    Metrics of a single row, summed over all of its completion requests
+    """
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0
+    retries: int = 0
+    format_retries: int = 0
+
+    def share(self, count: int) -> "RowMetrics":
+        """
+        Splits metrics shared by several rows, e.g. of a packed prompt, evenly
+
+        :param count: Number of rows
+        :return: The metrics of a single row
+        """
+        return RowMetrics(self.calls / count, self.prompt_tokens / count, self.completion_tokens / count,
+                          self.latency / count, self.retries / count, self.format_retries / count)
+
+
+class MetricsRecorder:
+    """
+    Records token usage, latency and retries of every completion of a run, aggregated per experiment type and model
+    """
+
+    def __init__(self):
+        self.summaries = {}
+
+    def get_summary(self, experiment: str, model: str) -> RunSummary:
+        return self.summaries.setdefault((experiment, model), RunSummary())
+
+    def record_call(self, experiment: str, model: str, row_metrics: RowMetrics | None, completion: Completion,
+                    format_retry: bool = False):
+        """
+        Records a finished completion request
+
+        :param experiment: The experiment type
+        :param model: The GPT model
+        :param row_metrics: The metrics of the row the request belongs to, if any
+        :param completion: The completion
+        :param format_retry: States whether the request repeats a response with an incorrect path format
+        """
+        summary = self.get_summary(experiment, model)
+        summary.calls += 1
+        summary.prompt_tokens += completion.prompt_tokens
+        summary.completion_tokens += completion.completion_tokens
+        summary.retries += completion.retries
+        summary.format_retries += format_retry
+        summary.call_latency.add(completion.latency)
+        if row_metrics is not None:
+            row_metrics.calls += 1
+            row_metrics.prompt_tokens += completion.prompt_tokens
+            row_metrics.completion_tokens += completion.completion_tokens
+            row_metrics.latency += completion.latency
+            row_metrics.retries += completion.retries
+            row_metrics.format_retries += format_retry
+
+    def record_row(self, experiment: str, model: str, row_metrics: RowMetrics):
+        """
+        Records a finished row
+
+        :param experiment: The experiment type
+        :param model: The GPT model
+        :param row_metrics: The metrics of the row
+        """
+        summary = self.get_summary(experiment, model)
+        summary.rows += 1
+        summary.row_tokens.add(row_metrics.prompt_tokens + row_metrics.completion_tokens)
+        summary.row_calls.add(row_metrics.calls)
+
+    def record_resolved_row(self, experiment: str, model: str, resolved_by: str):
+        """
+        Records a row finished without a completion request
+
+        :param experiment: The experiment type
+        :param model: The GPT model
+        :param resolved_by: "prefilter" for rows classified by the prefilter index, "duplicate" for rows copied from
+        their representative
+        """
+        self.record_row(experiment, model, RowMetrics())
+        summary = self.get_summary(experiment, model)
+        if resolved_by == "prefilter":
+            summary.prefilter_rows += 1
+        elif resolved_by == "duplicate":
+            summary.duplicate_rows += 1
+        else:
+            raise ValueError(f"Unknown row resolution: {resolved_by}")
+
+    def to_report(self) -> list[dict[str, object]]:
+        """
+        Creates the run report
+
+        :return: One entry per experiment type and model
+        """
+        return [{'Experiment Type': experiment, 'GPT Model': model, **summary.to_dict()}
+                for (experiment, model), summary in self.summaries.items()]
+
+    def to_prometheus(self) -> str:
+        """
+        Renders the run report in the Prometheus text exposition format, e.g. for the node exporter's textfile
+        collector
+
+        :return: The metrics as text
+        """
+        lines = []
+        for entry in self.to_report():
+            labels = f'experiment="{entry["Experiment Type"]}",model="{entry["GPT Model"]}"'
+            for key, value in entry.items():
+                if key in ('Experiment Type', 'GPT Model'):
+                    continue
+                name = "classifygpt_" + key.lower().replace(' ', '_')
+                lines.append(f"{name}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, results_csv_name: str, prometheus: bool = False) -> str:
+        """
+        Saves the run report as JSON next to the results file and optionally as Prometheus textfile
+
+        :param results_csv_name: Path of the results csv file
+        :param prometheus: Also writes a .prom textfile if True
+        :return: Path of the JSON report
+        """
+        stem = os.path.splitext(results_csv_name)[0]
+        directory = os.path.dirname(stem)
+        if directory and not os.path.exists(directory):
+            # results saved to the result store don't create the directory of the results file
+            os.makedirs(directory)
+        report_path = stem + "_metrics.json"
+        with open(report_path, "w", encoding="utf-8") as report_file:
+            json.dump(self.to_report(), report_file, indent=2)
+        if prometheus:
+            with open(stem + "_metrics.prom", "w", encoding="utf-8") as prometheus_file:
+                prometheus_file.write(self.to_prometheus())
+        return report_path
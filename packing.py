@@ -0,0 +1,55 @@
+import re
+
+import data
+
+# User Prompt Templates of packed prompts, replacing data.USER_PROMPT_PRODUCT_TEMPLATE. Several products share one
+# label block, each product is answered in a separate section starting with its marker
+PACKED_PROMPT_TEMPLATE = ("This message specifies {count} products instead of one. Classify every product "
+                          "separately and answer each product in its own section, which starts with the marker of "
+                          "the product on a new line, e.g. \"Product 1:\", and ends with the hierarchical path of the "
+                          "product. Don't use these markers anywhere else. The products to be classified are:\n"
+                          "{products}")
+
+PACKED_PRODUCT_TEMPLATE = "Product {number}: \"{title}\" of the brand {brand}\n"
+
+# Start of a section of a packed response, e.g. "Product 2:" or "**Product 2:**". Bare numbers like "2." aren't
+# markers, as they also number the steps of the reasoning
+SECTION_PATTERN = re.compile(r"^[\s#*]*Product\s+(\d+)\s*\**\s*:", re.IGNORECASE | re.MULTILINE)
+
+
+def format_packed_user_prompt(products: list[tuple[str, str]], second_level_labels: list[str],
+                              third_level_labels: list[str], with_definition: bool = False) -> str:
+    """
+    Assembles a user prompt classifying several products at once. The compiled label prompt is shared by all
+    products and followed by the list of the products, each with its marker.
+
+    :param products: Title and brand of each product
+    :param second_level_labels: List of second-level categories, either in original or in permuted order
+    :param third_level_labels: List of third-level categories, either in original or in permuted order
+    :param with_definition: Adds label definitions if True, doesn't add label definitions if False
+    :return: Formatted string for the user prompt
+    """
+    product_list = "".join(PACKED_PRODUCT_TEMPLATE.format(number=number, title=title, brand=brand)
+                           for number, (title, brand) in enumerate(products, start=1))
+    return (data.compile_label_prompt(tuple(second_level_labels), tuple(third_level_labels), with_definition) +
+            PACKED_PROMPT_TEMPLATE.format(count=len(products), products=product_list))
+
+
+def split_packed_response(response_string: str, count: int) -> list[str | None] | None:
+    """
+    Splits the response to a packed prompt into the sections of the single products. A section ends where the next
+    section starts, so each section contains the path of its product only. Responses whose sections can't be
+    assigned unambiguously are rejected, so that no row gets the answer of another row.
+
+    :param response_string: String value of the response message
+    :param count: Number of products in the prompt
+    :return: The section of each product in prompt order, None for products without a section. None if a marker
+    is outside the pack or appears more than once
+    """
+    sections = [None] * count
+    starts = [(match.start(), int(match.group(1))) for match in SECTION_PATTERN.finditer(response_string)]
+    for (start, number), (end, _) in zip(starts, starts[1:] + [(len(response_string), None)]):
+        if not 1 <= number <= count or sections[number - 1] is not None:
+            return None
+        sections[number - 1] = response_string[start:end].strip()
+    return sections
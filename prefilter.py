@@ -0,0 +1,109 @@
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.neighbors import NearestNeighbors
+
+# Number of neighbours voting on the path of a product
+N_NEIGHBOURS = 5
+# Paths that don't count as labels, e.g. of rounds that never returned a valid path
+INVALID_PATHS = {"None>None>None"}
+
+
+def get_product_text(title: str, brand: str) -> str:
+    """
+    Creates the text a product is indexed by
+
+    :param title: The product title
+    :param brand: The product brand
+    :return: Brand and title in lower case
+    """
+    return f"{brand} {title}".lower()
+
+
+class NearestNeighbourIndex:
+    """
+    Index of labeled products for a local first-stage classification. Products are represented by hashed character
+    n-grams of brand and title, so near-duplicates like the same model in another colour or capacity are close to
+    each other. The hashing vectorizer needs no fitting, so labeled products can be added at any time.
+    """
+
+    def __init__(self, n_neighbours: int = N_NEIGHBOURS, n_features: int = 2 ** 20):
+        """
+        :param n_neighbours: Number of neighbours voting on the path of a product
+        :param n_features: Number of hashed features
+        """
+        self.n_neighbours = n_neighbours
+        self.vectorizer = HashingVectorizer(analyzer="char_wb", ngram_range=(3, 5), n_features=n_features,
+                                            alternate_sign=False)
+        self.vectors = None
+        self.paths = np.empty(0, dtype=object)
+        self.neighbours = None
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def add(self, texts: list[str], paths: list[str]):
+        """
+        Adds labeled products to the index
+
+        :param texts: The product texts as returned by get_product_text()
+        :param paths: The category path of each product, invalid paths are skipped
+        """
+        labeled = [(text, path) for text, path in zip(texts, paths)
+                   if isinstance(path, str) and path not in INVALID_PATHS]
+        if not labeled:
+            return
+        vectors = self.vectorizer.transform([text for text, _ in labeled])
+        self.vectors = vectors if self.vectors is None else scipy.sparse.vstack([self.vectors, vectors], format="csr")
+        self.paths = np.concatenate([self.paths, np.array([path for _, path in labeled], dtype=object)])
+        self.neighbours = None
+
+    def query(self, texts: list[str]) -> list[tuple[str | None, float]]:
+        """
+        Classifies products by a similarity-weighted vote of their nearest labeled neighbours
+
+        :param texts: The product texts as returned by get_product_text()
+        :return: The predicted path and its confidence for each product. The confidence is the vote share of the path
+        multiplied by the similarity of its closest neighbour, so it is only high for products with close and
+        agreeing neighbours. The path is None for an empty index
+        """
+        if not len(self) or not texts:
+            return [(None, 0.0)] * len(texts)
+        if self.neighbours is None:
+            # brute force search only stores the vectors, so it is cheap to refit after additions
+            self.neighbours = NearestNeighbors(metric="cosine", algorithm="brute").fit(self.vectors)
+        distances, indices = self.neighbours.kneighbors(self.vectorizer.transform(texts),
+                                                        min(self.n_neighbours, len(self)))
+        predictions = []
+        for row_distances, row_indices in zip(distances, indices):
+            similarities = np.clip(1 - row_distances, 0, 1)
+            scores = defaultdict(float)
+            closest = {}
+            for similarity, path in zip(similarities, self.paths[row_indices]):
+                scores[path] += similarity
+                closest.setdefault(path, similarity)
+            path = max(scores, key=scores.get)
+            total = similarities.sum()
+            predictions.append((path, float(scores[path] / total * closest[path]) if total else 0.0))
+        return predictions
+
+
+def build_index(paths: list[str], label_column: str = 'Category Path',
+                n_neighbours: int = N_NEIGHBOURS) -> NearestNeighbourIndex:
+    """
+    Builds an index from labeled csv files, e.g. icecat_test_data.csv or results files
+
+    :param paths: Paths of the csv files, containing the columns Title, Brand and the label column
+    :param label_column: The column holding the paths, e.g. Predicted Path for results without correct paths
+    :param n_neighbours: Number of neighbours voting on the path of a product
+    :return: The index
+    """
+    index = NearestNeighbourIndex(n_neighbours)
+    for path in paths:
+        for chunk in pd.read_csv(path, usecols=['Title', 'Brand', label_column], chunksize=10000):
+            index.add([get_product_text(title, brand) for title, brand in zip(chunk['Title'], chunk['Brand'])],
+                      list(chunk[label_column]))
+    return index
@@ -0,0 +1,269 @@
+import contextvars
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+# Profiling modes: spans only time the named stages, cprofile additionally records every function call, sampling
+# additionally samples the stack of the main thread
+PROFILING_MODES = ("spans", "cprofile", "sampling")
+# Seconds between two stack samples of the sampling profiler
+SAMPLING_INTERVAL = 0.005
+
+PROFILING_MODE = None
+SPANS_ENABLED = False
+
+span_path = contextvars.ContextVar("span_path", default=())
+
+_profiler = None
+
+
+class NullSpan:
+    """
+    Span used while profiling is disabled. A single instance is shared, so a disabled span costs one function call
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class StageStats:
+    """
+    Aggregated durations of the spans, by stage name and by the path of nested spans
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.totals = defaultdict(float)
+        self.maxima = defaultdict(float)
+        self.path_totals = defaultdict(float)
+
+    def add(self, path: tuple[str, ...], duration: float):
+        """
+        Records a finished span
+
+        :param path: The names of the enclosing spans and the span itself
+        :param duration: The duration of the span in seconds
+        """
+        name = path[-1]
+        with self.lock:
+            self.counts[name] += 1
+            self.totals[name] += duration
+            self.maxima[name] = max(self.maxima[name], duration)
+            self.path_totals[path] += duration
+
+    def to_report(self, wall_time: float) -> list[dict[str, object]]:
+        """
+        Creates the per-stage breakdown. Stages include their nested stages and overlap in concurrent runs, so the
+        shares of all stages can add up to more than 100 %
+
+        :param wall_time: The duration of the run in seconds
+        :return: One entry per stage, slowest stage first
+        """
+        return [{'Stage': name, 'Count': self.counts[name], 'Total Seconds': total,
+                 'Mean Milliseconds': total / self.counts[name] * 1000,
+                 'Max Milliseconds': self.maxima[name] * 1000,
+                 'Share Of Wall Time': total / wall_time if wall_time else 0.0}
+                for name, total in sorted(self.totals.items(), key=lambda item: item[1], reverse=True)]
+
+    def to_collapsed(self) -> str:
+        """
+        Renders the spans as collapsed stacks, the input format of flamegraph.pl and speedscope. The value of a
+        stack is its self time in microseconds, i.e. its time minus the time of its nested spans
+
+        :return: One line per span path
+        """
+        child_totals = defaultdict(float)
+        for path, total in self.path_totals.items():
+            if len(path) > 1:
+                child_totals[path[:-1]] += total
+        lines = []
+        for path, total in self.path_totals.items():
+            # concurrent children can add up to more than their parent
+            self_time = max(total - child_totals[path], 0.0)
+            lines.append(f"{';'.join(path)} {round(self_time * 1e6)}")
+        return "\n".join(lines) + "\n"
+
+
+class Span:
+    """
+    Times a named stage. Spans nest along the context, so the spans of asyncio tasks nest below the span that
+    created the task
+    """
+    __slots__ = ("name", "token", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.token = span_path.set(span_path.get() + (self.name,))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        path = span_path.get()
+        span_path.reset(self.token)
+        if _profiler is not None:
+            _profiler.stage_stats.add(path, duration)
+        return False
+
+
+def span(name: str) -> Span | NullSpan:
+    """
+    Creates the span of a stage, e.g. with profiling.span("parse"): ...
+
+    :param name: The name of the stage
+    :return: The span, a shared no-op span if profiling is disabled
+    """
+    if not SPANS_ENABLED:
+        return NULL_SPAN
+    return Span(name)
+
+
+class StackSampler(threading.Thread):
+    """
+    Sampling profiler, which periodically records the stack of a thread as collapsed stack
+    """
+
+    def __init__(self, thread_id: int, interval: float = SAMPLING_INTERVAL):
+        """
+        :param thread_id: The identifier of the sampled thread
+        :param interval: Seconds between two samples
+        """
+        super().__init__(name="StackSampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def to_collapsed(self) -> str:
+        """
+        :return: The samples as collapsed stacks, one line per distinct stack with its number of samples
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.items())
+
+
+class RunProfiler:
+    """
+    Profiler of a single run, collecting the stage statistics and, depending on the mode, a cProfile or a sampling
+    profile
+    """
+
+    def __init__(self, mode: str):
+        """
+        :param mode: One of PROFILING_MODES
+        """
+        self.mode = mode
+        self.stage_stats = StageStats()
+        self.profile = cProfile.Profile() if mode == "cprofile" else None
+        self.sampler = StackSampler(threading.get_ident()) if mode == "sampling" else None
+        self.start = None
+        self.wall_time = 0.0
+
+    def begin(self):
+        self.start = time.perf_counter()
+        if self.profile is not None:
+            self.profile.enable()
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def end(self):
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.wall_time = time.perf_counter() - self.start
+
+    def save(self, results_csv_name: str) -> list[str]:
+        """
+        Saves the stage breakdown as <results>_profile.json and the span stacks as <results>_spans.collapsed next
+        to the results file, and the cProfile statistics as <results>.prof or the samples as
+        <results>_samples.collapsed
+
+        :param results_csv_name: Path of the results csv file
+        :return: The paths of the saved files
+        """
+        stem = os.path.splitext(results_csv_name)[0]
+        directory = os.path.dirname(stem)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        paths = [stem + "_profile.json", stem + "_spans.collapsed"]
+        with open(paths[0], "w", encoding="utf-8") as report_file:
+            json.dump({'Mode': self.mode, 'Wall Seconds': self.wall_time,
+                       'Stages': self.stage_stats.to_report(self.wall_time)}, report_file, indent=2)
+        with open(paths[1], "w", encoding="utf-8") as collapsed_file:
+            collapsed_file.write(self.stage_stats.to_collapsed())
+        if self.profile is not None:
+            paths.append(stem + ".prof")
+            self.profile.dump_stats(paths[-1])
+        if self.sampler is not None:
+            paths.append(stem + "_samples.collapsed")
+            with open(paths[-1], "w", encoding="utf-8") as collapsed_file:
+                collapsed_file.write(self.sampler.to_collapsed())
+        return paths
+
+
+def set_profiling(mode: str = None):
+    """
+    Sets how runs are profiled
+
+    :param mode: One of PROFILING_MODES, None to disable profiling
+    """
+    if mode is not None and mode not in PROFILING_MODES:
+        raise ValueError(f"Unknown profiling mode {mode}, expected one of {', '.join(PROFILING_MODES)}")
+    global PROFILING_MODE, SPANS_ENABLED
+    PROFILING_MODE = mode
+    SPANS_ENABLED = mode is not None
+
+
+def begin_run() -> RunProfiler | None:
+    """
+    Starts profiling a run if profiling is enabled
+
+    :return: The profiler of the run, None if profiling is disabled
+    """
+    global _profiler
+    if PROFILING_MODE is None:
+        return None
+    _profiler = RunProfiler(PROFILING_MODE)
+    _profiler.begin()
+    return _profiler
+
+
+def end_run() -> RunProfiler | None:
+    """
+    Stops profiling the current run
+
+    :return: The profiler of the run, None if profiling is disabled
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.end()
+    return profiler
@@ -0,0 +1,253 @@
+import datetime
+import glob
+import os
+import urllib.parse
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+
+import data
+
+# Column groups of the store. The paths group holds the catalog columns, the paths and every other small column, the
+# responses group only the response texts, so evaluations read the paths without touching the responses
+PATHS_GROUP = "paths"
+RESPONSES_GROUP = "responses"
+# Name of the column identifying the run of a row
+RUN_COLUMN = "Run"
+# Partition directories below each column group, e.g. paths/experiment=combined/model=gpt-4o/date=2024-05-08
+PARTITION_SCHEMA = pa.schema([("experiment", pa.string()), ("model", pa.string()), ("date", pa.string())])
+PARTITIONING = ds.partitioning(PARTITION_SCHEMA, flavor="hive")
+# Columns holding text, saved as strings even if a chunk only contains missing values
+TEXT_COLUMNS = {'Title', 'Brand', 'Category Path', 'Predicted Path', 'Prefilter Path'}
+COMPRESSION = "zstd"
+
+
+def is_response_column(column: str) -> bool:
+    """
+    :param column: The name of a result column
+    :return: True if the column holds response texts and belongs to the responses group
+    """
+    return column.startswith("Response")
+
+
+def is_text_column(column: str) -> bool:
+    return column in TEXT_COLUMNS or column.startswith("Path Round") or is_response_column(column)
+
+
+def get_run_id(results_path: str) -> str:
+    """
+    Derives the identifier of a run from the path of its results file, e.g. results_combined_2024-05-08-10-00-00
+
+    :param results_path: Path of the results csv file
+    :return: The run identifier
+    """
+    return os.path.splitext(os.path.basename(results_path))[0]
+
+
+def get_partition_directory(root: str, group: str, experiment: str, model: str, date: str) -> str:
+    """
+    :param root: Root directory of the store
+    :param group: PATHS_GROUP or RESPONSES_GROUP
+    :param experiment: The experiment type value
+    :param model: The GPT model, escaped like pyarrow escapes hive partitions, so models with slashes are allowed
+    :param date: The date in ISO format
+    :return: The directory of the partition
+    """
+    return os.path.join(root, group, f"experiment={urllib.parse.quote(experiment, safe='')}",
+                        f"model={urllib.parse.quote(model, safe='')}", f"date={date}")
+
+
+def to_arrow_column(column: str, values: pd.Series) -> pa.Array:
+    # text columns and columns of mixed objects are saved as strings, so the parts of a run share their types
+    if is_text_column(column) or values.dtype == object:
+        values = values.where(values.isna(), values.astype(str))
+        return pa.array(values, type=pa.string(), from_pandas=True)
+    return pa.array(values, from_pandas=True)
+
+
+def to_table(df: pd.DataFrame, columns: list[str], run_id: str) -> pa.Table:
+    """
+    Converts result rows into a table of one column group
+
+    :param df: The result rows, indexed by the row index
+    :param columns: The columns of the group
+    :param run_id: The identifier of the run
+    :return: The table with the index column, the columns of the group and the run column
+    """
+    arrays = [to_arrow_column(data.INDEX_COLUMN, df.index.to_series())]
+    arrays += [to_arrow_column(column, df[column]) for column in columns]
+    arrays.append(pa.array([run_id] * len(df), type=pa.string()))
+    return pa.Table.from_arrays(arrays, names=[data.INDEX_COLUMN] + columns + [RUN_COLUMN])
+
+
+class ResultStoreWriter:
+    """
+    Appends the result chunks of a run to the store. Every chunk is written as one Parquet file per column group,
+    so a run never rewrites earlier chunks and an interrupted run keeps the chunks written so far. Files are
+    renamed into place once complete, so queries during a run only see finished chunks.
+    """
+
+    def __init__(self, root: str, experiment: str, model: str, run_id: str, part_prefix: str = None,
+                 date: str = None):
+        """
+        :param root: Root directory of the store
+        :param experiment: The experiment type value
+        :param model: The GPT model
+        :param run_id: The identifier of the run, stored in the run column
+        :param part_prefix: Prefix of the file names, e.g. the shard results name, default: the run identifier.
+        Files of an earlier run with the same prefix are removed, like the results csv file of a resumed run is
+        rewritten
+        :param date: The date partition in ISO format, default: today
+        """
+        self.root = root
+        self.experiment = experiment
+        self.model = model
+        self.run_id = run_id
+        self.part_prefix = part_prefix or run_id
+        self.date = date or datetime.date.today().isoformat()
+        self.n_parts = 0
+        self.remove_parts()
+
+    def remove_parts(self):
+        """
+        Removes the files written with the same prefix, in any date partition
+        """
+        pattern = f"part-{glob.escape(self.part_prefix)}-[0-9][0-9][0-9][0-9][0-9].parquet"
+        for group in (PATHS_GROUP, RESPONSES_GROUP):
+            model_directory = os.path.dirname(get_partition_directory(self.root, group, self.experiment, self.model,
+                                                                      self.date))
+            for path in glob.glob(os.path.join(glob.escape(model_directory), "date=*", pattern)):
+                os.remove(path)
+
+    def append(self, df: pd.DataFrame) -> list[str]:
+        """
+        Writes a chunk of result rows
+
+        :param df: The result rows, i.e. the test data joined with the result columns
+        :return: The paths of the written files
+        """
+        if not len(df):
+            return []
+        response_columns = [column for column in df.columns if is_response_column(column)]
+        path_columns = [column for column in df.columns if not is_response_column(column)]
+        paths = []
+        for group, columns in ((PATHS_GROUP, path_columns), (RESPONSES_GROUP, response_columns)):
+            directory = get_partition_directory(self.root, group, self.experiment, self.model, self.date)
+            os.makedirs(directory, exist_ok=True)
+            name = f"part-{self.part_prefix}-{self.n_parts:05d}.parquet"
+            # files starting with a dot are ignored by queries until they are renamed
+            temporary_path = os.path.join(directory, "." + name)
+            pq.write_table(to_table(df, columns, self.run_id), temporary_path, compression=COMPRESSION)
+            paths.append(os.path.join(directory, name))
+            os.replace(temporary_path, paths[-1])
+        self.n_parts += 1
+        return paths
+
+
+def open_dataset(root: str, group: str = PATHS_GROUP) -> ds.Dataset:
+    """
+    Opens a column group of the store as dataset. Files are memory-mapped, and the schemas of all files are unified,
+    so runs with other columns, e.g. other numbers of rounds, are queried together with missing values
+
+    :param root: Root directory of the store
+    :param group: PATHS_GROUP or RESPONSES_GROUP
+    :return: The dataset, including the partition columns experiment, model and date
+    """
+    directory = os.path.join(root, group)
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(f"No result store at {root}")
+    filesystem = pyarrow.fs.LocalFileSystem(use_mmap=True)
+    dataset = ds.dataset(os.path.abspath(directory), format="parquet", partitioning=PARTITIONING,
+                         filesystem=filesystem)
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()] + [PARTITION_SCHEMA],
+                              promote_options="permissive")
+    return ds.dataset(os.path.abspath(directory), schema=schema, format="parquet", partitioning=PARTITIONING,
+                      filesystem=filesystem)
+
+
+def get_filter(experiment: str = None, model: str = None, date: str = None, runs: list[str] = None) \
+        -> ds.Expression | None:
+    """
+    Creates the filter of a query. Filters on the partition columns skip the files of other partitions
+
+    :param experiment: Only rows of this experiment type value
+    :param model: Only rows of this GPT model
+    :param date: Only rows written on this date, in ISO format
+    :param runs: Only rows of these runs
+    :return: The filter expression, None for all rows
+    """
+    expression = None
+    for column, value in (("experiment", experiment), ("model", model), ("date", date)):
+        if value is not None:
+            condition = ds.field(column) == value
+            expression = condition if expression is None else expression & condition
+    if runs is not None:
+        condition = ds.field(RUN_COLUMN).isin(runs)
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def load_results(root: str, columns: list[str] = None, experiment: str = None, model: str = None, date: str = None,
+                 runs: list[str] = None, with_responses: bool = False) -> pd.DataFrame:
+    """
+    Queries result rows across runs. Only the requested columns are read
+
+    :param root: Root directory of the store
+    :param columns: Columns of the paths group, e.g. ['Category Path', 'Predicted Path'], default: all columns.
+    The index, run and partition columns are always included
+    :param experiment: Only rows of this experiment type value
+    :param model: Only rows of this GPT model
+    :param date: Only rows written on this date, in ISO format
+    :param runs: Only rows of these runs
+    :param with_responses: Also reads the response texts if True
+    :return: One row per result row and run, in the layout of the results csv files plus the run and partition
+    columns
+    """
+    dataset = open_dataset(root, PATHS_GROUP)
+    key_columns = [data.INDEX_COLUMN, RUN_COLUMN] + PARTITION_SCHEMA.names
+    if columns is not None:
+        columns = key_columns + [column for column in columns if column not in key_columns]
+    row_filter = get_filter(experiment, model, date, runs)
+    results = dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+    if with_responses:
+        responses = open_dataset(root, RESPONSES_GROUP).to_table(filter=row_filter).to_pandas()
+        response_columns = [column for column in responses.columns if is_response_column(column)]
+        results = results.merge(responses[[data.INDEX_COLUMN, RUN_COLUMN] + response_columns],
+                                on=[data.INDEX_COLUMN, RUN_COLUMN], how="left")
+    return results
+
+
+def list_runs(root: str) -> pd.DataFrame:
+    """
+    Lists the runs of the store. Only the run and partition columns are read
+
+    :param root: Root directory of the store
+    :return: One row per run with its partitions and number of rows
+    """
+    runs = open_dataset(root, PATHS_GROUP).to_table(columns=[RUN_COLUMN] + PARTITION_SCHEMA.names).to_pandas()
+    return runs.groupby([RUN_COLUMN] + PARTITION_SCHEMA.names).size().rename("Rows").reset_index()
+
+
+def import_csv(results_path: str, root: str, experiment: str, model: str, run_id: str = None, date: str = None,
+               chunk_size: int = data.CHUNK_SIZE) -> str:
+    """
+    Copies a results csv file into the store chunk by chunk
+
+    :param results_path: Path of the results csv file
+    :param root: Root directory of the store
+    :param experiment: The experiment type value of the run
+    :param model: The GPT model of the run
+    :param run_id: The identifier of the run, default: the name of the results file
+    :param date: The date partition in ISO format, default: the modification date of the results file
+    :param chunk_size: Number of rows copied at once
+    :return: The identifier of the run
+    """
+    run_id = run_id or get_run_id(results_path)
+    date = date or datetime.date.fromtimestamp(os.path.getmtime(results_path)).isoformat()
+    writer = ResultStoreWriter(root, experiment, model, run_id, date=date)
+    for chunk in pd.read_csv(results_path, chunksize=chunk_size, index_col=data.INDEX_COLUMN):
+        writer.append(chunk)
+    return run_id
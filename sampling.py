@@ -0,0 +1,60 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class SampleRequest:
+    """
+    A single completion request that produces the samples of one or more classification rounds.
+
+    temperature: the sampling temperature of the request
+    second_level_labels: the second-level labels of the prompt, either in original or permuted order
+    third_level_labels: the third-level labels of the prompt, either in original or permuted order
+    round_names: the rounds served by the request, one sample (n) per round
+    """
+    temperature: float
+    second_level_labels: list[str]
+    third_level_labels: list[str]
+    round_names: list[str | None]
+
+
+def get_temperature_bucket(temperature: float, temperature_buckets: int) -> int:
+    """
+    Assigns a temperature from [0, 1] to one of temperature_buckets equally wide buckets
+
+    :param temperature: the temperature
+    :param temperature_buckets: number of buckets
+    :return: index of the bucket
+    """
+    return min(int(temperature * temperature_buckets), temperature_buckets - 1)
+
+
+def plan_requests(rounds: list[tuple[str | None, float, list[str], list[str]]], max_samples: int = 1,
+                  temperature_buckets: int = None) -> list[SampleRequest]:
+    """
+    Groups classification rounds that share the same prompt into multi-sample requests. Rounds are grouped if their
+    label orders are identical and their temperatures are identical or, if temperature_buckets is set, fall into the
+    same temperature bucket. Bucketed groups are sampled at the mean temperature of their rounds.
+
+    :param rounds: the rounds as returned by classifier.get_rounds()
+    :param max_samples: maximum number of samples (n) per request, 1 disables grouping
+    :param temperature_buckets: number of buckets the temperature schedule is split into, None keeps exact temperatures
+    :return: the planned requests, in order of the first round they serve
+    """
+    groups = {}
+    for round_name, temperature, second_level_labels, third_level_labels in rounds:
+        if temperature_buckets:
+            temperature_key = get_temperature_bucket(temperature, temperature_buckets)
+        else:
+            temperature_key = temperature
+        key = (tuple(second_level_labels), tuple(third_level_labels), temperature_key)
+        groups.setdefault(key, []).append((round_name, temperature, second_level_labels, third_level_labels))
+
+    requests = []
+    for group in groups.values():
+        for start in range(0, len(group), max_samples):
+            chunk = group[start:start + max_samples]
+            temperature = sum(round_spec[1] for round_spec in chunk) / len(chunk)
+            requests.append(SampleRequest(temperature=temperature, second_level_labels=chunk[0][2],
+                                          third_level_labels=chunk[0][3],
+                                          round_names=[round_spec[0] for round_spec in chunk]))
+    return requests
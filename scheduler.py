@@ -0,0 +1,241 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Awaitable, Callable
+
+import backend
+from backend import Completion
+
+# Completion tokens reserved per sample if a request doesn't set max_tokens
+DEFAULT_COMPLETION_TOKENS = 300
+
+# Maximum number of attempts per error class, errors of other classes are not retried
+DEFAULT_RETRY_POLICY = {
+    backend.RateLimitError: 8,
+    backend.ServerError: 4,
+    backend.BackendTimeoutError: 3,
+    backend.BackendConnectionError: 3,
+}
+
+_scheduler = None
+
+
+def estimate_tokens(messages: list[dict], n: int = 1, max_tokens: int = None) -> int:
+    """
+    Estimates the tokens a request counts against the tokens-per-minute limit, with about four characters per prompt
+    token
+
+    :param messages: The chat messages
+    :param n: Number of samples
+    :param max_tokens: Maximum number of completion tokens per sample, if set
+    :return: Estimated number of prompt and completion tokens
+    """
+    prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+    return prompt_tokens + n * (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a rate per minute. Reservations may overdraw the bucket, the caller then
+    waits until the debt is refilled, so waiting requests are served in order.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        """
+        :param rate_per_minute: Number of tokens added per minute
+        :param capacity: Maximum number of tokens in the bucket, default: rate_per_minute
+        """
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes tokens from the bucket
+
+        :param amount: Number of tokens
+        :return: Seconds to wait until the reserved tokens are available
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, amount: float):
+        """
+        Corrects an earlier reservation, e.g. once the actual token usage of a request is known
+
+        :param amount: Number of tokens to take, negative to give tokens back
+        """
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RetryBudgetExhaustedError(backend.BackendError):
+    """
+    Raised if a request fails while the retry budget of the scheduler is used up
+    """
+
+
+class RateLimitScheduler:
+    """
+    Scheduler every completion request passes through. Requests wait for the request and token buckets, and failed
+    requests are retried with jittered exponential backoff according to a retry policy per error class. A server
+    requested Retry-After pauses all requests, so that throttling doesn't escalate. Retries are limited by a budget
+    relative to the number of requests.
+    """
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None,
+                 retry_policy: dict[type, int] = None, base_delay: float = 1.0, max_delay: float = 60.0,
+                 retry_budget: float = 0.2, min_retry_budget: int = 20):
+        """
+        :param requests_per_minute: Maximum number of requests per minute, None for no limit
+        :param tokens_per_minute: Maximum number of estimated tokens per minute, None for no limit
+        :param retry_policy: Maximum number of attempts per error class, default: DEFAULT_RETRY_POLICY
+        :param base_delay: Backoff delay in seconds before the first retry, doubled with every further retry
+        :param max_delay: Maximum backoff delay in seconds
+        :param retry_budget: Share of the requests that may be retries
+        :param min_retry_budget: Number of retries that are always allowed, independent of the number of requests
+        """
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget
+        self.min_retry_budget = min_retry_budget
+        self.requests = 0
+        self.retries = 0
+        self.paused_until = 0.0
+
+    def get_admission_delay(self, tokens: int, attempt: int) -> float:
+        """
+        Reserves a request and its tokens
+
+        :param tokens: Estimated tokens of the request
+        :param attempt: Number of the attempt, starting with 1. Only first attempts count towards the retry budget
+        :return: Seconds to wait before sending the request
+        """
+        if attempt == 1:
+            self.requests += 1
+        delay = max(0.0, self.paused_until - time.monotonic())
+        if self.request_bucket is not None:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            delay = max(delay, self.token_bucket.reserve(tokens))
+        return delay
+
+    def record_usage(self, tokens: int, completion: Completion):
+        """
+        Replaces the token estimate of a finished request by its actual usage, if the backend reported it
+        """
+        if self.token_bucket is not None and completion.prompt_tokens:
+            self.token_bucket.adjust(completion.prompt_tokens + completion.completion_tokens - tokens)
+
+    def get_retry_delay(self, error: Exception, attempt: int) -> float | None:
+        """
+        Decides whether a failed request is retried
+
+        :param error: The error of the failed attempt
+        :param attempt: Number of the failed attempt, starting with 1
+        :return: Seconds to wait before the next attempt, or None if the error is not retried
+        """
+        max_attempts = next((attempts for error_class, attempts in self.retry_policy.items()
+                             if isinstance(error, error_class)), 1)
+        if attempt >= max_attempts:
+            return None
+        if self.retries >= max(self.min_retry_budget, self.retry_budget * self.requests):
+            raise RetryBudgetExhaustedError(f"Retry budget exhausted after {self.retries} retries: {error}") \
+                from error
+        self.retries += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+            if isinstance(error, backend.RateLimitError):
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        return delay
+
+    async def run(self, request: Callable[[], Awaitable[Completion]], tokens: int) -> Completion:
+        """
+        Sends a request once the rate limits allow it and retries it on failure
+
+        :param request: Function creating the awaitable of the request, called once per attempt
+        :param tokens: Estimated tokens of the request
+        :return: The completion
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            delay = self.get_admission_delay(tokens, attempt)
+            if delay:
+                await asyncio.sleep(delay)
+            start = time.perf_counter()
+            try:
+                completion = await request()
+            except backend.BackendError as e:
+                delay = self.get_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            completion.latency = time.perf_counter() - start
+            completion.retries = attempt - 1
+            self.record_usage(tokens, completion)
+            return completion
+
+    def run_sync(self, request: Callable[[], Completion], tokens: int) -> Completion:
+        """
+        Blocking variant of run()
+
+        :param request: Function sending the request, called once per attempt
+        :param tokens: Estimated tokens of the request
+        :return: The completion
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            delay = self.get_admission_delay(tokens, attempt)
+            if delay:
+                time.sleep(delay)
+            start = time.perf_counter()
+            try:
+                completion = request()
+            except backend.BackendError as e:
+                delay = self.get_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            completion.latency = time.perf_counter() - start
+            completion.retries = attempt - 1
+            self.record_usage(tokens, completion)
+            return completion
+
+
+def get_scheduler() -> RateLimitScheduler:
+    """
+    Returns the scheduler used for all completions. Creates a scheduler without rate limits on first use if no
+    scheduler was set
+
+    :return: The current scheduler
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RateLimitScheduler()
+    return _scheduler
+
+
+def set_scheduler(rate_limit_scheduler: RateLimitScheduler):
+    """
+    Sets the scheduler used for all completions
+
+    :param rate_limit_scheduler: The new scheduler
+    """
+    global _scheduler
+    _scheduler = rate_limit_scheduler
@@ -0,0 +1,300 @@
+import dataclasses
+import os
+import random
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import get_context
+from typing import Iterable, Iterator
+
+import pandas as pd
+
+import backend
+import cache
+import checkpoint
+import classifier
+import data
+import logwriter
+import prefilter
+import scheduler
+import structured
+import taxonomy
+from util import ExperimentType
+
+
+@dataclass
+class RunConfig:
+    """
+    Settings of a classification run. The config is passed to every worker process, which applies it to its own
+    copy of the module-global classifier settings.
+
+    experiment_type: the experiment type as specified in util.ExperimentType
+    gpt_model: the GPT model
+    n_self_consistency: number of self-consistency paths
+    n_choice_shuffling: number of choice shuffling paths
+    with_definition: adds label definitions to the prompt if True
+    max_concurrency: maximum number of concurrent requests per process
+    chunk_size: number of products per chunk when reading the catalog
+    backend_name: the completion backend, one of openai, http, fake
+    base_url: base URL of an OpenAI-compatible server, used by the openai and http backends
+    requests_per_minute: request limit of the scheduler per process, None for no limit
+    tokens_per_minute: token limit of the scheduler per process, None for no limit
+    prometheus_metrics: also saves the run metrics as Prometheus textfile if True
+    log_level: minimum level of the log records, one of DEBUG, INFO, WARNING, ERROR
+    response_sample_rate: share of the log records that include full response texts
+    pack_size: number of products packed into one prompt
+    prefilter_paths: labeled csv files of the local prefilter index, None to classify all products with the LLM
+    prefilter_label_column: the column holding the paths in the prefilter files
+    prefilter_threshold: minimum confidence of the prefilter index for a product to skip the LLM
+    taxonomy_path: the taxonomy file, None for the Icecat taxonomy
+    two_stage: classifies into the second level first and then among its children if True
+    deduplication: classifies one representative of equivalent rows of a process if True
+    strip_variant_tokens: also treats variants like other colours or capacities as equivalent if True
+    shuffle_seed: seed of the choice shuffling orderings, None for a random seed shared by the shards of a run
+    per_row_shuffling: derives separate choice shuffling orderings for every row if True
+    profiling_mode: profiles the run with one of profiling.PROFILING_MODES, None to disable profiling
+    fast_mode: asks for answer-only structured outputs restricted to the labels if True
+    fast_max_tokens: maximum number of completion tokens per answer in the fast mode
+    result_store: root directory of the partitioned result store, None to save the results as csv files
+    max_samples_per_request: maximum number of samples requested at once for rounds sharing a prompt
+    temperature_buckets: number of buckets the self-consistency temperatures are grouped into, None for exact
+    temperatures
+    adaptive_voting: stops rows early once their leading path can't be overtaken if True
+    vote_confidence: stops rows once the leading path has this share of the votes, None to disable
+    vote_margin: stops rows once the leading path leads by this many votes, None to disable
+    min_votes: minimum number of votes before vote_confidence and vote_margin are checked
+    cache_path: SQLite file of the response cache shared by all processes, None to disable the cache
+    replay_only: answers from the response cache only and fails on cache misses if True
+    """
+    experiment_type: ExperimentType
+    gpt_model: str = "gpt-3.5-turbo"
+    n_self_consistency: int = 5
+    n_choice_shuffling: int = 5
+    with_definition: bool = False
+    max_concurrency: int = 8
+    chunk_size: int = data.CHUNK_SIZE
+    backend_name: str = "openai"
+    base_url: str = None
+    requests_per_minute: float = None
+    tokens_per_minute: float = None
+    prometheus_metrics: bool = False
+    log_level: str = "INFO"
+    response_sample_rate: float = 1.0
+    pack_size: int = 1
+    prefilter_paths: list[str] = None
+    prefilter_label_column: str = 'Category Path'
+    prefilter_threshold: float = 0.5
+    taxonomy_path: str = None
+    two_stage: bool = False
+    deduplication: bool = False
+    strip_variant_tokens: bool = False
+    shuffle_seed: int = None
+    per_row_shuffling: bool = False
+    profiling_mode: str = None
+    fast_mode: bool = False
+    fast_max_tokens: int = structured.FAST_MAX_TOKENS
+    result_store: str = None
+    max_samples_per_request: int = 8
+    temperature_buckets: int = None
+    adaptive_voting: bool = False
+    vote_confidence: float = None
+    vote_margin: int = None
+    min_votes: int = 1
+    cache_path: str = None
+    replay_only: bool = False
+
+    def apply(self):
+        """
+        Applies the settings to the classifier and sets the completion backend of the current process
+        """
+        classifier.set_gpt_model(self.gpt_model)
+        classifier.set_n_self_consistency(self.n_self_consistency)
+        classifier.set_n_choice_shuffling(self.n_choice_shuffling)
+        classifier.set_choice_shuffling(self.shuffle_seed, self.per_row_shuffling)
+        classifier.set_max_concurrency(self.max_concurrency)
+        classifier.set_max_samples_per_request(self.max_samples_per_request)
+        classifier.set_temperature_buckets(self.temperature_buckets)
+        classifier.set_adaptive_voting(self.adaptive_voting, self.vote_confidence, self.vote_margin, self.min_votes)
+        classifier.set_prometheus_metrics(self.prometheus_metrics)
+        classifier.set_pack_size(self.pack_size, self.experiment_type)
+        if self.taxonomy_path:
+            classifier.set_taxonomy(taxonomy.load_taxonomy(self.taxonomy_path))
+        classifier.set_two_stage(self.two_stage)
+        classifier.set_deduplication(self.deduplication, self.strip_variant_tokens)
+        classifier.set_profiling(self.profiling_mode)
+        classifier.set_fast_mode(self.fast_mode, self.fast_max_tokens)
+        classifier.set_result_store(self.result_store)
+        if self.prefilter_paths:
+            classifier.set_prefilter(prefilter.build_index(self.prefilter_paths, self.prefilter_label_column),
+                                     self.prefilter_threshold)
+        else:
+            classifier.set_prefilter(None)
+        logwriter.set_log_level(self.log_level)
+        logwriter.set_response_sample_rate(self.response_sample_rate)
+        scheduler.set_scheduler(scheduler.RateLimitScheduler(self.requests_per_minute, self.tokens_per_minute))
+        if self.backend_name == "openai":
+            backend.set_backend(backend.OpenAIBackend(base_url=self.base_url))
+        elif self.backend_name == "http":
+            backend.set_backend(backend.HTTPBackend(self.base_url))
+        elif self.backend_name == "fake":
+            backend.set_backend(backend.FakeBackend())
+        else:
+            raise ValueError(f"Unknown backend {self.backend_name}")
+        if self.cache_path or self.replay_only:
+            cache.enable_cache(self.cache_path or cache.CACHE_PATH, replay_only=self.replay_only)
+
+
+def get_shard(row_index, shards: int) -> int:
+    """
+    Assigns a row to a shard. The assignment only depends on the row index, so it is the same in every process and
+    on every machine
+
+    :param row_index: The index of the row
+    :param shards: Total number of shards
+    :return: The shard of the row, between 0 and shards - 1
+    """
+    return zlib.crc32(str(row_index).encode("utf-8")) % shards
+
+
+def iter_shard(chunks: Iterable[pd.DataFrame], shard_index: int, shards: int) -> Iterator[pd.DataFrame]:
+    """
+    Filters the chunks of a catalog to the rows of one shard
+
+    :param chunks: The chunks of the catalog
+    :param shard_index: The shard to be kept
+    :param shards: Total number of shards
+    :return: Iterator over the non-empty chunks of the shard
+    """
+    for chunk in chunks:
+        shard_chunk = chunk[[get_shard(i, shards) == shard_index for i in chunk.index]]
+        if len(shard_chunk):
+            yield shard_chunk
+
+
+def get_shard_path(output_path: str, shard_index: int, shards: int, extension: str = None) -> str:
+    """
+    Derives the path of a shard's output file from the path of the merged output
+
+    :param output_path: Path of the merged output file
+    :param shard_index: The shard
+    :param shards: Total number of shards
+    :param extension: Extension of the shard file, default: the extension of output_path
+    :return: Path of the shard file
+    """
+    stem, output_extension = os.path.splitext(output_path)
+    if shards == 1:
+        return stem + (extension or output_extension)
+    return f"{stem}_shard-{shard_index}-of-{shards}{extension or output_extension}"
+
+
+def run_shard(config: RunConfig, input_path: str, shard_index: int, shards: int, output_path: str,
+              resume: bool = False) -> str:
+    """
+    Classifies one shard of a catalog in the current process. Results and checkpoint are written next to the merged
+    output, so that a rerun with resume=True continues the shard. With a result store, the shard appends to the run
+    of the merged output instead, and no merge is needed
+
+    :param config: The run settings
+    :param input_path: Path of the catalog file
+    :param shard_index: The shard to be classified
+    :param shards: Total number of shards
+    :param output_path: Path of the merged output file
+    :param resume: Continues from the shard's checkpoint if True
+    :return: Path of the shard's results file, the store has the results instead if config.result_store is set
+    """
+    config.apply()
+    if config.result_store:
+        import resultstore
+        classifier.set_result_store(config.result_store, resultstore.get_run_id(output_path))
+    if shards > 1:
+        logwriter.set_log_name_suffix(f"_shard-{shard_index}-of-{shards}")
+    shard_path = get_shard_path(output_path, shard_index, shards)
+    checkpoint_path = get_shard_path(output_path, shard_index, shards, ".jsonl")
+    resume = resume and os.path.exists(checkpoint_path)
+    chunks = iter_shard(data.iter_products(input_path, config.chunk_size), shard_index, shards)
+    classifier.classify(config.experiment_type, chunks, config.with_definition, checkpoint_path, resume, shard_path)
+    return shard_path
+
+
+def merge_results(shard_paths: list[str], output_path: str, chunk_size: int = data.CHUNK_SIZE):
+    """
+    Merges the results files of all shards into one file. The files are copied chunk by chunk, rows are kept in
+    shard order
+
+    :param shard_paths: Paths of the shard results files
+    :param output_path: Path of the merged results file
+    :param chunk_size: Number of rows copied at once
+    """
+    directory = os.path.dirname(output_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    columns = None
+    with open(output_path, "w", encoding="utf-8", newline="") as output_file:
+        for shard_path in shard_paths:
+            if not os.path.exists(shard_path):
+                continue
+            for chunk in pd.read_csv(shard_path, chunksize=chunk_size, index_col=data.INDEX_COLUMN):
+                if columns is None:
+                    columns = list(chunk.columns)
+                    chunk.to_csv(output_file, index_label=data.INDEX_COLUMN)
+                else:
+                    chunk[columns].to_csv(output_file, header=False, index_label=data.INDEX_COLUMN)
+
+
+def get_shuffle_seed(output_path: str, shards: int, resume: bool = False) -> int:
+    """
+    Chooses the choice shuffling seed shared by the shards of a run without a fixed seed
+
+    :param output_path: Path of the merged output file
+    :param shards: Total number of shards
+    :param resume: Returns the seed recorded in the shard checkpoints, if any, so the orderings don't change
+    :return: The seed
+    """
+    if resume:
+        for shard_index in range(shards):
+            specification = checkpoint.load_specification(get_shard_path(output_path, shard_index, shards, ".jsonl"))
+            if specification and specification.get('Shuffle Seed') is not None:
+                return specification['Shuffle Seed']
+    return random.randrange(2 ** 32)
+
+
+def run_sharded(config: RunConfig, input_path: str, output_path: str, shards: int, workers: int = None,
+                resume: bool = False) -> str:
+    """
+    Classifies a catalog in shards, each shard in a separate worker process, and merges the shard results. A single
+    shard is classified in the current process. Shards writing to a result store aren't merged. If a shard fails,
+    the other shards are still finished, but nothing is merged, so a rerun with resume=True continues the failed
+    shards
+
+    :param config: The run settings
+    :param input_path: Path of the catalog file
+    :param output_path: Path of the merged results file
+    :param shards: Number of shards
+    :param workers: Number of worker processes, default: one per shard
+    :param resume: Continues every shard from its checkpoint if True
+    :return: Path of the merged results file
+    """
+    if shards == 1:
+        return run_shard(config, input_path, 0, 1, output_path, resume)
+    if config.shuffle_seed is None and config.experiment_type in (ExperimentType.CHOICE_SHUFFLING,
+                                                                  ExperimentType.COMBINED):
+        # without a fixed seed every process would draw its own, so the shards share one seed
+        config = dataclasses.replace(config, shuffle_seed=get_shuffle_seed(output_path, shards, resume))
+    workers = workers or shards
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+        futures = [executor.submit(run_shard, config, input_path, shard_index, shards, output_path, resume)
+                   for shard_index in range(shards)]
+        shard_paths = []
+        failures = []
+        for shard_index, future in enumerate(futures):
+            try:
+                shard_paths.append(future.result())
+            except Exception as e:
+                failures.append(f"shard {shard_index}: {e!r}")
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {shards} shards failed, the results weren't merged, rerun with "
+                           f"--resume to continue them: {'; '.join(failures)}")
+    if config.result_store:
+        return output_path
+    merge_results(shard_paths, output_path, config.chunk_size)
+    return output_path
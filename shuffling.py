@@ -0,0 +1,66 @@
+import random
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class LabelOrdering:
+    """
+    Order of the label pools in the prompt of a choice shuffling round
+
+    second_level_labels: the second-level labels in permuted order
+    third_level_labels: the third-level labels in permuted order
+    """
+    second_level_labels: tuple[str, ...]
+    third_level_labels: tuple[str, ...]
+
+
+class PermutationRegistry:
+    """
+    Label orderings of the choice shuffling rounds. Either a fixed set of orderings is shared by all rows, or every
+    row gets its own orderings. Orderings are derived from the seed, the row key and the ordering index, so a run is
+    reproduced exactly by its seed and memory doesn't grow with the number of rows. The orderings are tuples, so their
+    compiled prompts are looked up in data.compile_label_prompt() instead of being rendered again.
+    """
+
+    def __init__(self, second_level_labels: list[str], third_level_labels: list[str], n_orderings: int,
+                 seed: int = None, per_row: bool = False):
+        """
+        :param second_level_labels: The second-level labels in original order
+        :param third_level_labels: The third-level labels in original order
+        :param n_orderings: Number of orderings per row
+        :param seed: Seed of the orderings, default: a random seed
+        :param per_row: Derives separate orderings for every row if True, shares one set of orderings if False
+        """
+        self.second_level_labels = tuple(second_level_labels)
+        self.third_level_labels = tuple(third_level_labels)
+        self.n_orderings = n_orderings
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.per_row = per_row
+        self.orderings = [self.create_ordering(j) for j in range(n_orderings)]
+
+    def create_ordering(self, ordering_index: int, row_key=None) -> LabelOrdering:
+        """
+        Derives an ordering. The same arguments always return the same ordering, in every process
+
+        :param ordering_index: The index of the ordering within the row
+        :param row_key: The key of the row, e.g. its index, None for the shared orderings
+        :return: The ordering
+        """
+        # string seeds are hashed with SHA-512, so they don't depend on the hash randomization of the process
+        random_generator = random.Random(f"{self.seed}|{row_key}|{ordering_index}")
+        second_level_labels = list(self.second_level_labels)
+        third_level_labels = list(self.third_level_labels)
+        random_generator.shuffle(second_level_labels)
+        random_generator.shuffle(third_level_labels)
+        return LabelOrdering(tuple(second_level_labels), tuple(third_level_labels))
+
+    def get_orderings(self, row_key=None) -> list[LabelOrdering]:
+        """
+        Returns the orderings of a row
+
+        :param row_key: The key of the row, e.g. its index. Ignored unless orderings are derived per row
+        :return: n_orderings orderings
+        """
+        if not self.per_row or row_key is None:
+            return self.orderings
+        return [self.create_ordering(j, row_key) for j in range(self.n_orderings)]
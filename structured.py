@@ -0,0 +1,59 @@
+import functools
+import json
+
+import taxonomy
+
+# Maximum number of completion tokens of an answer-only response, enough for the JSON object of the longest path
+FAST_MAX_TOKENS = 60
+# Number of label orders whose response formats are kept in memory
+RESPONSE_FORMAT_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=RESPONSE_FORMAT_CACHE_SIZE)
+def get_response_format(second_level_labels: tuple[str, ...], third_level_labels: tuple[str, ...],
+                        label_taxonomy: taxonomy.Taxonomy) -> dict:
+    """
+    Creates the structured output format of the fast mode. The answer is a JSON object whose fields are restricted
+    to the labels, with one alternative per second-level category that only allows its own children, so every
+    answer is a valid path of the taxonomy. The alternatives and enums keep the order of the prompt, so choice
+    shuffling also shuffles the structured output. The result is cached per label order and must not be modified.
+
+    :param second_level_labels: Tuple of second-level categories, either in original or in permuted order
+    :param third_level_labels: Tuple of third-level categories, either in original or in permuted order
+    :param label_taxonomy: The taxonomy defining the labels
+    :return: The response_format parameter of the chat completion request
+    """
+    third_level_positions = {label: position for position, label in enumerate(third_level_labels)}
+    alternatives = []
+    for second_level_label in second_level_labels:
+        children = sorted(label_taxonomy.get_children(second_level_label),
+                          key=lambda label: third_level_positions.get(label, len(third_level_positions)))
+        alternatives.append({
+            "type": "object",
+            "properties": {"second_level_category": {"type": "string", "enum": [second_level_label]},
+                           "third_level_category": {"type": "string", "enum": children}},
+            "required": ["second_level_category", "third_level_category"],
+            "additionalProperties": False})
+    return {"type": "json_schema",
+            "json_schema": {"name": "category_path", "strict": True,
+                            "schema": {"type": "object",
+                                       "properties": {"category": {"anyOf": alternatives}},
+                                       "required": ["category"],
+                                       "additionalProperties": False}}}
+
+
+def extract_structured_path(response_string: str) -> str | int:
+    """
+    Reads the category path from a structured response of the fast mode. The response is decoded as JSON and the
+    path is looked up in the taxonomy, without searching the text for a path
+
+    :param response_string: String value of the response message
+    :return: The category path, or -1 if the response isn't a JSON object holding a valid path
+    """
+    try:
+        category = json.loads(response_string)["category"]
+        path = taxonomy.PATH_SEPARATOR.join([taxonomy.get_taxonomy().root.name, category["second_level_category"],
+                                             category["third_level_category"]])
+    except (ValueError, KeyError, TypeError):
+        return -1
+    return path if taxonomy.get_taxonomy().is_path(path) else -1
@@ -0,0 +1,151 @@
+import json
+import os
+from dataclasses import dataclass, field
+
+import matcher
+
+# Category tree as specified by Icecat, with a definition for each label
+TAXONOMY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taxonomy.json')
+
+PATH_SEPARATOR = ">"
+
+_taxonomy = None
+
+
+@dataclass(eq=False)
+class TaxonomyNode:
+    """
+    Category of the taxonomy
+
+    name: the label of the category
+    definition: the definition of the label, empty if the taxonomy file doesn't define it
+    children: the subcategories
+    """
+    name: str
+    definition: str = ""
+    children: list["TaxonomyNode"] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, node: dict) -> "TaxonomyNode":
+        return cls(node["name"], node.get("definition", ""),
+                   [cls.from_dict(child) for child in node.get("children", [])])
+
+
+class Taxonomy:
+    """
+    Three-level category hierarchy, e.g. Computers & Electronics>Data Input Devices>Keyboards. The root is the
+    first level, its children form the second-level pool and their children the third-level pool. Only paths along
+    the tree are valid, and the path matchers are compiled once per taxonomy.
+    """
+
+    def __init__(self, root: TaxonomyNode, third_level_order: list[str] = None):
+        """
+        :param root: The first-level category
+        :param third_level_order: Order of the third-level pool in the prompts, default: the order of the tree
+        """
+        self.root = root
+        self.nodes = {child.name: child for child in root.children}
+        self.definitions = {}
+        for second_level_node in root.children:
+            self.definitions.setdefault(second_level_node.name, second_level_node.definition)
+            for third_level_node in second_level_node.children:
+                self.definitions.setdefault(third_level_node.name, third_level_node.definition)
+        self.second_level_labels = [child.name for child in root.children]
+        self.third_level_labels = list(dict.fromkeys(third_level_node.name for second_level_node in root.children
+                                                     for third_level_node in second_level_node.children))
+        if third_level_order is not None:
+            if sorted(third_level_order) != sorted(self.third_level_labels):
+                raise ValueError("The third-level order must list every third-level label exactly once")
+            self.third_level_labels = list(third_level_order)
+        self.path_matchers = {}
+        self.path_set = None
+
+    def is_path(self, path: str) -> bool:
+        """
+        Checks whether a path is a valid full path of the taxonomy
+
+        :param path: The path, e.g. Computers & Electronics>Data Input Devices>Keyboards
+        :return: True if the path is valid
+        """
+        if self.path_set is None:
+            self.path_set = frozenset(self.get_paths())
+        return path in self.path_set
+
+    def get_children(self, second_level_label: str) -> list[str]:
+        """
+        Lists the third-level labels of a second-level category
+
+        :param second_level_label: The second-level label
+        :return: The labels of its children
+        """
+        return [child.name for child in self.nodes[second_level_label].children]
+
+    def get_paths(self, second_level_label: str = None) -> list[str]:
+        """
+        Lists the valid category paths
+
+        :param second_level_label: Only lists the paths below this second-level label if set
+        :return: The full paths
+        """
+        second_level_labels = [second_level_label] if second_level_label is not None else self.second_level_labels
+        return [PATH_SEPARATOR.join([self.root.name, label_2, label_3])
+                for label_2 in second_level_labels for label_3 in self.get_children(label_2)]
+
+    def get_path_matcher(self, second_level_label: str = None) -> matcher.PathMatcher:
+        """
+        Returns the matcher of the valid category paths. It is compiled on first use
+
+        :param second_level_label: Only matches the paths below this second-level label if set
+        :return: The path matcher
+        """
+        if second_level_label not in self.path_matchers:
+            self.path_matchers[second_level_label] = matcher.PathMatcher(self.get_paths(second_level_label))
+        return self.path_matchers[second_level_label]
+
+    def get_second_level_matcher(self) -> matcher.PathMatcher:
+        """
+        Returns the matcher of the second-level paths, e.g. Computers & Electronics>Data Input Devices
+
+        :return: The path matcher
+        """
+        if "" not in self.path_matchers:
+            self.path_matchers[""] = matcher.PathMatcher([PATH_SEPARATOR.join([self.root.name, label])
+                                                          for label in self.second_level_labels])
+        return self.path_matchers[""]
+
+
+def load_taxonomy(path: str = TAXONOMY_PATH) -> Taxonomy:
+    """
+    Loads a taxonomy from a JSON file. Every node has a name, an optional definition and optional children. The root
+    may list the prompt order of the third-level pool as third_level_order, the Icecat taxonomy keeps the order of
+    the original prompts this way
+
+    :param path: Path of the taxonomy file
+    :return: The taxonomy
+    """
+    with open(path, encoding="utf-8") as taxonomy_file:
+        root = json.load(taxonomy_file)
+    return Taxonomy(TaxonomyNode.from_dict(root), root.get("third_level_order"))
+
+
+def get_taxonomy() -> Taxonomy:
+    """
+    Returns the taxonomy used for prompts and path extraction. Loads the Icecat taxonomy on first use if no taxonomy
+    was set
+
+    :return: The current taxonomy
+    """
+    global _taxonomy
+    if _taxonomy is None:
+        _taxonomy = load_taxonomy()
+    return _taxonomy
+
+
+def set_taxonomy(category_taxonomy: Taxonomy):
+    """
+    Sets the taxonomy used for prompts and path extraction
+
+    :param category_taxonomy: The new taxonomy
+    """
+    global _taxonomy
+    _taxonomy = category_taxonomy
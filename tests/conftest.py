@@ -0,0 +1,76 @@
+import os
+import sys
+
+import pytest
+
+# the modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backend  # noqa: E402
+import data  # noqa: E402
+
+
+@pytest.fixture
+def run_directory(tmp_path, monkeypatch):
+    """
+    Runs a test in an empty directory, so the Results and Logs of a run are written there
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def install_fake_backend(monkeypatch):
+    """
+    Returns a function installing a FakeBackend with the given responder for the duration of the test
+    """
+    def install(responder=backend.random_path_responder) -> backend.FakeBackend:
+        fake_backend = backend.FakeBackend(responder)
+        monkeypatch.setattr(backend, "_backend", fake_backend)
+        return fake_backend
+    return install
+
+
+class FailingBackend(backend.FakeBackend):
+    """
+    FakeBackend failing its first requests with a backend error
+    """
+
+    def __init__(self, failures: int, error: backend.BackendError):
+        super().__init__()
+        self.failures = failures
+        self.error = error
+        self.attempts = 0
+
+    def fail(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise self.error
+
+    def complete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                 **params) -> backend.Completion:
+        self.fail()
+        return super().complete(model, messages, temperature, n, **params)
+
+    async def acomplete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                        **params) -> backend.Completion:
+        self.fail()
+        return await super().acomplete(model, messages, temperature, n, **params)
+
+
+@pytest.fixture
+def failing_backend():
+    """
+    Returns a function creating a FakeBackend that fails its first requests, by default with a 429 response
+    """
+    def create(failures: int = 1, error: backend.BackendError = None) -> FailingBackend:
+        return FailingBackend(failures, error or backend.RateLimitError("HTTP 429", 429))
+    return create
+
+
+@pytest.fixture
+def products():
+    """
+    The first products of the test dataset, with their correct paths
+    """
+    return data.load_test_dataset().iloc[:8]
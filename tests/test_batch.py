@@ -0,0 +1,89 @@
+import json
+import os
+
+import batch
+from util import ExperimentType
+
+
+def read_lines(paths: list[str]) -> list[dict]:
+    lines = []
+    for path in paths:
+        with open(path, encoding="utf-8") as batch_file:
+            lines += [json.loads(line) for line in batch_file]
+    return lines
+
+
+def write_output(path: str, batch_requests: list[dict], answer) -> str:
+    """
+    Writes a batch output file answering every request with answer(batch_request), None answers fail the request
+    """
+    with open(path, "w", encoding="utf-8") as output_file:
+        for batch_request in batch_requests:
+            response_string = answer(batch_request)
+            if response_string is None:
+                entry = {"custom_id": batch_request["custom_id"], "response": None,
+                         "error": {"code": "server_error", "message": "failed"}}
+            else:
+                entry = {"custom_id": batch_request["custom_id"], "error": None,
+                         "response": {"status_code": 200, "body": {"choices": [
+                             {"message": {"role": "assistant", "content": response_string}}]}}}
+            output_file.write(json.dumps(entry) + "\n")
+    return path
+
+
+def test_custom_id_round_trip():
+    assert batch.parse_custom_id(batch.get_custom_id(12, "3,1", 2)) == ("12", "3,1", 2)
+    assert batch.parse_custom_id(batch.get_custom_id("a|b", None)) == ("a|b", None, 1)
+
+
+def test_write_batch_files_splits_at_limits(tmp_path):
+    batch_requests = [{"custom_id": str(i), "body": {"text": "x" * 50}} for i in range(5)]
+    paths = batch.write_batch_files(batch_requests, str(tmp_path / "batch" / "input"), max_requests=2)
+    assert [os.path.basename(path) for path in paths] == ["input_000.jsonl", "input_001.jsonl", "input_002.jsonl"]
+    assert read_lines(paths) == batch_requests
+    assert len(batch.write_batch_files(batch_requests, str(tmp_path / "small"), max_bytes=100)) == 5
+
+
+def test_export_and_ingest_with_follow_up_batch(tmp_path, products):
+    paths = dict(zip(products['Title'], products['Category Path']))
+    request_paths = batch.export_batch(ExperimentType.SELF_CONSISTENCY, products, str(tmp_path / "input"))
+    batch_requests = read_lines(request_paths)
+    assert len(batch_requests) == len(products) * 5
+    assert len({batch_request["custom_id"] for batch_request in batch_requests}) == len(batch_requests)
+
+    def get_path(batch_request: dict) -> str:
+        prompt = batch_request["body"]["messages"][-1]["content"]
+        return next(path for title, path in paths.items() if f"\"{title}\"" in prompt)
+
+    # the first row gets an answer without a path, the second row a failed request
+    invalid_id = batch.get_custom_id(products.index[0], "2")
+    failed_id = batch.get_custom_id(products.index[1], "4")
+
+    def answer(batch_request: dict) -> str | None:
+        if batch_request["custom_id"] == invalid_id:
+            return "I don't know"
+        if batch_request["custom_id"] == failed_id:
+            return None
+        return f"The path is {get_path(batch_request)}"
+
+    output_paths = [write_output(str(tmp_path / "output_000.jsonl"), batch_requests, answer)]
+    results, followup_paths = batch.ingest_batch(ExperimentType.SELF_CONSISTENCY, products, output_paths,
+                                                 request_paths, str(tmp_path / "followup"))
+    assert list(results.index) == list(products.index)
+    assert results['Predicted Path'].iloc[:2].isna().all()
+    assert list(results['Predicted Path'].iloc[2:]) == list(products['Category Path'].iloc[2:])
+
+    # the follow-up batch repeats both requests as second attempts
+    followup_requests = read_lines(followup_paths)
+    assert sorted(batch_request["custom_id"] for batch_request in followup_requests) == \
+        sorted([batch.get_custom_id(products.index[0], "2", 2), batch.get_custom_id(products.index[1], "4", 2)])
+    originals = {batch_request["custom_id"]: batch_request for batch_request in batch_requests}
+    for batch_request in followup_requests:
+        assert batch_request["body"] == originals[batch_request["custom_id"][:-1] + "1"]["body"]
+
+    output_paths.append(write_output(str(tmp_path / "output_001.jsonl"), followup_requests,
+                                     lambda batch_request: f"The path is {get_path(batch_request)}"))
+    results, followup_paths = batch.ingest_batch(ExperimentType.SELF_CONSISTENCY, products, output_paths,
+                                                 request_paths + followup_paths, str(tmp_path / "followup_2"))
+    assert followup_paths == []
+    assert list(results['Predicted Path']) == list(products['Category Path'])
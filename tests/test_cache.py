@@ -0,0 +1,81 @@
+import pytest
+
+import backend
+import cache
+import classifier
+import scheduler
+from util import ExperimentType
+
+MESSAGES = [{"role": "user", "content": "Classify the product"}]
+
+
+def test_create_key_distinguishes_requests():
+    key = cache.ResponseCache.create_key("model", MESSAGES, 0.5, 1, {"max_tokens": 10, "seed": 1})
+    assert key == cache.ResponseCache.create_key("model", MESSAGES, 0.5, 1, {"seed": 1, "max_tokens": 10})
+    assert key != cache.ResponseCache.create_key("model", MESSAGES, 0.7, 1, {"max_tokens": 10, "seed": 1})
+    assert key != cache.ResponseCache.create_key("model", MESSAGES, 0.5, 2, {"max_tokens": 10, "seed": 1})
+    assert key != cache.ResponseCache.create_key("other", MESSAGES, 0.5, 1, {"max_tokens": 10, "seed": 1})
+    assert key != cache.ResponseCache.create_key("model", MESSAGES, 0.5, 1, {"max_tokens": 10, "seed": 1}, 1)
+
+
+def test_repeated_requests_are_replayed_in_order(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    fake_backend = backend.FakeBackend()
+    recording = cache.CachingBackend(fake_backend, cache.ResponseCache(path))
+    recorded = [recording.complete("model", MESSAGES).texts for _ in range(3)]
+    recording.close()
+
+    replaying = cache.CachingBackend(backend.FakeBackend(), cache.ResponseCache(path), replay_only=True)
+    assert [replaying.complete("model", MESSAGES).texts for _ in range(3)] == recorded
+    with pytest.raises(cache.CacheMissError):
+        replaying.complete("model", MESSAGES)
+    # a new run starts with the first occurrence again
+    replaying.begin_run()
+    assert replaying.complete("model", MESSAGES).texts == recorded[0]
+    assert fake_backend.calls == 3
+
+
+def test_replay_only_fails_on_misses(tmp_path):
+    replaying = cache.CachingBackend(backend.FakeBackend(), cache.ResponseCache(str(tmp_path / "cache.sqlite")),
+                                     replay_only=True)
+    with pytest.raises(cache.CacheMissError):
+        replaying.complete("model", MESSAGES)
+    assert replaying.backend.calls == 0
+
+
+def test_failed_request_keeps_its_occurrence(tmp_path, failing_backend):
+    path = str(tmp_path / "cache.sqlite")
+    recording = cache.CachingBackend(failing_backend(1), cache.ResponseCache(path))
+    with pytest.raises(backend.RateLimitError):
+        recording.complete("model", MESSAGES)
+    # repeating the failed request records it under the first occurrence
+    recorded = recording.complete("model", MESSAGES).texts
+    recording.close()
+
+    replaying = cache.CachingBackend(backend.FakeBackend(), cache.ResponseCache(path), replay_only=True)
+    assert replaying.complete("model", MESSAGES).texts == recorded
+
+
+def test_replay_of_a_run_recorded_with_a_429(run_directory, failing_backend, products, monkeypatch):
+    path = str(run_directory / "cache.sqlite")
+    monkeypatch.setattr(scheduler, "_scheduler", scheduler.RateLimitScheduler(base_delay=0.0))
+    monkeypatch.setattr(backend, "_backend", failing_backend(1))
+    recording = cache.enable_cache(path)
+    recorded = classifier.classify(ExperimentType.SELF_CONSISTENCY, products.copy())
+    recording.close()
+
+    monkeypatch.setattr(backend, "_backend", backend.FakeBackend())
+    replaying = cache.enable_cache(path, replay_only=True)
+    replayed = classifier.classify(ExperimentType.SELF_CONSISTENCY, products.copy())
+    assert replaying.backend.calls == 0
+    assert list(replayed['Predicted Path']) == list(recorded['Predicted Path'])
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    response_cache = cache.ResponseCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    for key in ["a", "b", "c"]:
+        response_cache.put(key, backend.Completion(texts=[key]))
+    assert response_cache.get("a") is None
+    assert response_cache.get("c").texts == ["c"]
+    assert response_cache.stats()['Entries'] == 2
+    assert response_cache.stats()['Evictions'] == 1
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import checkpoint
+import classifier
+from util import ExperimentType
+
+SPECIFICATION = {"Experiment Type": "baseline"}
+
+
+def test_checkpoint_round_trip(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    writer = checkpoint.CheckpointWriter(path, SPECIFICATION)
+    writer.write(0, {"Predicted Path": "a>b>c"})
+    writer.write(1, {"Predicted Path": "a>b>d"})
+    writer.close()
+    assert checkpoint.load_checkpoint(path, SPECIFICATION) == {0: {"Predicted Path": "a>b>c"},
+                                                               1: {"Predicted Path": "a>b>d"}}
+
+
+def test_load_checkpoint_skips_truncated_line(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    path.write_text(json.dumps({"specification": SPECIFICATION}) + "\n" +
+                    json.dumps({"index": 0, "record": {"Predicted Path": "a>b>c"}}) + "\n" +
+                    '{"index": 1, "rec', encoding="utf-8")
+    assert checkpoint.load_checkpoint(str(path)) == {0: {"Predicted Path": "a>b>c"}}
+    # a resumed writer terminates the truncated line before appending
+    writer = checkpoint.CheckpointWriter(str(path), SPECIFICATION, resume=True)
+    writer.write(2, {"Predicted Path": "a>b>d"})
+    writer.close()
+    assert set(checkpoint.load_checkpoint(str(path))) == {0, 2}
+
+
+def test_load_checkpoint_rejects_other_specification(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    checkpoint.CheckpointWriter(path, SPECIFICATION).close()
+    with pytest.raises(ValueError):
+        checkpoint.load_checkpoint(path, {"Experiment Type": "combined"})
+
+
+def test_new_run_moves_existing_checkpoint(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    writer = checkpoint.CheckpointWriter(path, SPECIFICATION)
+    writer.write(0, {"Predicted Path": "a>b>c"})
+    writer.close()
+    other_specification = {"Experiment Type": "combined"}
+    checkpoint.CheckpointWriter(path, other_specification).close()
+    assert checkpoint.load_checkpoint(path, other_specification) == {}
+    assert checkpoint.load_checkpoint(checkpoint.get_previous_checkpoint_path(path), SPECIFICATION) == \
+        {0: {"Predicted Path": "a>b>c"}}
+
+
+def test_resume_skips_finished_rows(run_directory, install_fake_backend, products):
+    checkpoint_path = str(run_directory / "checkpoint.jsonl")
+    install_fake_backend()
+    first_results = classifier.classify(ExperimentType.BASELINE, products.copy(), checkpoint_path=checkpoint_path)
+
+    fake_backend = install_fake_backend()
+    resumed_results = classifier.classify(ExperimentType.BASELINE, products.copy(), checkpoint_path=checkpoint_path,
+                                          resume=True)
+    assert fake_backend.calls == 0
+    assert list(resumed_results['Predicted Path']) == list(first_results['Predicted Path'])
+
+
+def test_resume_classifies_remaining_rows(run_directory, install_fake_backend, products):
+    checkpoint_path = str(run_directory / "checkpoint.jsonl")
+    install_fake_backend()
+    classifier.classify(ExperimentType.BASELINE, products.iloc[:5].copy(), checkpoint_path=checkpoint_path)
+
+    fake_backend = install_fake_backend()
+    results = classifier.classify(ExperimentType.BASELINE, products.copy(), checkpoint_path=checkpoint_path,
+                                  resume=True)
+    assert fake_backend.calls == len(products) - 5
+    assert results['Predicted Path'].notna().all()
+    assert len(checkpoint.load_checkpoint(checkpoint_path)) == len(products)
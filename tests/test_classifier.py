@@ -0,0 +1,52 @@
+import asyncio
+
+import backend
+import classifier
+from util import ExperimentType
+
+
+class ConcurrencyProbe(backend.FakeBackend):
+    """
+    FakeBackend answering with the correct path of a product, tracking the number of requests in flight
+    """
+
+    def __init__(self, paths: dict[str, str]):
+        super().__init__(lambda messages, temperature: next(path for title, path in paths.items()
+                                                             if f"\"{title}\"" in messages[-1]["content"]))
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def acomplete(self, model: str, messages: list[dict], temperature: float = 0.5, n: int = 1,
+                        **params) -> backend.Completion:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            return self.create_completion(messages, temperature, n, params)
+        finally:
+            self.in_flight -= 1
+
+
+def install_probe(products, monkeypatch) -> ConcurrencyProbe:
+    probe = ConcurrencyProbe(dict(zip(products['Title'], products['Category Path'])))
+    monkeypatch.setattr(backend, "_backend", probe)
+    return probe
+
+
+def test_requests_run_concurrently_up_to_the_limit(run_directory, products, monkeypatch):
+    probe = install_probe(products, monkeypatch)
+    monkeypatch.setattr(classifier, "MAX_CONCURRENCY", 3)
+    results = classifier.classify(ExperimentType.SELF_CONSISTENCY, products.copy())
+    assert probe.max_in_flight == 3
+    assert probe.calls == len(products) * classifier.N_SELF_CONSISTENCY
+    # results are assigned to their rows regardless of the completion order
+    assert list(results.index) == list(products.index)
+    assert list(results['Predicted Path']) == list(products['Category Path'])
+
+
+def test_max_concurrency_one_classifies_sequentially(run_directory, products, monkeypatch):
+    probe = install_probe(products, monkeypatch)
+    monkeypatch.setattr(classifier, "MAX_CONCURRENCY", 1)
+    results = classifier.classify(ExperimentType.BASELINE, products.copy())
+    assert probe.max_in_flight == 1
+    assert list(results['Predicted Path']) == list(products['Category Path'])
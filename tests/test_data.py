@@ -0,0 +1,93 @@
+import pandas
+import pytest
+
+import checkpoint
+import classifier
+import data
+from util import ExperimentType
+
+
+def test_result_accumulator_joins_in_row_order(products):
+    results = data.ResultAccumulator(['Predicted Path', 'Response'])
+    # rows finish in any order, and not every row has every column
+    results.add(products.index[2], {'Predicted Path': "a>b>c", 'Response': "the path is a>b>c"})
+    results.add(products.index[0], {'Predicted Path': "a>b>d"})
+    assert len(results) == 2
+    joined = results.join(products.iloc[:3])
+    assert list(joined.index) == list(products.index[:3])
+    assert list(joined.columns) == list(products.columns) + ['Predicted Path', 'Response']
+    assert list(joined['Predicted Path'].fillna("missing")) == ["a>b>d", "missing", "a>b>c"]
+    assert list(joined['Response'].fillna("missing")) == ["missing", "missing", "the path is a>b>c"]
+
+
+def test_result_accumulator_dataframe():
+    results = data.ResultAccumulator(['Predicted Path', 'Path Round 0'])
+    results.add(5, {'Path Round 0': "a>b>c", 'Predicted Path': "a>b>c", 'Other': 1})
+    dataframe = results.to_dataframe()
+    assert list(dataframe.index) == [5]
+    assert list(dataframe.columns) == ['Predicted Path', 'Path Round 0']
+    assert dataframe.loc[5, 'Path Round 0'] == "a>b>c"
+
+
+def write_catalog(catalog: pandas.DataFrame, path: str):
+    if path.endswith(".csv"):
+        catalog.to_csv(path, index_label=data.INDEX_COLUMN)
+    elif path.endswith(".jsonl"):
+        catalog.reset_index().to_json(path, orient="records", lines=True)
+    else:
+        catalog.reset_index().to_parquet(path)
+
+
+@pytest.mark.parametrize("file_name", ["catalog.csv", "catalog.jsonl", "catalog.parquet"])
+def test_iter_products_keeps_rows_and_order(tmp_path, products, file_name):
+    if file_name.endswith(".parquet"):
+        pytest.importorskip("pyarrow")
+    path = str(tmp_path / file_name)
+    write_catalog(products, path)
+    chunks = list(data.iter_products(path, chunk_size=3))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 2]
+    catalog = pandas.concat(chunks)
+    assert list(catalog.index) == list(products.index)
+    assert list(catalog['Title']) == list(products['Title'])
+    assert list(catalog['Brand']) == list(products['Brand'])
+
+
+def test_iter_products_numbers_rows_without_index(tmp_path, products):
+    path = str(tmp_path / "catalog.csv")
+    products.to_csv(path, index=False)
+    assert [list(chunk.index) for chunk in data.iter_products(path, chunk_size=3)] == [[0, 1, 2], [3, 4, 5], [6, 7]]
+
+
+def test_iter_products_rejects_unknown_formats(tmp_path):
+    with pytest.raises(ValueError):
+        next(data.iter_products(str(tmp_path / "catalog.xlsx")))
+
+
+@pytest.mark.parametrize("file_name", ["catalog.csv", "catalog.jsonl", "catalog.parquet"])
+def test_resumed_streaming_run_restores_earlier_rows(run_directory, install_fake_backend, products, file_name):
+    if file_name.endswith(".parquet"):
+        pytest.importorskip("pyarrow")
+    path = str(run_directory / file_name)
+    write_catalog(products, path)
+    checkpoint_path = str(run_directory / "checkpoint.jsonl")
+    install_fake_backend()
+    classifier.classify(ExperimentType.BASELINE, data.iter_products(path, chunk_size=3),
+                        checkpoint_path=checkpoint_path, results_csv_name=str(run_directory / "first.csv"))
+    first_results = pandas.read_csv(run_directory / "first.csv", index_col=data.INDEX_COLUMN)
+
+    # the interrupted run had finished the first five rows
+    with open(checkpoint_path, encoding="utf-8") as checkpoint_file:
+        lines = checkpoint_file.readlines()
+    with open(checkpoint_path, "w", encoding="utf-8") as checkpoint_file:
+        checkpoint_file.writelines(lines[:6])
+    finished_rows = list(checkpoint.load_checkpoint(checkpoint_path))
+    fake_backend = install_fake_backend()
+    results_path = str(run_directory / "resumed.csv")
+    assert classifier.classify(ExperimentType.BASELINE, data.iter_products(path, chunk_size=3),
+                               checkpoint_path=checkpoint_path, resume=True, results_csv_name=results_path) is None
+    resumed_results = pandas.read_csv(results_path, index_col=data.INDEX_COLUMN)
+    assert fake_backend.calls == len(products) - 5
+    assert list(resumed_results.index) == list(products.index)
+    assert list(resumed_results.loc[finished_rows, 'Predicted Path']) == \
+        list(first_results.loc[finished_rows, 'Predicted Path'])
+    assert resumed_results['Predicted Path'].notna().all()
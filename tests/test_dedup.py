@@ -0,0 +1,64 @@
+import pandas
+
+import classifier
+import dedup
+from util import ExperimentType
+
+
+def test_canonicalize():
+    assert dedup.canonicalize("  ASUS Rog-Gladius   Mouse! ") == "asus rog gladius mouse"
+    # compatibility characters like full-width letters are normalized
+    assert dedup.canonicalize("ＡＳＵＳ mouse") == "asus mouse"
+    assert dedup.canonicalize(float("nan")) == ""
+
+
+def test_canonicalize_strips_variant_tokens():
+    title = "Logitech M185 Mouse Black 2 pack 1000 mAh 15.6\""
+    assert dedup.canonicalize(title) == "logitech m185 mouse black 2 pack 1000 mah 15 6"
+    assert dedup.canonicalize(title, strip_variants=True) == "logitech m185 mouse"
+    assert dedup.get_product_key("Mouse Red", "Logitech", True) == dedup.get_product_key("mouse, BLUE", "LOGITECH",
+                                                                                         True)
+    assert dedup.get_product_key("Mouse Red", "Logitech") != dedup.get_product_key("Mouse Blue", "Logitech")
+
+
+def test_deduplicator_fans_out_within_and_across_chunks():
+    deduplicator = dedup.Deduplicator()
+    representatives, known_duplicates = deduplicator.split([(0, "Mouse", "Logitech"), (1, "mouse.", "LOGITECH"),
+                                                            (2, "Keyboard", "Cherry")])
+    assert representatives == [(0, "Mouse", "Logitech"), (2, "Keyboard", "Cherry")]
+    assert known_duplicates == []
+    assert deduplicator.finish(0, {'Predicted Path': "a>b>c"}) == [1]
+    assert deduplicator.finish(2, {'Predicted Path': "a>b>d"}) == []
+    # a later chunk finishes duplicates of classified groups without classifying them
+    representatives, known_duplicates = deduplicator.split([(3, "MOUSE", "logitech"), (4, "Monitor", "Dell")])
+    assert representatives == [(4, "Monitor", "Dell")]
+    assert known_duplicates == [(3, 0, {'Predicted Path': "a>b>c"})]
+    assert deduplicator.duplicates == 2
+
+
+def test_deduplicator_forgets_least_recently_used_groups():
+    deduplicator = dedup.Deduplicator(max_remembered_groups=1)
+    for i, title in enumerate(["Mouse", "Keyboard"]):
+        deduplicator.split([(i, title, "Brand")])
+        deduplicator.finish(i, {'Predicted Path': title})
+    representatives, known_duplicates = deduplicator.split([(2, "Mouse", "Brand"), (3, "Keyboard", "Brand")])
+    assert representatives == [(2, "Mouse", "Brand")]
+    assert [(i, representative) for i, representative, _ in known_duplicates] == [(3, 1)]
+
+
+def test_duplicates_get_the_results_of_their_representative(run_directory, install_fake_backend, products,
+                                                            monkeypatch):
+    duplicates = products.iloc[:3].copy()
+    duplicates['Title'] = duplicates['Title'].str.upper() + " !"
+    duplicates.index = duplicates.index + 1000
+    catalog = pandas.concat([products, duplicates])
+    monkeypatch.setattr(classifier, "DEDUPLICATION", True)
+    fake_backend = install_fake_backend()
+    results = classifier.classify(ExperimentType.SELF_CONSISTENCY, catalog.copy())
+    assert fake_backend.calls == len(products) * classifier.N_SELF_CONSISTENCY
+    assert list(results.index) == list(catalog.index)
+    for i, representative in zip(duplicates.index, products.index[:3]):
+        assert results.loc[i, 'Duplicate Of'] == representative
+        assert results.loc[i, 'Predicted Path'] == results.loc[representative, 'Predicted Path']
+        assert results.loc[i, 'Response Round 0'] == results.loc[representative, 'Response Round 0']
+    assert results.loc[products.index, 'Duplicate Of'].isna().all()
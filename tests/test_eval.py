@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pandas
+import pytest
+
+import eval
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Results")
+
+
+@pytest.fixture
+def runs() -> eval.RunSet:
+    runs = eval.load_runs(os.path.join(RESULTS_DIRECTORY, "results_*_v0125.csv"))
+    assert runs.names == ["results_baseline_v0125", "results_choice-shuffling_v0125", "results_combined_v0125",
+                          "results_self-consistency_v0125"]
+    return runs
+
+
+def test_f1_scores_match_sklearn():
+    metrics = pytest.importorskip("sklearn.metrics")
+    result_data = pandas.read_csv(os.path.join(RESULTS_DIRECTORY, "results_combined_v0125.csv")).dropna(
+        subset=['Category Path', 'Predicted Path'])
+    scores = eval.eval_f1_scores(result_data['Category Path'], result_data['Predicted Path'])
+    assert scores['Paths Micro F1'] == pytest.approx(
+        metrics.f1_score(result_data['Category Path'], result_data['Predicted Path'], average='micro'))
+    assert scores['Paths Macro F1'] == pytest.approx(
+        metrics.f1_score(result_data['Category Path'], result_data['Predicted Path'], average='macro'))
+    second_level_true = result_data['Category Path'].str.split('>').str[1]
+    second_level_pred = result_data['Predicted Path'].str.split('>').str[1]
+    assert scores['Second-Level Macro F1'] == pytest.approx(
+        metrics.f1_score(second_level_true, second_level_pred, average='macro'))
+
+
+# Reference values of the *_v0125 runs on the Paths level, calculated with statsmodels' mcnemar (exact test below
+# 25 discordant pairs, chi-squared with continuity correction otherwise) and sklearn's cohen_kappa_score, in the order
+# baseline, choice-shuffling, combined, self-consistency
+REFERENCE_P_VALUES = {(0, 1): 0.2265625, (0, 2): 0.359283447265625, (0, 3): 1.0, (1, 2): 1.0, (1, 3): 0.2265625,
+                      (2, 3): 0.30175781249999994}
+REFERENCE_CHI2_P_VALUES = {(0, 1): 0.22779999398822554, (0, 2): 0.3587953578869416, (0, 3): 0.7236736098317629,
+                           (1, 2): 0.7728299926844475, (1, 3): 0.22779999398822554, (2, 3): 0.30169958247834494}
+REFERENCE_KAPPAS = {(0, 1): 0.8337489609310058, (0, 2): 0.7612869745718733, (0, 3): 0.8753764669228372,
+                    (1, 2): 0.8544244566912759, (1, 3): 0.8443821973233738, (2, 3): 0.8029863127333057}
+
+
+def test_compare_runs_matches_reference_values(runs):
+    p_values, kappas = eval.compare_runs(runs, 'Paths')
+    chi2_p_values, _ = eval.compare_runs(runs, 'Paths', exact=False)
+    for (i, j), p_value in REFERENCE_P_VALUES.items():
+        assert p_values.iloc[i, j] == pytest.approx(p_value)
+        assert p_values.iloc[j, i] == pytest.approx(p_value)
+        assert chi2_p_values.iloc[i, j] == pytest.approx(REFERENCE_CHI2_P_VALUES[(i, j)])
+        assert kappas.iloc[i, j] == pytest.approx(REFERENCE_KAPPAS[(i, j)])
+
+
+def test_single_pair_tests_match_reference_values(runs):
+    labels = runs.labels['Paths']
+    gold = labels[runs.gold['Paths']]
+    predictions = [labels[codes] for codes in runs.predictions['Paths']]
+    assert eval.mcnemar_test(gold, predictions[0], predictions[2]) == pytest.approx(REFERENCE_P_VALUES[(0, 2)])
+    assert eval.mcnemar_test(gold, predictions[0], predictions[2], exact=False) == \
+        pytest.approx(REFERENCE_CHI2_P_VALUES[(0, 2)])
+    assert eval.cohen_kappa(predictions[0], predictions[2]) == pytest.approx(REFERENCE_KAPPAS[(0, 2)])
+
+
+def test_bootstrap_interval_contains_score(runs):
+    scores = eval.evaluate_runs(runs, n_resamples=200)
+    assert (scores['Paths Micro F1 Lower'] <= scores['Paths Micro F1']).all()
+    assert (scores['Paths Micro F1'] <= scores['Paths Micro F1 Upper']).all()
+    assert np.isfinite(scores.to_numpy(dtype=float)).all()
@@ -0,0 +1,41 @@
+import classifier
+import matcher
+
+MICE = "Computers & Electronics>Data Input Devices>Mice"
+KEYBOARDS = "Computers & Electronics>Data Input Devices>Keyboards"
+
+
+def test_find_returns_last_path():
+    path_matcher = matcher.PathMatcher(["a>b>c", "a>b>d", "x>y>z"])
+    assert path_matcher.find("first a>b>c, then x>y>z and finally a>b>d.") == "a>b>d"
+    assert path_matcher.find_all("a>b>c or a>b>d") == ["a>b>c", "a>b>d"]
+
+
+def test_find_prefers_longest_path():
+    path_matcher = matcher.PathMatcher(["a>b>c", "a>b>cd"])
+    assert path_matcher.find("the answer is a>b>cd") == "a>b>cd"
+    assert path_matcher.find("the answer is a>b>c.") == "a>b>c"
+
+
+def test_find_without_path():
+    assert matcher.PathMatcher(["a>b>c"]).find("no path here, only a>b") is None
+
+
+def test_pattern_escapes_special_characters():
+    path_matcher = matcher.PathMatcher(["a>(b)>c+"])
+    assert path_matcher.find("path a>(b)>c+ found") == "a>(b)>c+"
+
+
+def test_extract_response_path_normalizes_separators():
+    response = f"I considered {KEYBOARDS}, but the final answer is Computers & Electronics > Data Input Devices > Mice"
+    assert classifier.extract_response_path(response) == MICE
+
+
+def test_extract_response_path_rejects_paths_outside_the_tree():
+    assert classifier.extract_response_path("Computers & Electronics>Projectors>Mice") == -1
+    assert classifier.extract_response_path("no path") == -1
+
+
+def test_extract_response_path_below_second_level_label():
+    assert classifier.extract_response_path(f"{MICE}", "Data Input Devices") == MICE
+    assert classifier.extract_response_path(f"{MICE}", "Projectors") == -1
@@ -0,0 +1,46 @@
+import pandas
+import pytest
+
+import classifier
+import metrics
+import prefilter
+from backend import Completion
+from util import ExperimentType
+
+
+def test_resolved_rows_count_with_zero_calls():
+    recorder = metrics.MetricsRecorder()
+    row_metrics = metrics.RowMetrics()
+    for _ in range(2):
+        recorder.record_call("Baseline", "model", row_metrics, Completion(["a>b>c"], 30, 10, 0.5, 1))
+    recorder.record_row("Baseline", "model", row_metrics)
+    recorder.record_resolved_row("Baseline", "model", "prefilter")
+    recorder.record_resolved_row("Baseline", "model", "duplicate")
+    [report] = recorder.to_report()
+    assert (report['Rows'], report['Prefilter Rows'], report['Duplicate Rows']) == (3, 1, 1)
+    assert report['Calls Per Product'] == 2 / 3
+    assert report['Tokens Per Product'] == 80 / 3
+    assert report['Retries'] == 2
+    with pytest.raises(ValueError):
+        recorder.record_resolved_row("Baseline", "model", "cache")
+
+
+def test_run_report_counts_prefilter_and_duplicate_rows(run_directory, install_fake_backend, products,
+                                                         monkeypatch):
+    index = prefilter.NearestNeighbourIndex()
+    index.add([prefilter.get_product_text(title, brand) for title, brand in
+               zip(products['Title'].iloc[:4], products['Brand'].iloc[:4])], list(products['Category Path'].iloc[:4]))
+    duplicates = products.iloc[4:6].copy()
+    duplicates['Title'] = duplicates['Title'].str.upper()
+    duplicates.index = duplicates.index + 1000
+    monkeypatch.setattr(classifier, "PREFILTER_INDEX", index)
+    monkeypatch.setattr(classifier, "PREFILTER_THRESHOLD", 0.5)
+    monkeypatch.setattr(classifier, "DEDUPLICATION", True)
+    fake_backend = install_fake_backend()
+    classifier.classify(ExperimentType.BASELINE, pandas.concat([products, duplicates]))
+    [report] = classifier.run_metrics.to_report()
+    assert report['Rows'] == len(products) + len(duplicates)
+    assert report['Prefilter Rows'] == 4
+    assert report['Duplicate Rows'] == len(duplicates)
+    assert report['Calls'] == fake_backend.calls == len(products) - 4
+    assert report['Calls Per Product'] == report['Calls'] / report['Rows']
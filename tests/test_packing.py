@@ -0,0 +1,97 @@
+import re
+
+import classifier
+import packing
+from util import ExperimentType
+
+MICE = "Computers & Electronics>Data Input Devices>Mice"
+KEYBOARDS = "Computers & Electronics>Data Input Devices>Keyboards"
+
+
+def test_split_packed_response_at_markers():
+    response = f"Product 1: A mouse, so {MICE}\n**Product 2:** A keyboard, so {KEYBOARDS}"
+    assert packing.split_packed_response(response, 2) == [f"Product 1: A mouse, so {MICE}",
+                                                         f"**Product 2:** A keyboard, so {KEYBOARDS}"]
+
+
+def test_split_packed_response_ignores_numbered_reasoning():
+    response = ("Product 1:\n1. The product is a mouse.\n2. Therefore the path is " + MICE + "\n"
+                "Product 2:\n1. The product is a keyboard.\n2. Therefore the path is " + KEYBOARDS)
+    sections = packing.split_packed_response(response, 2)
+    assert MICE in sections[0] and KEYBOARDS not in sections[0]
+    assert KEYBOARDS in sections[1] and MICE not in sections[1]
+
+
+def test_split_packed_response_without_markers():
+    response = f"1. The first product is a mouse: {MICE}\n2. The second one is a keyboard: {KEYBOARDS}"
+    assert packing.split_packed_response(response, 2) == [None, None]
+
+
+def test_split_packed_response_rejects_ambiguous_markers():
+    assert packing.split_packed_response(f"Product 1: {MICE}\nProduct 1: {KEYBOARDS}", 2) is None
+    assert packing.split_packed_response(f"Product 1: {MICE}\nProduct 3: {KEYBOARDS}", 2) is None
+    assert packing.split_packed_response(f"Product 0: {MICE}", 2) is None
+
+
+def test_format_packed_user_prompt_marks_products():
+    prompt = packing.format_packed_user_prompt([("Mouse", "Logitech"), ("Keyboard", "Cherry")], ["Computers"],
+                                               ["Notebooks"])
+    assert "Product 1: \"Mouse\" of the brand Logitech" in prompt
+    assert "Product 2: \"Keyboard\" of the brand Cherry" in prompt
+
+
+def get_user_prompt(messages: list[dict]) -> str:
+    return messages[-1]["content"]
+
+
+def test_packed_rows_answered_with_marked_sections(run_directory, install_fake_backend, products, monkeypatch):
+    paths = dict(zip(products['Title'], products['Category Path']))
+
+    def responder(messages, temperature):
+        titles = re.findall(r"^Product \d+: \"(.*)\" of the brand", get_user_prompt(messages), re.MULTILINE)
+        return "\n".join(f"Product {number}: {paths[title]}" for number, title in enumerate(titles, start=1))
+
+    fake_backend = install_fake_backend(responder)
+    monkeypatch.setitem(classifier.PACK_SIZES, ExperimentType.BASELINE, 4)
+    results = classifier.classify(ExperimentType.BASELINE, products.copy())
+    assert list(results['Predicted Path']) == list(products['Category Path'])
+    assert fake_backend.calls == 2
+
+
+def test_packed_rows_fall_back_on_unsplittable_response(run_directory, install_fake_backend, products,
+                                                         monkeypatch):
+    paths = dict(zip(products['Title'], products['Category Path']))
+
+    def responder(messages, temperature):
+        prompt = get_user_prompt(messages)
+        if "products instead of one" in prompt:
+            # numbered reasoning without product markers, answering every product with the first path
+            return f"1. The first product is a mouse.\n2. Therefore it belongs to {MICE}"
+        return next(path for title, path in paths.items() if f"\"{title}\"" in prompt)
+
+    fake_backend = install_fake_backend(responder)
+    monkeypatch.setitem(classifier.PACK_SIZES, ExperimentType.BASELINE, 4)
+    results = classifier.classify(ExperimentType.BASELINE, products.copy())
+    assert list(results['Predicted Path']) == list(products['Category Path'])
+    # one packed request per pack, then one request per product
+    assert fake_backend.calls == 2 + len(products)
+
+
+def test_packed_rows_resubmit_only_invalid_sections(run_directory, install_fake_backend, products, monkeypatch):
+    paths = dict(zip(products['Title'], products['Category Path']))
+    invalid_titles = {products['Title'].iloc[1], products['Title'].iloc[6]}
+
+    def responder(messages, temperature):
+        prompt = get_user_prompt(messages)
+        if "products instead of one" not in prompt:
+            return next(path for title, path in paths.items() if f"\"{title}\"" in prompt)
+        titles = re.findall(r"^Product \d+: \"(.*)\" of the brand", prompt, re.MULTILINE)
+        return "\n".join(f"Product {number}: " + ("I am not sure." if title in invalid_titles else paths[title])
+                         for number, title in enumerate(titles, start=1))
+
+    fake_backend = install_fake_backend(responder)
+    monkeypatch.setitem(classifier.PACK_SIZES, ExperimentType.BASELINE, 4)
+    results = classifier.classify(ExperimentType.BASELINE, products.copy())
+    assert list(results['Predicted Path']) == list(products['Category Path'])
+    # one packed request per pack, then one request per product without a valid path
+    assert fake_backend.calls == 2 + len(invalid_titles)
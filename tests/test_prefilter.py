@@ -0,0 +1,45 @@
+import pytest
+
+import classifier
+import prefilter
+from util import ExperimentType
+
+
+def get_texts(products) -> list[str]:
+    return [prefilter.get_product_text(title, brand) for title, brand in zip(products['Title'], products['Brand'])]
+
+
+def test_empty_index_is_uncertain():
+    assert prefilter.NearestNeighbourIndex().query(["logitech mouse", "cherry keyboard"]) == [(None, 0.0)] * 2
+
+
+def test_query_votes_for_the_closest_labels(products):
+    index = prefilter.NearestNeighbourIndex()
+    index.add(get_texts(products.iloc[:4]) + ["unlabeled product"], list(products['Category Path'].iloc[:4]) +
+              ["None>None>None"])
+    assert len(index) == 4
+    predictions = index.query(get_texts(products))
+    assert [path for path, _ in predictions[:4]] == list(products['Category Path'].iloc[:4])
+    assert all(confidence >= 0.5 for _, confidence in predictions[:4])
+    # products without a labeled neighbour get a low confidence
+    assert all(confidence < 0.5 for _, confidence in predictions[4:])
+
+
+@pytest.mark.parametrize("threshold, llm_rows", [(0.5, 4), (1.01, 8)])
+def test_confident_rows_bypass_the_llm(run_directory, install_fake_backend, products, monkeypatch, threshold,
+                                       llm_rows):
+    index = prefilter.NearestNeighbourIndex()
+    index.add(get_texts(products.iloc[:4]), list(products['Category Path'].iloc[:4]))
+    monkeypatch.setattr(classifier, "PREFILTER_INDEX", index)
+    monkeypatch.setattr(classifier, "PREFILTER_THRESHOLD", threshold)
+    fake_backend = install_fake_backend()
+    results = classifier.classify(ExperimentType.BASELINE, products.copy())
+    assert fake_backend.calls == llm_rows
+    assert results['Prefilter Confidence'].notna().all()
+    bypassed = results['Prefilter Confidence'] >= threshold
+    assert bypassed.sum() == len(products) - llm_rows
+    assert (results.loc[bypassed, 'Predicted Path'] == results.loc[bypassed, 'Prefilter Path']).all()
+    assert results.loc[bypassed, 'Response'].isna().all()
+    assert results.loc[~bypassed, 'Response'].notna().all()
+    # the rows classified by the LLM are added to the index for later chunks
+    assert len(index) == 4 + llm_rows
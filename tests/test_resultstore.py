@@ -0,0 +1,56 @@
+import pandas
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import eval  # noqa: E402
+import resultstore  # noqa: E402
+
+
+def get_results(run: int, n_rows: int = 6) -> pandas.DataFrame:
+    return pandas.DataFrame({'Title': [f"Product {i}" for i in range(n_rows)],
+                             'Brand': ["Brand"] * n_rows,
+                             'Category Path': ["a>b>c", "a>b>d"] * (n_rows // 2),
+                             'Path Round 0': ["a>b>c"] * n_rows,
+                             'Response Round 0': [f"Run {run} answers a>b>c"] * n_rows,
+                             'Predicted Path': ["a>b>c"] * (n_rows - 1) + [None]},
+                            index=pandas.RangeIndex(n_rows, name="Index"))
+
+
+def test_append_and_load_round_trip(tmp_path):
+    writer = resultstore.ResultStoreWriter(str(tmp_path), "combined", "org/model", "run_a", date="2024-05-08")
+    results = get_results(0)
+    writer.append(results.iloc[:3])
+    writer.append(results.iloc[3:])
+    loaded = resultstore.load_results(str(tmp_path), with_responses=True).sort_values("Index")
+    assert list(loaded['Index']) == list(results.index)
+    assert list(loaded['Predicted Path'].fillna("missing")) == list(results['Predicted Path'].fillna("missing"))
+    assert list(loaded['Response Round 0']) == list(results['Response Round 0'])
+    assert set(loaded['model']) == {"org/model"}
+    assert set(loaded['date']) == {"2024-05-08"}
+
+
+def test_path_columns_skip_responses(tmp_path):
+    resultstore.ResultStoreWriter(str(tmp_path), "combined", "model", "run_a").append(get_results(0))
+    loaded = resultstore.load_results(str(tmp_path), ['Predicted Path'])
+    assert 'Response Round 0' not in loaded.columns
+    assert 'Response Round 0' not in resultstore.open_dataset(str(tmp_path)).schema.names
+
+
+def test_query_across_runs(tmp_path):
+    resultstore.ResultStoreWriter(str(tmp_path), "combined", "model", "run_a").append(get_results(0))
+    resultstore.ResultStoreWriter(str(tmp_path), "baseline", "model", "run_b").append(get_results(1))
+    runs = resultstore.list_runs(str(tmp_path))
+    assert sorted(runs['Run']) == ["run_a", "run_b"]
+    assert list(runs['Rows']) == [6, 6]
+    assert set(resultstore.load_results(str(tmp_path), experiment="baseline")['Run']) == {"run_b"}
+    run_set = eval.load_store_runs(str(tmp_path))
+    assert run_set.names == ["run_a", "run_b"]
+    assert len(run_set.index) == 5
+
+
+def test_rerun_replaces_parts(tmp_path):
+    resultstore.ResultStoreWriter(str(tmp_path), "combined", "model", "run_a").append(get_results(0))
+    resultstore.ResultStoreWriter(str(tmp_path), "combined", "model", "run_a",
+                                  date="2099-01-01").append(get_results(0, 4))
+    assert list(resultstore.list_runs(str(tmp_path))['Rows']) == [4]
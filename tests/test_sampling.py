@@ -0,0 +1,56 @@
+import pytest
+
+import sampling
+
+SECOND_LEVEL_LABELS = ["Computers", "Data Input Devices"]
+THIRD_LEVEL_LABELS = ["Mice", "Keyboards"]
+
+
+def get_rounds(temperatures: list[float], orderings: int = 1) -> list[tuple[str, float, list[str], list[str]]]:
+    # every ordering of the labels reverses the previous one, like the permutations of choice shuffling
+    label_orders = [SECOND_LEVEL_LABELS if ordering % 2 == 0 else SECOND_LEVEL_LABELS[::-1]
+                    for ordering in range(orderings)]
+    return [(f"Round {ordering}-{i}", temperature, label_orders[ordering], THIRD_LEVEL_LABELS)
+            for ordering in range(orderings) for i, temperature in enumerate(temperatures)]
+
+
+def get_samples_per_round(requests: list[sampling.SampleRequest]) -> dict[str, int]:
+    samples = {}
+    for request in requests:
+        for round_name in request.round_names:
+            samples[round_name] = samples.get(round_name, 0) + 1
+    return samples
+
+
+@pytest.mark.parametrize("max_samples, temperature_buckets", [(1, None), (8, None), (8, 1), (2, 1), (3, 2), (8, 5)])
+def test_grouping_keeps_one_sample_per_round(max_samples, temperature_buckets):
+    rounds = get_rounds([0.0, 0.25, 0.5, 0.75, 1.0], orderings=2)
+    requests = sampling.plan_requests(rounds, max_samples, temperature_buckets)
+    assert get_samples_per_round(requests) == get_samples_per_round(sampling.plan_requests(rounds))
+    assert sum(len(request.round_names) for request in requests) == len(rounds)
+    assert all(len(request.round_names) <= max_samples for request in requests)
+    # rounds are only grouped with rounds sharing their label order
+    orderings = {round_name: second_level_labels for round_name, _, second_level_labels, _ in rounds}
+    for request in requests:
+        assert all(orderings[round_name] == request.second_level_labels for round_name in request.round_names)
+
+
+def test_exact_temperatures_are_not_grouped():
+    requests = sampling.plan_requests(get_rounds([0.0, 0.25, 0.5, 0.75, 1.0]), max_samples=8)
+    assert [request.temperature for request in requests] == [0.0, 0.25, 0.5, 0.75, 1.0]
+    requests = sampling.plan_requests(get_rounds([0.5] * 5), max_samples=2)
+    assert [len(request.round_names) for request in requests] == [2, 2, 1]
+
+
+def test_temperatures_map_to_their_bucket():
+    assert [sampling.get_temperature_bucket(temperature, 2) for temperature in [0.0, 0.25, 0.49, 0.5, 0.75, 1.0]] == \
+        [0, 0, 0, 1, 1, 1]
+    assert [sampling.get_temperature_bucket(temperature, 5) for temperature in [0.0, 0.19, 0.2, 0.5, 0.99, 1.0]] == \
+        [0, 0, 1, 2, 4, 4]
+
+
+def test_buckets_sample_at_their_mean_temperature():
+    requests = sampling.plan_requests(get_rounds([0.0, 0.25, 0.5, 0.75, 1.0]), max_samples=8, temperature_buckets=2)
+    assert [request.round_names for request in requests] == [["Round 0-0", "Round 0-1"],
+                                                            ["Round 0-2", "Round 0-3", "Round 0-4"]]
+    assert [request.temperature for request in requests] == pytest.approx([0.125, 0.75])
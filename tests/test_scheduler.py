@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+import backend
+import cache
+import classifier
+import scheduler
+from util import ExperimentType
+
+MESSAGES = [{"role": "user", "content": "Classify the product"}]
+
+
+class FakeClock:
+    """
+    Replaces the time module of the scheduler, sleeping only advances the clock
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    fake_clock = FakeClock()
+    monkeypatch.setattr(scheduler, "time", fake_clock)
+    return fake_clock
+
+
+def test_token_bucket_waits_for_refill(clock):
+    bucket = scheduler.TokenBucket(60)
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    clock.sleep(31)
+    assert bucket.reserve(20) == 0.0
+    # the bucket never holds more than its capacity
+    clock.sleep(600)
+    assert bucket.reserve(70) == pytest.approx(10.0)
+    bucket.adjust(-10)
+    assert bucket.reserve(0) == 0.0
+
+
+def test_retry_after_pauses_all_requests(clock):
+    rate_limit_scheduler = scheduler.RateLimitScheduler(base_delay=0.5)
+    error = backend.RateLimitError("HTTP 429", 429, retry_after=5.0)
+    assert rate_limit_scheduler.get_admission_delay(100, 1) == 0.0
+    assert rate_limit_scheduler.get_retry_delay(error, 1) == pytest.approx(5.0)
+    assert rate_limit_scheduler.get_admission_delay(100, 1) == pytest.approx(5.0)
+    clock.sleep(2)
+    assert rate_limit_scheduler.get_admission_delay(100, 1) == pytest.approx(3.0)
+    # a Retry-After of a server error delays the retry, but doesn't pause other requests
+    rate_limit_scheduler = scheduler.RateLimitScheduler(base_delay=0.5)
+    assert rate_limit_scheduler.get_retry_delay(backend.ServerError("HTTP 503", 503, retry_after=4.0), 1) == \
+        pytest.approx(4.0)
+    assert rate_limit_scheduler.get_admission_delay(100, 1) == 0.0
+
+
+def test_run_sync_retries_until_success(clock, failing_backend):
+    failing = failing_backend(2)
+    completion = scheduler.RateLimitScheduler(base_delay=1.0).run_sync(
+        lambda: failing.complete("model", MESSAGES), 100)
+    assert failing.attempts == 3
+    assert completion.retries == 2
+    assert len(clock.sleeps) == 2
+    assert all(0 <= delay <= 2.0 for delay in clock.sleeps)
+
+
+def test_run_sync_stops_after_max_attempts(clock, failing_backend):
+    failing = failing_backend(10, backend.ServerError("HTTP 500", 500))
+    with pytest.raises(backend.ServerError):
+        scheduler.RateLimitScheduler().run_sync(lambda: failing.complete("model", MESSAGES), 100)
+    assert failing.attempts == scheduler.DEFAULT_RETRY_POLICY[backend.ServerError]
+    # errors without a retry policy fail on the first attempt
+    failing = failing_backend(1, backend.BackendError("HTTP 400", 400))
+    with pytest.raises(backend.BackendError):
+        scheduler.RateLimitScheduler().run_sync(lambda: failing.complete("model", MESSAGES), 100)
+    assert failing.attempts == 1
+
+
+def test_retry_budget_limits_retries(clock, failing_backend):
+    rate_limit_scheduler = scheduler.RateLimitScheduler(retry_budget=0.0, min_retry_budget=2)
+    failing = failing_backend(10)
+    with pytest.raises(scheduler.RetryBudgetExhaustedError):
+        rate_limit_scheduler.run_sync(lambda: failing.complete("model", MESSAGES), 100)
+    assert failing.attempts == 3
+    assert rate_limit_scheduler.retries == 2
+
+
+def test_retries_bypass_the_response_cache(tmp_path, failing_backend):
+    failing = failing_backend(2)
+    caching_backend = cache.CachingBackend(failing, cache.ResponseCache(str(tmp_path / "cache.sqlite")))
+    rate_limit_scheduler = scheduler.RateLimitScheduler(base_delay=0.0)
+    completion = asyncio.run(caching_backend.acomplete_with(lambda request: rate_limit_scheduler.run(request, 100),
+                                                            "model", MESSAGES))
+    assert failing.attempts == 3
+    assert completion.retries == 2
+    # the cache is consulted once and stores the completion under the first occurrence of the request
+    assert caching_backend.cache.stats()['Misses'] == 1
+    assert caching_backend.occurrences == {cache.ResponseCache.create_key("model", MESSAGES, 0.5, 1, {}): 1}
+    assert caching_backend.cache.get(cache.ResponseCache.create_key("model", MESSAGES, 0.5, 1, {})).texts == \
+        completion.texts
+
+
+def test_classify_retries_under_an_active_cache(run_directory, failing_backend, products, monkeypatch):
+    failing = failing_backend(3)
+    caching_backend = cache.CachingBackend(failing, cache.ResponseCache(str(run_directory / "cache.sqlite")))
+    monkeypatch.setattr(backend, "_backend", caching_backend)
+    monkeypatch.setattr(scheduler, "_scheduler", scheduler.RateLimitScheduler(base_delay=0.0))
+    results = classifier.classify(ExperimentType.BASELINE, products.copy())
+    assert results['Predicted Path'].notna().all()
+    assert failing.attempts == len(products) + 3
+    assert caching_backend.cache.stats()['Entries'] == len(products)
+    assert caching_backend.cache.stats()['Misses'] == len(products)
@@ -0,0 +1,56 @@
+import pandas
+import pytest
+
+import data
+import sharding
+from util import ExperimentType
+
+
+def test_get_shard_is_stable():
+    # crc32 of the row index, the same in every process and on every machine
+    assert [sharding.get_shard(i, 4) for i in range(12)] == [1, 3, 1, 3, 0, 2, 0, 2, 3, 1, 1, 3]
+    assert [sharding.get_shard(f"p{i}", 3) for i in range(4)] == [1, 1, 2, 1]
+    assert all(sharding.get_shard(i, 1) == 0 for i in range(10))
+
+
+def test_iter_shard_partitions_the_catalog(products):
+    chunks = [products.iloc[:3], products.iloc[3:]]
+    shards = [pandas.concat(sharding.iter_shard(chunks, shard_index, 3)) for shard_index in range(3)]
+    assert sorted(i for shard in shards for i in shard.index) == sorted(products.index)
+    for shard_index, shard in enumerate(shards):
+        assert all(sharding.get_shard(i, 3) == shard_index for i in shard.index)
+
+
+def test_get_shard_path():
+    assert sharding.get_shard_path("Results/run.csv", 1, 4) == "Results/run_shard-1-of-4.csv"
+    assert sharding.get_shard_path("Results/run.csv", 1, 4, ".jsonl") == "Results/run_shard-1-of-4.jsonl"
+    assert sharding.get_shard_path("Results/run.csv", 0, 1) == "Results/run.csv"
+
+
+def test_merge_results_keeps_the_first_column_order(tmp_path):
+    first = pandas.DataFrame({'Title': ["a", "b"], 'Predicted Path': ["x>y>z", "x>y>w"], 'Response': ["r", "s"]},
+                             index=pandas.Index([3, 1], name=data.INDEX_COLUMN))
+    second = pandas.DataFrame({'Response': ["t"], 'Title': ["c"], 'Predicted Path': ["x>y>v"]},
+                              index=pandas.Index([2], name=data.INDEX_COLUMN))
+    first.to_csv(tmp_path / "shard-0.csv")
+    second.to_csv(tmp_path / "shard-2.csv")
+    output_path = str(tmp_path / "merged" / "results.csv")
+    # shard 1 has no results file, e.g. because it had no rows
+    sharding.merge_results([str(tmp_path / f"shard-{i}.csv") for i in range(3)], output_path, chunk_size=1)
+    merged = pandas.read_csv(output_path, index_col=data.INDEX_COLUMN)
+    assert list(merged.columns) == ['Title', 'Predicted Path', 'Response']
+    assert list(merged.index) == [3, 1, 2]
+    assert list(merged['Response']) == ["r", "s", "t"]
+
+
+@pytest.mark.parametrize("cache_path", [None, "cache.sqlite"])
+def test_run_sharded_merges_all_rows(run_directory, products, cache_path):
+    input_path = str(run_directory / "catalog.csv")
+    products.to_csv(input_path, index_label=data.INDEX_COLUMN)
+    output_path = str(run_directory / "Results" / "results.csv")
+    config = sharding.RunConfig(ExperimentType.SELF_CONSISTENCY, backend_name="fake", chunk_size=3,
+                                cache_path=cache_path and str(run_directory / cache_path))
+    assert sharding.run_sharded(config, input_path, output_path, shards=2) == output_path
+    merged = pandas.read_csv(output_path, index_col=data.INDEX_COLUMN)
+    assert sorted(merged.index) == sorted(products.index)
+    assert merged['Predicted Path'].notna().all()
@@ -0,0 +1,51 @@
+import checkpoint
+import classifier
+import sharding
+import shuffling
+from util import ExperimentType
+
+SECOND_LEVEL_LABELS = [f"Second {i}" for i in range(10)]
+THIRD_LEVEL_LABELS = [f"Third {i}" for i in range(20)]
+
+
+def test_orderings_are_derived_from_the_seed():
+    registry = shuffling.PermutationRegistry(SECOND_LEVEL_LABELS, THIRD_LEVEL_LABELS, 3, seed=7)
+    assert registry.get_orderings() == shuffling.PermutationRegistry(SECOND_LEVEL_LABELS, THIRD_LEVEL_LABELS, 3,
+                                                                     seed=7).get_orderings()
+    assert registry.get_orderings() != shuffling.PermutationRegistry(SECOND_LEVEL_LABELS, THIRD_LEVEL_LABELS, 3,
+                                                                     seed=8).get_orderings()
+    assert all(sorted(ordering.second_level_labels) == sorted(SECOND_LEVEL_LABELS)
+               for ordering in registry.get_orderings())
+    # shared orderings ignore the row
+    assert registry.get_orderings(5) is registry.get_orderings()
+
+
+def test_per_row_orderings():
+    registry = shuffling.PermutationRegistry(SECOND_LEVEL_LABELS, THIRD_LEVEL_LABELS, 3, seed=7, per_row=True)
+    assert registry.get_orderings(1) == registry.get_orderings(1)
+    assert registry.get_orderings(1) != registry.get_orderings(2)
+
+
+def test_resume_without_seed_keeps_the_orderings(run_directory, install_fake_backend, products, monkeypatch):
+    monkeypatch.setattr(classifier, "permutation_registry", None)
+    checkpoint_path = str(run_directory / "checkpoint.jsonl")
+    install_fake_backend()
+    classifier.classify(ExperimentType.CHOICE_SHUFFLING, products.iloc[:5].copy(), checkpoint_path=checkpoint_path)
+    seed = classifier.get_permutation_registry().seed
+    assert checkpoint.load_specification(checkpoint_path)['Shuffle Seed'] == seed
+
+    # a new process draws another random seed unless it is restored from the checkpoint
+    monkeypatch.setattr(classifier, "permutation_registry", None)
+    fake_backend = install_fake_backend()
+    classifier.classify(ExperimentType.CHOICE_SHUFFLING, products.copy(), checkpoint_path=checkpoint_path,
+                        resume=True)
+    assert classifier.get_permutation_registry().seed == seed
+    assert fake_backend.calls == (len(products) - 5) * classifier.N_CHOICE_SHUFFLING
+
+
+def test_shards_share_the_recorded_seed(tmp_path):
+    output_path = str(tmp_path / "results.csv")
+    assert sharding.get_shuffle_seed(output_path, 2, resume=True) != sharding.get_shuffle_seed(output_path, 2)
+    writer = checkpoint.CheckpointWriter(sharding.get_shard_path(output_path, 1, 2, ".jsonl"), {'Shuffle Seed': 42})
+    writer.close()
+    assert sharding.get_shuffle_seed(output_path, 2, resume=True) == 42
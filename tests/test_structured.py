@@ -0,0 +1,46 @@
+import json
+
+import structured
+import taxonomy
+
+
+def get_alternatives(response_format: dict) -> list[dict]:
+    return response_format["json_schema"]["schema"]["properties"]["category"]["anyOf"]
+
+
+def test_response_format_restricts_children_to_their_parent():
+    category_taxonomy = taxonomy.get_taxonomy()
+    response_format = structured.get_response_format(tuple(category_taxonomy.second_level_labels),
+                                                     tuple(category_taxonomy.third_level_labels), category_taxonomy)
+    alternatives = get_alternatives(response_format)
+    assert [alternative["properties"]["second_level_category"]["enum"][0] for alternative in alternatives] == \
+        category_taxonomy.second_level_labels
+    for alternative in alternatives:
+        second_level_label = alternative["properties"]["second_level_category"]["enum"][0]
+        assert sorted(alternative["properties"]["third_level_category"]["enum"]) == \
+            sorted(category_taxonomy.get_children(second_level_label))
+
+
+def test_response_format_keeps_the_prompt_order():
+    category_taxonomy = taxonomy.get_taxonomy()
+    second_level_labels = tuple(reversed(category_taxonomy.second_level_labels))
+    third_level_labels = tuple(reversed(category_taxonomy.third_level_labels))
+    alternatives = get_alternatives(structured.get_response_format(second_level_labels, third_level_labels,
+                                                                   category_taxonomy))
+    assert alternatives[0]["properties"]["second_level_category"]["enum"] == [second_level_labels[0]]
+    children = alternatives[0]["properties"]["third_level_category"]["enum"]
+    assert children == [label for label in third_level_labels if label in children]
+
+
+def test_extract_structured_path():
+    response = json.dumps({"category": {"second_level_category": "Data Input Devices",
+                                        "third_level_category": "Mice"}})
+    assert structured.extract_structured_path(response) == "Computers & Electronics>Data Input Devices>Mice"
+
+
+def test_extract_structured_path_rejects_invalid_responses():
+    invalid_path = json.dumps({"category": {"second_level_category": "Projectors", "third_level_category": "Mice"}})
+    assert structured.extract_structured_path(invalid_path) == -1
+    assert structured.extract_structured_path("Computers & Electronics>Data Input Devices>Mice") == -1
+    assert structured.extract_structured_path(json.dumps({"category": "Mice"})) == -1
+    assert structured.extract_structured_path(json.dumps([1, 2])) == -1
@@ -0,0 +1,50 @@
+import classifier
+import util
+from util import ExperimentType
+
+
+def test_vote_decided_once_the_leader_can_not_be_overtaken():
+    assert util.is_vote_decided(["a", "a", "a"], 2)
+    assert not util.is_vote_decided(["a", "a"], 2)
+    assert util.is_vote_decided(["a", "a", "b"], 0)
+    assert not util.is_vote_decided([], 5)
+    assert util.is_vote_decided([], 0)
+
+
+def test_tie_is_not_decided():
+    assert not util.is_vote_decided(["a", "b"], 1)
+    # a tie has neither a margin nor a leader with more than half of the votes
+    assert not util.is_vote_decided(["a", "b", "a", "b"], 1, confidence=0.6, margin=1)
+    assert util.is_vote_decided(["a", "b", "a"], 1, margin=1)
+    # without remaining votes a tie stays undecided, the majority falls to the string voted first
+    assert not util.is_vote_decided(["a", "b"], 0)
+    assert util.most_common_string(["a", "b"]) == "a"
+
+
+def test_thresholds_respect_min_votes():
+    assert util.is_vote_decided(["a"], 4, confidence=0.5)
+    assert not util.is_vote_decided(["a"], 4, confidence=0.5, min_votes=2)
+    assert util.is_vote_decided(["a", "a", "b"], 2, confidence=0.6)
+    assert not util.is_vote_decided(["a", "a", "b"], 2, confidence=0.7)
+    assert util.is_vote_decided(["a", "a", "a", "b"], 3, margin=2)
+
+
+def test_next_vote_count():
+    # without votes, a majority of five rounds needs three votes
+    assert util.get_next_vote_count([], 5) == 3
+    assert util.get_next_vote_count(["a", "a"], 3) == 1
+    # after a tie, the leader needs two further votes to lead by more than the remaining votes
+    assert util.get_next_vote_count(["a", "b"], 3) == 2
+    assert util.get_next_vote_count(["a", "b"], 1) == 1
+    assert util.get_next_vote_count([], 5, margin=1, min_votes=2) == 2
+
+
+def test_adaptive_voting_skips_decided_rounds(run_directory, install_fake_backend, products, monkeypatch):
+    paths = dict(zip(products['Title'], products['Category Path']))
+    fake_backend = install_fake_backend(lambda messages, temperature: next(
+        path for title, path in paths.items() if f"\"{title}\"" in messages[-1]["content"]))
+    monkeypatch.setattr(classifier, "ADAPTIVE_VOTING", True)
+    results = classifier.classify(ExperimentType.SELF_CONSISTENCY, products.copy())
+    assert list(results['Predicted Path']) == list(products['Category Path'])
+    assert fake_backend.calls == 3 * len(products)
+    assert (results['Calls Used'] == 3).all()
@@ -30,6 +30,55 @@ def most_common_string(strings: list[str]) -> str:
     return most_common
 
 
+def is_vote_decided(votes: list[str], remaining_votes: int, confidence: float = None, margin: int = None,
+                    min_votes: int = 1) -> bool:
+    """
+    Checks whether a majority vote can stop early. The vote is decided if the leading string can't be overtaken or
+    tied by the remaining votes, or if one of the optional thresholds is met.
+
+    :param votes: the votes cast so far
+    :param remaining_votes: number of votes that are still outstanding
+    :param confidence: decides once the leading string has at least this share of the votes cast, None to disable
+    :param margin: decides once the leading string leads by at least this many votes, None to disable
+    :param min_votes: minimum number of votes cast before the thresholds are checked
+    :return: True if the vote is decided
+    """
+    if not votes:
+        return remaining_votes == 0
+    counts = Counter(votes).most_common(2)
+    leader_count = counts[0][1]
+    runner_up_count = counts[1][1] if len(counts) > 1 else 0
+    if leader_count > runner_up_count + remaining_votes:
+        return True
+    if len(votes) < min_votes:
+        return False
+    if margin is not None and leader_count - runner_up_count >= margin:
+        return True
+    if confidence is not None and leader_count / len(votes) >= confidence:
+        return True
+    return False
+
+
+def get_next_vote_count(votes: list[str], remaining_votes: int, confidence: float = None, margin: int = None,
+                        min_votes: int = 1) -> int:
+    """
+    Calculates how many further votes are needed at least before the vote could be decided, i.e. assuming that all
+    of them go to the currently leading string.
+
+    :param votes: the votes cast so far
+    :param remaining_votes: number of votes that are still outstanding
+    :param confidence: see is_vote_decided()
+    :param margin: see is_vote_decided()
+    :param min_votes: see is_vote_decided()
+    :return: number of votes to cast next, between 1 and remaining_votes
+    """
+    leader = most_common_string(votes) if votes else ""
+    for count in range(1, remaining_votes):
+        if is_vote_decided(votes + [leader] * count, remaining_votes - count, confidence, margin, min_votes):
+            return count
+    return remaining_votes
+
+
 def get_current_datetime():
     """
     Creates a formatted string of the current date and time